@@ -0,0 +1,125 @@
+# Standard library imports
+import os
+import time
+import logging
+
+# Third-party imports
+from sqlalchemy import select, delete
+
+# Local application imports
+from .db_utils import Session
+from .models import (User, Category, Expense, RecurringExpense, UserGoogleSheetsCredentials, GsheetRow,
+                     GsheetBlock)
+from .users import forget_user_id
+from .categories import bump_category_version
+from .classifier import forget_classifier
+from .recent import invalidate_recent_expenses
+from .gsheet import invalidate_sheets_client
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Rows deleted per transaction, small enough to hold row locks for a few milliseconds only
+ACCOUNT_DELETE_BATCH_SIZE = int(os.getenv('ACCOUNT_DELETE_BATCH_SIZE', 500))
+# Seconds between two batches, leaving room to the other users' writes and to the replicas
+ACCOUNT_DELETE_PAUSE = float(os.getenv('ACCOUNT_DELETE_PAUSE', 0.05))
+
+# Tables holding a user's data, as (name, model, owner column, key column). The rules and the
+# sheet link go first, so the recurring job and the sheet sync stop writing for the user.
+ACCOUNT_TABLES = [
+    ('recurring_expenses', RecurringExpense, RecurringExpense.user_id, RecurringExpense.id),
+    ('gsheet', UserGoogleSheetsCredentials, UserGoogleSheetsCredentials.user_id, UserGoogleSheetsCredentials.user_id),
+    ('gsheet_blocks', GsheetBlock, GsheetBlock.user_id, GsheetBlock.block),
+    ('gsheet_rows', GsheetRow, GsheetRow.user_id, GsheetRow.expense_id),
+    ('expenses', Expense, Expense.user_id, Expense.id),
+    ('categories', Category, Category.user_id, Category.id),
+]
+
+
+def _delete_in_batches(name, model, owner, key, user_id, batch_size, progress):
+    deleted = 0
+    while True:
+        # One short transaction per batch: the keys are found through the user's index and
+        # deleted by key, so only the rows of this batch are locked, never a range
+        with Session() as session:
+            keys = session.scalars(select(key).where(owner == user_id).limit(batch_size)).all()
+            if not keys:
+                return deleted
+            session.execute(delete(model).where(owner == user_id, key.in_(keys)))
+            session.commit()
+
+        deleted += len(keys)
+        if progress:
+            progress(name, deleted)
+        if len(keys) < batch_size:
+            return deleted
+        time.sleep(ACCOUNT_DELETE_PAUSE)
+
+
+def _has_account_data(user_id):
+    with Session() as session:
+        return any(session.scalar(select(key).where(owner == user_id).limit(1)) is not None
+                   for _, _, owner, key in ACCOUNT_TABLES)
+
+
+def delete_account(user_id, progress=None, batch_size=ACCOUNT_DELETE_BATCH_SIZE):
+    """
+    Deletes a user with all their data, in batches of short transactions.
+
+    Every table is emptied `batch_size` rows at a time, each batch committed on its own, so
+    wiping a heavy user never holds locks long enough to stall other users' writes. The rows
+    written meanwhile are deleted together with the user row, in one transaction, and the
+    data tables are swept once more afterwards, to catch the rows written by updates that
+    were already running. An interrupted deletion is resumed by running it again, also once
+    the user row is gone.
+
+    Runs its own sessions, not the unit of work of the calling update.
+
+    Args:
+        user_id (int): The ID of the user.
+        progress (callable, optional): Called as progress(table, deleted) after every batch.
+        batch_size (int): The number of rows deleted per transaction.
+
+    Returns:
+        dict: Table name -> number of rows deleted, or None if neither the user nor any of their data exists.
+
+    Raises:
+        SQLAlchemyError: If there is a database related error. The batches committed so far stay deleted.
+    """
+    with Session() as session:
+        telegram_id = session.scalar(select(User.telegram_id).where(User.id == user_id))
+    if telegram_id is None and not _has_account_data(user_id):
+        logging.warning(f'User with ID {user_id} not found for account deletion.')
+        return None
+
+    started = time.monotonic()
+    deleted = {}
+    try:
+        for name, model, owner, key in ACCOUNT_TABLES:
+            deleted[name] = _delete_in_batches(name, model, owner, key, user_id, batch_size, progress)
+
+        # Until this commit the user row is kept, so a failed deletion can be run again from the bot
+        with Session() as session:
+            for name, model, owner, key in ACCOUNT_TABLES:
+                deleted[name] += session.execute(delete(model).where(owner == user_id)).rowcount
+            deleted['users'] = session.execute(delete(User).where(User.id == user_id)).rowcount
+            session.commit()
+        if telegram_id is not None:
+            forget_user_id(telegram_id)
+
+        for name, model, owner, key in ACCOUNT_TABLES:
+            deleted[name] += _delete_in_batches(name, model, owner, key, user_id, batch_size, progress)
+    except Exception as e:
+        logging.error(f'Account deletion of user {user_id} stopped after {deleted}: {e}')
+        raise
+    finally:
+        # Whatever was deleted must not be served from memory anymore
+        invalidate_sheets_client(user_id)
+        invalidate_recent_expenses(user_id)
+        forget_classifier(user_id)
+        bump_category_version(user_id)
+
+    logging.info(f'Account of user {user_id} deleted in {time.monotonic() - started:.2f}s: {deleted}.')
+    return deleted
@@ -0,0 +1,142 @@
+# Standard library imports
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+# Load environment variables
+from dotenv import load_dotenv
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class AdmissionController:
+    """
+    Admission control and circuit breaker for a slow external dependency.
+
+    Calls are admitted while the number of in-flight calls is below `max_in_flight`
+    and the circuit is closed. The circuit opens when the error rate over the last
+    `window_seconds` goes above `error_rate_threshold` (once at least `min_calls`
+    were observed), stays open for `open_seconds`, then lets a single probe through
+    (half open) to decide whether to close again. Calls slower than
+    `slow_call_seconds` count as failures.
+    """
+
+    def __init__(self, name, max_in_flight=4, error_rate_threshold=0.5, window_seconds=60,
+                 min_calls=4, open_seconds=30, slow_call_seconds=20):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.error_rate_threshold = error_rate_threshold
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+
+        self._lock = threading.Lock()
+        self._calls = deque()  # (finished_at, success)
+        self._in_flight = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+            logging.info(f'{self.name}: circuit half open, allowing a probe call.')
+        return self._state
+
+    def _trim(self, now):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _open(self, now, reason):
+        self._state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+        logging.warning(f'{self.name}: circuit opened ({reason}).')
+
+    def try_acquire(self):
+        """
+        Asks for permission to start a call.
+
+        Returns:
+            bool: True if the call is admitted and `release` must be called afterwards,
+                  False if the caller should degrade immediately.
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+
+            if state == OPEN:
+                return False
+            if state == HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            elif self._in_flight >= self.max_in_flight:
+                logging.warning(f'{self.name}: rejecting call, {self._in_flight} calls already in flight.')
+                return False
+
+            self._in_flight += 1
+            return True
+
+    def release(self, success, duration):
+        """
+        Records the outcome of an admitted call.
+
+        Args:
+            success (bool): Whether the call produced a usable result.
+            duration (float): How long the call took, in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._in_flight = max(self._in_flight - 1, 0)
+            ok = success and duration <= self.slow_call_seconds
+
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    logging.info(f'{self.name}: probe succeeded, circuit closed.')
+                else:
+                    self._open(now, 'probe failed')
+                return
+
+            self._calls.append((now, ok))
+            self._trim(now)
+
+            if self._state == CLOSED and len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, call_ok in self._calls if not call_ok)
+                error_rate = failures / len(self._calls)
+                if error_rate > self.error_rate_threshold:
+                    self._open(now, f'error rate {error_rate:.0%} over {len(self._calls)} calls')
+
+
+# Admission controller guarding the voice message path (Whisper + GPT)
+llm_admission = AdmissionController(
+    'llm',
+    max_in_flight=int(os.getenv('LLM_MAX_IN_FLIGHT', 4)),
+    error_rate_threshold=float(os.getenv('LLM_ERROR_RATE_THRESHOLD', 0.5)),
+    window_seconds=float(os.getenv('LLM_ERROR_WINDOW_SECONDS', 60)),
+    min_calls=int(os.getenv('LLM_MIN_CALLS', 4)),
+    open_seconds=float(os.getenv('LLM_CIRCUIT_OPEN_SECONDS', 30)),
+    slow_call_seconds=float(os.getenv('LLM_SLOW_CALL_SECONDS', 20)),
+)
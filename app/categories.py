@@ -1,71 +1,158 @@
 # Standard library imports
 import logging
+from datetime import datetime
 
 # Third-party imports
-from sqlalchemy import func
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import func, insert, select, update, delete, literal, String
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
 # Local application imports
-from .db_utils import Session, add_to_session_and_close
+from .db_utils import get_session, get_read_session, savepoint, commit, on_commit, record_write
 from .models import Category
+from .records import CategoryRecord
 
 # Configure logging
 logging.basicConfig(filename='./logs/mylogs.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
+# Maximum number of active categories per user
+MAX_ACTIVE_CATEGORIES = 20
+
+# In-process version of each user's categories, bumped whenever they change so that
+# anything derived from them (e.g. rendered keyboards) can be cached safely
+_category_versions = {}
+
+
+def get_category_version(user_id):
+    """
+    Returns the current version of a user's categories.
+
+    Args:
+        user_id (int): The user's ID.
+
+    Returns:
+        int: A number that changes every time the user's categories change.
+    """
+    return _category_versions.get(user_id, 0)
+
+
+def bump_category_version(user_id):
+    """
+    Marks a user's categories as changed, invalidating anything cached on them.
+
+    Args:
+        user_id (int): The user's ID.
+    """
+    _category_versions[user_id] = _category_versions.get(user_id, 0) + 1
+
+
+def _bump_on_commit(session, user_id):
+    # Bumped once the change is committed, so nothing is cached under the new version before.
+    # Until then the change is only visible to this unit of work, which does not cache what it reads
+    session.info.setdefault('changed_categories', set()).add(user_id)
+
+    def bump():
+        session.info.get('changed_categories', set()).discard(user_id)
+        bump_category_version(user_id)
+    on_commit(session, bump)
+
+
+def has_uncommitted_category_changes(user_id):
+    """
+    Tells whether the running unit of work changed a user's categories without committing them yet.
+
+    Anything built from the categories meanwhile must not be cached: it would stay valid
+    under the current version if the unit of work is rolled back.
+
+    Args:
+        user_id (int): The user's ID.
+
+    Returns:
+        bool: True if the categories read now include uncommitted changes.
+    """
+    with get_session() as session:
+        return user_id in session.info.get('changed_categories', ())
+
+
+def normalize_category_name(name):
+    """
+    Normalizes a category name for uniqueness checks: case-insensitive, with collapsed whitespace.
+
+    Args:
+        name (str): The name of the category.
+
+    Returns:
+        str: The normalized name.
+    """
+    return ' '.join(name.split()).casefold()
+
 
 def add_category(user_id, name, description=None):
     """
     Adds a new category for a user. If the category already exists or the user has reached
     the maximum number of categories, the function raises an exception.
 
+    The insert is a single conditional statement: the row is only selected for insertion
+    while the user has fewer than MAX_ACTIVE_CATEGORIES active categories, and duplicates are
+    rejected by the unique constraint on (user_id, name_normalized). Concurrent requests
+    therefore cannot create duplicates or exceed the cap.
+
     Args:
         user_id (int): The user's ID.
         name (str): The name of the category.
         description (str, optional): Optional description of the category.
 
     Returns:
-        Category: The new Category object if added successfully.
+        bool: True if the category was added successfully.
 
     Raises:
         ValueError: If the maximum number of categories is reached or the category already exists.
         SQLAlchemyError: If there is a database related error.
         Exception: For any other unexpected errors.
     """
-    try: 
-        with Session() as session:
-            if count_active_categories(user_id) >= 20:
-                logging.error(f'User {user_id} has reached the maximum number of categories (20).')
-                raise ValueError('Maximum number of categories reached')
+    now = datetime.utcnow()
+    active_categories = select(func.count(Category.id))\
+                            .where(Category.user_id == user_id, Category.active == True)\
+                            .scalar_subquery()
+    new_category = select(literal(user_id), literal(name), literal(normalize_category_name(name)),
+                          literal(description, String), literal(True), literal(now), literal(now))\
+                        .where(active_categories < MAX_ACTIVE_CATEGORIES)
+    statement = insert(Category).from_select(
+        ['user_id', 'name', 'name_normalized', 'description', 'active', 'created_at', 'updated_at'],
+        new_category
+    )
 
-            existing_category = session.query(Category)\
-                                    .filter(Category.user_id == user_id, 
-                                            func.lower(Category.name) == func.lower(name))\
-                                    .first()
-
-            if existing_category:
+    try:
+        with get_session() as session:
+            try:
+                with savepoint(session):
+                    result = session.execute(statement)
+                    commit(session)
+                record_write(session, user_id)
+            except IntegrityError:
                 logging.error(f'Category named {name} already exists for user {user_id}')
                 raise ValueError('This category already exists')
 
-            new_category = Category(user_id=user_id, name=name, description=description)
-            add_to_session_and_close(session, new_category)
+            if result.rowcount == 0:
+                logging.error(f'User {user_id} has reached the maximum number of categories ({MAX_ACTIVE_CATEGORIES}).')
+                raise ValueError('Maximum number of categories reached')
+
+            _bump_on_commit(session, user_id)
             logging.info(f'Category added by user:{user_id} {name}')
             return True
-    
+
     except SQLAlchemyError as e:
-        session.rollback()
         logging.error(f'DB error creating category for user:{user_id}: {e}')
         raise
 
+    except ValueError:
+        raise
+
     except Exception as e:
-        session.rollback()
         logging.error(f'Unexpected error adding category for user:{user_id}: {e}')
         raise
 
-    finally:
-        session.close()
-
 
 def delete_category(user_id, name):
     """
@@ -83,14 +170,16 @@ def delete_category(user_id, name):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            category = session.query(Category)\
-                            .filter(Category.user_id == user_id, func.lower(Category.name) == func.lower(name))\
-                            .first()
-
-            if category:
-                session.delete(category)
-                session.commit()
+        with get_session() as session:
+            result = session.execute(
+                delete(Category).where(Category.user_id == user_id,
+                                       Category.name_normalized == normalize_category_name(name))
+            )
+
+            if result.rowcount:
+                commit(session)
+                record_write(session, user_id)
+                _bump_on_commit(session, user_id)
                 logging.info(f'Category {name} deleted for user {user_id}.')
                 return 'Category deleted successfully'
             else:
@@ -103,8 +192,6 @@ def delete_category(user_id, name):
     except Exception as e:
         logging.error(f'Unexpected error deleting category for user {user_id}: {e}')
         raise
-    finally:
-        session.close()
 
 
 def change_category_status(user_id, category_id, activate):
@@ -124,15 +211,16 @@ def change_category_status(user_id, category_id, activate):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            category = session.query(Category)\
-                            .filter(Category.user_id == user_id, 
-                                    Category.id == category_id)\
-                            .first()
+        with get_session() as session:
+            result = session.execute(
+                update(Category).where(Category.user_id == user_id, Category.id == category_id)
+                                .values(active=activate)
+            )
 
-            if category:
-                category.active = activate
-                session.commit()
+            if result.rowcount:
+                commit(session)
+                record_write(session, user_id)
+                _bump_on_commit(session, user_id)
 
                 action = "reactivated" if activate else "deactivated"
                 logging.info(f'Category {category_id} {action} for user {user_id}.')
@@ -164,10 +252,10 @@ def count_active_categories(user_id):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            active_category_count = session.query(Category)\
-                                           .filter(Category.user_id == user_id, Category.active == True)\
-                                           .count()
+        with get_read_session(user_id) as session:
+            active_category_count = session.scalar(
+                select(func.count(Category.id)).where(Category.user_id == user_id, Category.active == True)
+            )
 
             logging.info(f'User {user_id} has {active_category_count} active categories.')
             return active_category_count
@@ -199,16 +287,15 @@ def get_categories(user_id, type=0):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            query = session.query(Category.name).filter(Category.user_id == user_id)
+        with get_read_session(user_id) as session:
+            query = select(Category.name).where(Category.user_id == user_id)
             
             if type == 1:
-                query = query.filter(Category.active == True)
+                query = query.where(Category.active == True)
             elif type == 2:
-                query = query.filter(Category.active == False)
+                query = query.where(Category.active == False)
 
-            categories_tuples = query.all()
-            categories = [category[0] for category in categories_tuples]
+            categories = session.scalars(query).all()
 
             logging.info(f'Categories retrieved for user {user_id}.')
             return categories
@@ -233,23 +320,22 @@ def get_categories_and_id(user_id, type=0):
                     2 for only inactive.
 
     Returns:
-        list: A list of tuples, each containing the category name and ID, based on the specified type.
+        list: A list of CategoryRecord (name, id) tuples, based on the specified type.
 
     Raises:
         SQLAlchemyError: If there is a database related error.
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            query = session.query(Category.name, Category.id).filter(Category.user_id == user_id)
+        with get_read_session(user_id) as session:
+            query = select(Category.name, Category.id).where(Category.user_id == user_id)
             
             if type == 1: 
-                query = query.filter(Category.active == True)
+                query = query.where(Category.active == True)
             elif type == 2:
-                query = query.filter(Category.active == False)
+                query = query.where(Category.active == False)
 
-            categories_tuples = query.all()
-            categories = [[category.name, category.id] for category in categories_tuples]
+            categories = [CategoryRecord._make(row) for row in session.execute(query)]
 
             logging.info(f'Categories retrieved for user {user_id}.')
             return categories
@@ -318,14 +404,13 @@ def get_category_name(user_id, category_id):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            category = session.query(Category)\
-                              .filter(Category.user_id == user_id, 
-                                      Category.id == category_id)\
-                              .first()
-
-            if category is not None:
-                return category.name
+        with get_read_session(user_id) as session:
+            name = session.scalar(
+                select(Category.name).where(Category.user_id == user_id, Category.id == category_id)
+            )
+
+            if name is not None:
+                return name
             else:
                 return "Category not found"
 
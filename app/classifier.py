@@ -0,0 +1,168 @@
+# Standard library imports
+import os
+import re
+import math
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+# Third-party imports
+from sqlalchemy import select
+
+# Local application imports
+from .db_utils import get_read_session
+from .models import Expense
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Past expenses used to train a user's model, most recent first
+CLASSIFIER_HISTORY = int(os.getenv('CLASSIFIER_HISTORY', 2000))
+# Number of users whose models are kept in memory
+CLASSIFIER_CACHE_USERS = int(os.getenv('CLASSIFIER_CACHE_USERS', 1000))
+
+TOKEN_PATTERN = re.compile(r'[^\W\d_]{2,}')
+
+
+def tokenize(text):
+    """Splits a text into lowercase words, numbers and single letters are left out."""
+    return TOKEN_PATTERN.findall(text.casefold()) if text else []
+
+
+class CategoryClassifier:
+    """
+    Naive Bayes model mapping expense descriptions to a user's categories.
+
+    The model is only a table of word counts per category, so it is updated in place for
+    every new or deleted expense and a prediction costs a few dictionary lookups per word.
+    """
+
+    def __init__(self):
+        self.word_counts = {}
+        self.word_totals = Counter()
+        self.expense_counts = Counter()
+        self.vocabulary = Counter()
+
+    def learn(self, description, category_id, weight=1):
+        if category_id is None:
+            return
+        # IDs come as strings from callback data and as integers from the database
+        category_id = int(category_id)
+        tokens = tokenize(description)
+        counts = self.word_counts.setdefault(category_id, Counter())
+        for token in tokens:
+            counts[token] += weight
+            self.vocabulary[token] += weight
+            # Deleted expenses older than the training history may take counts below zero
+            if counts[token] <= 0:
+                del counts[token]
+            if self.vocabulary[token] <= 0:
+                del self.vocabulary[token]
+        self.word_totals[category_id] += weight * len(tokens)
+        self.expense_counts[category_id] += weight
+        if self.expense_counts[category_id] <= 0:
+            del self.word_counts[category_id], self.word_totals[category_id], self.expense_counts[category_id]
+
+    def known(self, token):
+        return token in self.vocabulary
+
+    def rank(self, text, category_ids):
+        """
+        Ranks candidate categories for a text.
+
+        Args:
+            text (str): The text to classify.
+            category_ids (list): The IDs of the categories that can be predicted.
+
+        Returns:
+            list: (category_id, probability) tuples sorted by decreasing probability, empty
+                  when none of the words of the text has been seen before.
+        """
+        tokens = [token for token in tokenize(text) if token in self.vocabulary]
+        if not tokens or not category_ids:
+            return []
+
+        vocabulary_size = len(self.vocabulary)
+        total_expenses = sum(self.expense_counts[category_id] for category_id in category_ids)
+        scores = {}
+        for category_id in category_ids:
+            counts = self.word_counts.get(category_id, {})
+            # Laplace smoothing on both the prior and the word likelihoods
+            score = math.log((self.expense_counts[category_id] + 1) / (total_expenses + len(category_ids)))
+            denominator = max(self.word_totals[category_id], 0) + vocabulary_size
+            for token in tokens:
+                score += math.log((counts.get(token, 0) + 1) / denominator)
+            scores[category_id] = score
+
+        best = max(scores.values())
+        weights = {category_id: math.exp(score - best) for category_id, score in scores.items()}
+        total = sum(weights.values())
+        return sorted(((category_id, weight / total) for category_id, weight in weights.items()),
+                      key=lambda item: item[1], reverse=True)
+
+
+_classifiers = OrderedDict()
+_classifiers_lock = threading.Lock()
+
+
+def _load_classifier(user_id):
+    classifier = CategoryClassifier()
+    with get_read_session(user_id) as session:
+        rows = session.execute(
+            select(Expense.description, Expense.category_id)
+            .where(Expense.user_id == user_id)
+            .order_by(Expense.created_at.desc(), Expense.id.desc())
+            .limit(CLASSIFIER_HISTORY)
+        ).all()
+    for description, category_id in rows:
+        classifier.learn(description, category_id)
+    logging.info(f'Category classifier of user {user_id} trained on {len(rows)} expenses.')
+    return classifier
+
+
+def get_classifier(user_id):
+    """
+    Returns the category classifier of a user, training it from past expenses on first use.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        CategoryClassifier: The user's model.
+    """
+    with _classifiers_lock:
+        if user_id in _classifiers:
+            _classifiers.move_to_end(user_id)
+            return _classifiers[user_id]
+
+    classifier = _load_classifier(user_id)
+    with _classifiers_lock:
+        # Another thread may have loaded it meanwhile, keep the one already receiving updates
+        classifier = _classifiers.setdefault(user_id, classifier)
+        while len(_classifiers) > CLASSIFIER_CACHE_USERS:
+            _classifiers.popitem(last=False)
+    return classifier
+
+
+def learn_expense(user_id, description, category_id):
+    """Adds an expense to the user's model, if it is loaded. Unloaded models read it from the database."""
+    with _classifiers_lock:
+        classifier = _classifiers.get(user_id)
+        if classifier is not None:
+            classifier.learn(description, category_id)
+
+
+def unlearn_expense(user_id, description, category_id):
+    """Removes a deleted expense from the user's model, if it is loaded."""
+    with _classifiers_lock:
+        classifier = _classifiers.get(user_id)
+        if classifier is not None:
+            classifier.learn(description, category_id, weight=-1)
+
+
+def forget_classifier(user_id):
+    """Drops a user's model, e.g. after their expenses were deleted."""
+    with _classifiers_lock:
+        _classifiers.pop(user_id, None)
@@ -1,10 +1,14 @@
 # Standard library imports
 import os
+import time
 import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 # Third-party imports
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import SQLAlchemyError
 
 # Load environment variables
@@ -43,13 +47,273 @@ def get_db_uri():
     return f'{database_type}+{db_driver}://{username}:{password}@{database_host}:{database_port}/{database_name}'
 
 
+def _use_sqlalchemy_transactions(engine):
+    # pysqlite opens transactions on its own and not before a SAVEPOINT, so releasing a
+    # savepoint would commit the whole unit of work: SQLAlchemy emits BEGIN itself instead.
+    # Reads then hold a transaction too, WAL keeps them from blocking the other writers
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
 
-# Creating the engine
-db_uri = get_db_uri()
-engine = create_engine(db_uri, connect_args=ssl_args)
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def create_db_engine(uri):
+    # TLS is only set up for MySQL, e.g. not for local SQLite files
+    use_ssl = uri.startswith('mysql') and os.getenv('DATABASE_SSL', 'true').lower() == 'true'
+    engine = create_engine(uri, connect_args=ssl_args if use_ssl else {})
+    if engine.dialect.name == 'sqlite':
+        _use_sqlalchemy_transactions(engine)
+    return engine
+
+
+# Creating the engine, DATABASE_URI overrides the URI built from the settings (e.g. sqlite:///primary.db)
+db_uri = os.getenv('DATABASE_URI') or get_db_uri()
+engine = create_db_engine(db_uri)
 # Create the Session
 Session = sessionmaker(bind=engine)
 
+# Optional read replicas, comma separated URIs. Without them every read goes to the primary
+replica_engines = [create_db_engine(uri.strip()) for uri in os.getenv('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+_replica_sessions = itertools.cycle([sessionmaker(bind=replica) for replica in replica_engines])
+
+# Reads of a user who wrote within this many seconds go to the primary, replicas may lag behind
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+# User ID -> time of the user's last write
+_last_writes = {}
+
+# Session of the unit of work running in the current context, see begin_unit_of_work
+_current_session = ContextVar('current_session', default=None)
+
+
+def begin_unit_of_work():
+    """
+    Starts a unit of work, e.g. for one Telegram update: until end_unit_of_work, the helpers
+    called from the current context (worker threads started with asyncio.to_thread included)
+    share one session and one transaction instead of opening their own.
+
+    Background tasks started from that context must not share it, see outside_unit_of_work.
+
+    Returns:
+        tuple: (session, token), the token is passed to end_unit_of_work.
+    """
+    session = Session()
+    return session, _current_session.set(session)
+
+
+def end_unit_of_work(token):
+    """Detaches the session of a unit of work from the current context, before commit_unit_of_work."""
+    _current_session.get().info['ended'] = True
+    _current_session.reset(token)
+
+
+def _unit_of_work_session():
+    session = _current_session.get()
+    # A context copied before the unit of work ended, e.g. by a task, no longer owns its session
+    if session is None or session.info.get('ended'):
+        return None
+    return session
+
+
+async def outside_unit_of_work(awaitable):
+    """
+    Awaits `awaitable` in a task of its own, detached from the unit of work it was started from.
+
+    Tasks copy the context they are created in, so a background task started by a handler
+    would otherwise share the update's session, which is committed and closed when the
+    update is done. Detached, its helpers open and commit their own sessions.
+
+    Usage: application.create_task(outside_unit_of_work(coroutine))
+    """
+    _current_session.set(None)
+    return await awaitable
+
+
+def _commit_and_run_callbacks(session):
+    try:
+        if session.in_transaction():
+            session.commit()
+    except SQLAlchemyError as e:
+        session.rollback()
+        logging.error(f'Error committing unit of work: {e}')
+        raise
+    # Every callback runs, a failing one must not leave the caches of the others stale
+    for callback in session.info.pop('on_commit', []):
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f'Error in on_commit callback {callback}: {e}')
+
+
+def commit_unit_of_work(session):
+    """
+    Commits a unit of work, runs its on_commit callbacks and closes its session.
+
+    The commit is skipped when nothing touched the database. It is a blocking call, async
+    code runs it in a worker thread.
+
+    Raises:
+        SQLAlchemyError: If the commit fails, the unit of work is rolled back.
+    """
+    try:
+        _commit_and_run_callbacks(session)
+    finally:
+        session.close()
+
+
+def fail_unit_of_work():
+    """
+    Marks the current unit of work as failed, so its changes are rolled back instead of committed.
+
+    Called from the error handler: the Application catches handler exceptions itself, so
+    the update processor never sees them. Outside a unit of work this does nothing.
+    """
+    session = _unit_of_work_session()
+    if session is not None:
+        session.info['failed'] = True
+
+
+def unit_of_work_failed(session):
+    """Returns True if the unit of work of `session` was marked with fail_unit_of_work."""
+    return session.info.get('failed', False)
+
+
+def rollback_unit_of_work(session):
+    """
+    Rolls back a failed unit of work, drops its on_commit callbacks and closes its session.
+
+    Changes already committed with save_unit_of_work stay. It is a blocking call, async code
+    runs it in a worker thread.
+    """
+    try:
+        session.info.pop('on_commit', None)
+        session.rollback()
+    finally:
+        session.close()
+
+
+def save_unit_of_work():
+    """
+    Commits the changes of the current unit of work so far, before the user is told they are saved.
+
+    The session stays open for the rest of the update. Outside a unit of work the helpers
+    have committed already and this does nothing. It is a blocking call, async code runs it
+    in a worker thread.
+
+    Raises:
+        SQLAlchemyError: If the commit fails, the changes of the update are rolled back.
+    """
+    session = _unit_of_work_session()
+    if session is not None:
+        _commit_and_run_callbacks(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_on_commit_callbacks(session, previous_transaction):
+    # The changes the callbacks were waiting for are gone, savepoints drop their own in savepoint()
+    if previous_transaction.parent is None:
+        session.info.pop('on_commit', None)
+
+
+@contextmanager
+def get_session():
+    """
+    Yields the session of the current unit of work, or a new session closed on exit.
+
+    Helpers end their changes with commit(session), which leaves the commit of a unit of
+    work to end_unit_of_work.
+    """
+    session = _unit_of_work_session()
+    if session is not None:
+        yield session
+        return
+    with Session() as session:
+        yield session
+
+
+@contextmanager
+def savepoint(session):
+    """
+    Undoes the changes made in the block if it raises, and only those.
+
+    Inside a unit of work the block runs in a SAVEPOINT, so a helper failing on e.g. a
+    unique constraint does not throw away the changes made earlier in the same update.
+    Outside, a failure rolls back the session's own transaction.
+    """
+    if session is _unit_of_work_session():
+        pending = list(session.info.get('on_commit', []))
+        try:
+            with session.begin_nested():
+                yield
+        except Exception:
+            session.info['on_commit'] = pending
+            raise
+        return
+    try:
+        yield
+    except Exception:
+        session.rollback()
+        raise
+
+
+@contextmanager
+def get_read_session(user_id=None):
+    """
+    Yields a session for read-only queries: a replica session closed on exit, or the
+    session get_session would give when there are no replicas or when the user wrote
+    within READ_YOUR_WRITES_WINDOW seconds (see record_write).
+
+    Args:
+        user_id (int, optional): The user whose data is read.
+    """
+    if not replica_engines or (user_id is not None and
+                               time.monotonic() - _last_writes.get(user_id, float('-inf')) < READ_YOUR_WRITES_WINDOW):
+        with get_session() as session:
+            yield session
+        return
+    with next(_replica_sessions)() as session:
+        yield session
+
+
+def record_write(session, user_id):
+    """
+    Records that a user's data changed, so their reads stay on the primary for READ_YOUR_WRITES_WINDOW.
+
+    The window starts now, so uncommitted changes of a unit of work are read back from its
+    session, and again once the changes are committed.
+    """
+    def mark():
+        _last_writes[user_id] = time.monotonic()
+        if len(_last_writes) > 10000:
+            cutoff = time.monotonic() - READ_YOUR_WRITES_WINDOW
+            for stale in [key for key, written in list(_last_writes.items()) if written < cutoff]:
+                del _last_writes[stale]
+    mark()
+    on_commit(session, mark)
+
+
+def commit(session):
+    """Commits a helper's changes, or only flushes them inside a unit of work."""
+    if session is _unit_of_work_session():
+        session.flush()
+    else:
+        session.commit()
+
+
+def on_commit(session, callback):
+    """
+    Runs a callback once the changes made in a session are committed, e.g. to update an in-memory cache.
+
+    Outside a unit of work the changes are already committed and the callback runs immediately.
+    """
+    if session is _unit_of_work_session():
+        session.info.setdefault('on_commit', []).append(callback)
+    else:
+        callback()
+
 
 def add_to_session_and_close(session, obj):
     """
@@ -1,44 +1,214 @@
 # Standard library imports
+import re
 import logging
+import calendar
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+# Third-party imports
+from sqlalchemy import select, insert, delete, and_, or_, func
 
 # Import local modules
-from .db_utils import Session, add_to_session_and_close
+from .db_utils import get_session, get_read_session, savepoint, commit, on_commit, record_write
 from .models import Expense, Category
+from .classifier import learn_expense, unlearn_expense
+from .records import ExpenseRecord, ExpenseSummary
+from .recent import RecentExpense, RECENT_EXPENSES_SIZE, as_datetime, get_recent_expenses, remember_expenses, forget_expense
 
 # Configure logging
 logging.basicConfig(filename='./logs/mylogs.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
-def add_expense(amount, category_id, user_id, description, date):
+DEFAULT_CURRENCY = 'EUR'
+CURRENCY_SYMBOLS = {'EUR': '€', 'USD': '$', 'GBP': '£'}
+
+
+def parse_amount(amount):
+    """
+    Parses an amount into integer minor units (cents), without going through floats.
+
+    Both '.' and ',' are accepted as decimal separators. When both appear, the last one is
+    the decimal separator; a single separator followed by exactly three digits after a
+    non-zero integer part, or a repeated separator, is a thousands separator ('1.000' and
+    '1,000,000', but '0.500' is 0.50).
+
+    Args:
+        amount (str, int, Decimal or float): The amount, possibly with a currency symbol.
+
+    Returns:
+        int: The amount in cents.
+
+    Raises:
+        ValueError: If the amount cannot be parsed or is negative.
+    """
+    if isinstance(amount, bool) or amount is None:
+        raise ValueError(f'Invalid amount: {amount!r}')
+    if isinstance(amount, int):
+        value = Decimal(amount)
+    elif isinstance(amount, Decimal):
+        value = amount
+    elif isinstance(amount, float):
+        # repr of a float is its shortest exact decimal form, e.g. 12.3 -> '12.3'
+        value = Decimal(repr(amount))
+    else:
+        text = re.sub(r'[^\d.,]', '', str(amount))
+        separators = [char for char in text if char in '.,']
+
+        if not separators:
+            number = text
+        elif len(set(separators)) == 1 and (len(separators) > 1 or
+                                            (len(text.rpartition(separators[0])[2]) == 3 and
+                                             text.partition(separators[0])[0].strip('0'))):
+            # Only thousands separators: '1.000', '1,000,000'. A leading group of zeros is
+            # never a thousands group, '0.500' is half a unit
+            if not re.fullmatch(rf'[1-9]\d{{0,2}}(\{separators[0]}\d{{3}})+', text):
+                raise ValueError(f'Invalid amount: {amount!r}')
+            number = text.replace(separators[0], '')
+        else:
+            # The last separator is the decimal one, the other (if any) groups thousands
+            decimal_separator = separators[-1]
+            integer_part, _, fraction = text.rpartition(decimal_separator)
+            thousands = ',' if decimal_separator == '.' else '.'
+            if not re.fullmatch(rf'\d+|[1-9]\d{{0,2}}(\{thousands}\d{{3}})+', integer_part) or not fraction.isdigit():
+                raise ValueError(f'Invalid amount: {amount!r}')
+            number = integer_part.replace(thousands, '') + '.' + fraction
+
+        if not number.isdigit() and not re.fullmatch(r'\d+\.\d+', number):
+            raise ValueError(f'Invalid amount: {amount!r}')
+        if str(amount).strip().startswith('-'):
+            raise ValueError(f'Invalid amount: {amount!r}')
+        value = Decimal(number)
+
+    if not value.is_finite() or value < 0:
+        raise ValueError(f'Invalid amount: {amount!r}')
+    return int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_amount(amount_cents, currency=DEFAULT_CURRENCY):
+    """
+    Formats an amount in cents for display, e.g. 1250 -> '12.50€' and -150 -> '-1.50€'.
+
+    Args:
+        amount_cents (int): The amount in cents.
+        currency (str): The ISO currency code.
+
+    Returns:
+        str: The formatted amount.
+    """
+    # divmod rounds towards minus infinity, the digits come from the absolute value
+    sign = '-' if amount_cents < 0 else ''
+    units, cents = divmod(abs(amount_cents), 100)
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    return f"{sign}{units}.{cents:02d}{symbol}" if symbol else f"{sign}{units}.{cents:02d} {currency}"
+
+
+def add_expense(amount, category_id, user_id, description, date, currency=DEFAULT_CURRENCY):
     """
     Adds a new expense to the database.
 
     Args:
-        amount (str): The amount of the expense, can include commas as decimal separators.
+        amount (str): The amount of the expense, '.' or ',' can be used as decimal separators.
         category_id (int): The ID of the category for this expense.
         user_id (int): The ID of the user who is adding the expense.
         description (str): A brief description of the expense.
         date (str): The date of the expense.
+        currency (str, optional): The ISO currency code of the amount.
 
     Returns:
-        Expense: The newly created expense object or None in case of an error.
+        int: The ID of the new expense, or None in case of an error.
     """
     try:
-        with Session() as session:
-            # Normalize amount by replacing commas with dots and converting to float
-            normalized_amount = float(str(amount).replace(',', '.'))
-            new_expense = Expense(amount=normalized_amount, category_id=category_id, 
-                                user_id=user_id, description=description, date=date)
-            add_to_session_and_close(session, new_expense)
-            logging.info(f'Expense added for user {user_id}: {normalized_amount}')
-            return True
+        with get_session() as session, savepoint(session):
+            amount_cents = parse_amount(amount)
+            # Whole seconds, as stored by the DATETIME column, so the recent expenses buffer matches the row
+            created_at = datetime.utcnow().replace(microsecond=0)
+            new_expense = Expense(amount_cents=amount_cents, currency=currency, category_id=category_id, 
+                                user_id=user_id, description=description, date=date,
+                                created_at=created_at, updated_at=created_at)
+            session.add(new_expense)
+            session.flush()
+            expense_id = new_expense.id
+            commit(session)
+            record_write(session, user_id)
+            on_commit(session, lambda: learn_expense(user_id, description, category_id))
+            on_commit(session, lambda: remember_expenses(user_id, [
+                RecentExpense(expense_id, amount_cents, currency, int(category_id), description,
+                              as_datetime(date), created_at)
+            ]))
+            logging.info(f'Expense added for user {user_id}: {format_amount(amount_cents, currency)}')
+            return expense_id
     except Exception as e:
-        session.rollback()
         logging.error(f'Error adding expense for user {user_id}: {e}')
         return None
 
 
+def add_expenses(user_id, expenses):
+    """
+    Adds several expenses for a user in one transaction.
+
+    The expenses are written with one multi-row INSERT, whose RETURNING clause or, on MySQL,
+    LAST_INSERT_ID() gives the new IDs.
+
+    Args:
+        user_id (int): The ID of the user who is adding the expenses.
+        expenses (list): A list of dicts with 'amount', 'category_id', 'description' and 'date' keys,
+                         and optionally 'currency'. Amounts are parsed with parse_amount.
+
+    Returns:
+        list: The IDs of the new expenses, in the same order as `expenses`, or None in case of an error.
+    """
+    if not expenses:
+        return []
+
+    try:
+        with get_session() as session, savepoint(session):
+            # Whole seconds, as stored by the DATETIME column, so the recent expenses buffer matches the rows
+            created_at = datetime.utcnow().replace(microsecond=0)
+            rows = [
+                {
+                    'amount_cents': parse_amount(expense['amount']),
+                    'currency': expense.get('currency') or DEFAULT_CURRENCY,
+                    'category_id': expense['category_id'],
+                    'user_id': user_id,
+                    'description': expense.get('description'),
+                    'date': expense.get('date') or created_at,
+                    'created_at': created_at,
+                    'updated_at': created_at,
+                }
+                for expense in expenses
+            ]
+
+            # The IDs come from the INSERT itself: reading them back by creation time would
+            # also pick up rows another writer added for the user in the same second
+            # One statement takes its IDs in the order of its rows
+            statement = insert(Expense).values(rows)
+            if session.get_bind().dialect.insert_returning:
+                expense_ids = sorted(session.scalars(statement.returning(Expense.id)))
+            else:
+                # MySQL: the IDs are consecutive, from LAST_INSERT_ID() on
+                result = session.execute(statement)
+                expense_ids = list(range(result.lastrowid, result.lastrowid + len(rows)))
+            commit(session)
+            record_write(session, user_id)
+
+            def learn_rows():
+                for row in rows:
+                    learn_expense(user_id, row['description'], row['category_id'])
+            on_commit(session, learn_rows)
+            on_commit(session, lambda: remember_expenses(user_id, [
+                RecentExpense(expense_id, row['amount_cents'], row['currency'], int(row['category_id']),
+                              row['description'], as_datetime(row['date']), created_at)
+                for expense_id, row in zip(expense_ids, rows)
+            ]))
+
+            logging.info(f'{len(rows)} expenses added for user {user_id}.')
+            return expense_ids
+
+    except Exception as e:
+        logging.error(f'Error adding {len(expenses)} expenses for user {user_id}: {e}')
+        return None
+
 
 def delete_expense(user_id, expense_id):
     """
@@ -52,12 +222,18 @@ def delete_expense(user_id, expense_id):
         bool: True if the expense was successfully deleted, False otherwise.
     """
     try:
-        with Session() as session:
-            expense = session.query(Expense).filter_by(user_id=user_id, id=expense_id).first()
+        with get_session() as session, savepoint(session):
+            expense = session.execute(
+                select(Expense.description, Expense.category_id).where(Expense.user_id == user_id, Expense.id == expense_id)
+            ).first()
 
             if expense:
-                session.delete(expense)
-                session.commit()
+                description, category_id = expense
+                session.execute(delete(Expense).where(Expense.id == expense_id))
+                commit(session)
+                record_write(session, user_id)
+                on_commit(session, lambda: unlearn_expense(user_id, description, category_id))
+                on_commit(session, lambda: forget_expense(user_id, expense_id))
                 logging.info(f"Expense {expense_id} successfully deleted for user {user_id}.")
                 return True
             else:
@@ -66,42 +242,37 @@ def delete_expense(user_id, expense_id):
                 return False
 
     except Exception as e:
-        session.rollback()
         logging.error(f"Error deleting expense {expense_id} for user {user_id}: {e}")
         return False
     
 
 def retrieve_last5_expenses(user_id):
     """
-    Retrieves the last five expenses for a given user.
+    Retrieves the last five expenses for a given user, from the recent expenses buffer.
 
     Args:
         user_id (int): The ID of the user whose expenses are to be retrieved.
 
     Returns:
-        list: A list of the last five expenses, each as a tuple (id, amount, category name),
+        list: The last five expenses as ExpenseSummary (id, amount_cents, currency, name) tuples,
               or None if an error occurs.
     """
     try:
-        with Session() as session:
-            expenses = session.query(Expense.id, Expense.amount, Category.name)\
-                            .join(Category, Expense.category_id == Category.id)\
-                            .filter(Expense.user_id == user_id)\
-                            .order_by(Expense.created_at.desc())\
-                            .limit(5)\
-                            .all()
-            logging.info(f"Last 5 expenses retrieved for user {user_id}.")
-            return expenses
+        expenses, _ = get_recent_expenses(user_id, 5)
+        logging.info(f"Last 5 expenses retrieved for user {user_id}.")
+        return [ExpenseSummary(expense.id, expense.amount_cents, expense.currency, expense.name) for expense in expenses]
 
     except Exception as e:
-        session.rollback()
         logging.error(f"Error retrieving last 5 expenses for user {user_id}: {e}")
         return None
 
 
 def retrieve_last_expense_id(user_id):
     """
-    Retrieves the ID of the most recent expense for a specific user.
+    Retrieves the ID of the most recent expense for a specific user, e.g. to undo it.
+
+    It is read from the recent expenses buffer, which only holds committed expenses: within
+    an update, use the ID returned by add_expense instead.
 
     Args:
         user_id (int): The ID of the user.
@@ -110,19 +281,144 @@ def retrieve_last_expense_id(user_id):
         int or None: The ID of the most recent expense if found, otherwise None.
     """
     try:
-        with Session() as session:
-            expense_record = session.query(Expense.id)\
-                                    .filter(Expense.user_id == user_id)\
-                                    .order_by(Expense.created_at.desc())\
-                                    .first()
-            if expense_record:
-                logging.info(f"Last expense ID retrieved for user {user_id}.")
-                return expense_record[0]  # Directly return the ID
-            else:
-                logging.info(f"No expenses found for user {user_id}.")
-                return None
+        expenses, _ = get_recent_expenses(user_id, 1)
+        if expenses:
+            logging.info(f"Last expense ID retrieved for user {user_id}.")
+            return expenses[0].id
+        else:
+            logging.info(f"No expenses found for user {user_id}.")
+            return None
 
     except Exception as e:
-        session.rollback()
         logging.error(f"Error retrieving last expense for user {user_id}: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def encode_expense_cursor(created_at, expense_id):
+    """
+    Encodes the keyset position of an expense into a compact string for callback data.
+
+    Args:
+        created_at (datetime): The creation time of the expense.
+        expense_id (int): The ID of the expense.
+
+    Returns:
+        str: The cursor, as '<microseconds since epoch>_<id>'.
+    """
+    micros = calendar.timegm(created_at.utctimetuple()) * 1_000_000 + created_at.microsecond
+    return f"{micros}_{expense_id}"
+
+
+def decode_expense_cursor(cursor):
+    """
+    Decodes a cursor produced by encode_expense_cursor.
+
+    Args:
+        cursor (str): The encoded cursor.
+
+    Returns:
+        tuple: (created_at, expense_id).
+    """
+    micros, expense_id = cursor.split('_')
+    created_at = datetime(1970, 1, 1) + timedelta(microseconds=int(micros))
+    return created_at, int(expense_id)
+
+
+def retrieve_expenses_page(user_id, cursor=None, direction='older', page_size=5):
+    """
+    Retrieves a page of a user's expenses, newest first, using keyset pagination.
+
+    The position is carried by a (created_at, id) cursor rather than an OFFSET, so every
+    page is a bounded range scan of the (user_id, created_at, id) index no matter how deep
+    into the history it is.
+
+    Args:
+        user_id (int): The ID of the user whose expenses are to be retrieved.
+        cursor (str, optional): Encoded position to page from. None for the newest page.
+        direction (str): 'older' for the expenses after the cursor, 'newer' for the ones before it.
+        page_size (int): The number of expenses per page.
+
+    Returns:
+        tuple: (expenses, has_newer, has_older) where expenses is a list of ExpenseRecord tuples,
+               newest first, or None if an error occurs.
+    """
+    try:
+        # The newest page, the one shown after adding or deleting, comes from the recent expenses buffer
+        if cursor is None and direction == 'older' and page_size < RECENT_EXPENSES_SIZE:
+            expenses, has_older = get_recent_expenses(user_id, page_size)
+            logging.info(f"Expenses page retrieved for user {user_id}.")
+            return expenses, False, has_older
+
+        with get_read_session(user_id) as session:
+            query = session.query(Expense.id, Expense.amount_cents, Expense.currency, Category.name, Expense.description,
+                                  Expense.date, Expense.created_at)\
+                           .join(Category, Expense.category_id == Category.id)\
+                           .filter(Expense.user_id == user_id)
+
+            if cursor is not None:
+                created_at, expense_id = decode_expense_cursor(cursor)
+                if direction == 'newer':
+                    query = query.filter(or_(Expense.created_at > created_at,
+                                             and_(Expense.created_at == created_at, Expense.id > expense_id)))
+                else:
+                    query = query.filter(or_(Expense.created_at < created_at,
+                                             and_(Expense.created_at == created_at, Expense.id < expense_id)))
+
+            if direction == 'newer':
+                query = query.order_by(Expense.created_at.asc(), Expense.id.asc())
+            else:
+                query = query.order_by(Expense.created_at.desc(), Expense.id.desc())
+
+            # One extra row tells whether there is another page in the same direction
+            expenses = [ExpenseRecord._make(row) for row in query.limit(page_size + 1)]
+            has_more = len(expenses) > page_size
+            expenses = expenses[:page_size]
+
+            if direction == 'newer':
+                expenses.reverse()
+                has_newer, has_older = has_more, True
+            else:
+                has_newer, has_older = cursor is not None, has_more
+
+            logging.info(f"Expenses page retrieved for user {user_id}.")
+            return expenses, has_newer, has_older
+
+    except Exception as e:
+        logging.error(f"Error retrieving expenses page for user {user_id}: {e}")
+        return None
+
+
+def sum_expenses(user_id, start_date=None, end_date=None, category_id=None):
+    """
+    Sums a user's expenses, per currency, as exact integer totals.
+
+    Without a category filter the query is answered from the (user_id, date, currency,
+    amount_cents) index alone.
+
+    Args:
+        user_id (int): The ID of the user.
+        start_date (datetime, optional): Only expenses dated on or after this date.
+        end_date (datetime, optional): Only expenses dated before this date.
+        category_id (int, optional): Only expenses of this category.
+
+    Returns:
+        dict: Currency code -> total amount in cents, or None if an error occurs.
+    """
+    try:
+        with get_read_session(user_id) as session:
+            query = session.query(Expense.currency, func.sum(Expense.amount_cents))\
+                           .filter(Expense.user_id == user_id)
+            if start_date is not None:
+                query = query.filter(Expense.date >= start_date)
+            if end_date is not None:
+                query = query.filter(Expense.date < end_date)
+            if category_id is not None:
+                query = query.filter(Expense.category_id == category_id)
+
+            totals = {currency: int(total) for currency, total in query.group_by(Expense.currency).all()}
+            logging.info(f"Expense totals computed for user {user_id}.")
+            return totals
+
+    except Exception as e:
+        logging.error(f"Error computing expense totals for user {user_id}: {e}")
+        return None
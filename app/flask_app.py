@@ -3,6 +3,8 @@ from google_auth_oauthlib.flow import Flow
 import json
 import os
 
+from .http_pools import google_auth_adapter
+
 app = Flask(__name__)
 
 with open('./client_secret_413293732491-pdfv31n1tct9o1kdeace1qv1v03r7rt9.apps.googleusercontent.com.json','r') as json_file:
@@ -60,6 +62,8 @@ def oauth2callback():
         redirect_uri=REDIRECT_URI
     )
 
+    # Token exchange on the shared Google pool
+    flow.oauth2session.mount('https://', google_auth_adapter)
     flow.fetch_token(authorization_response=request.url)
 
     credentials = flow.credentials
@@ -1,17 +1,29 @@
-from .models import UserGoogleSheetsCredentials
-from .db_utils import Session, add_to_session_and_close
-from .flask_app import REDIRECT_URI
+from .models import UserGoogleSheetsCredentials, Expense, Category, GsheetRow
+from .categories import normalize_category_name
+from .db_utils import Session, get_read_session, add_to_session_and_close
+from .flask_app import REDIRECT_URI, client_config
+from .http_pools import google_http, google_authorized_http, google_auth_request
+import os
 import logging
+import hashlib
+import threading
+from datetime import datetime, timedelta
 logging.basicConfig(filename='./logs/mylogs.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.DEBUG)
 
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from sqlalchemy import select, insert, update, bindparam, func
 
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 CREDENTIALS_FILE = './client_secret_413293732491-pdfv31n1tct9o1kdeace1qv1v03r7rt9.apps.googleusercontent.com.json'
+TOKEN_URI = 'https://oauth2.googleapis.com/token'
+# Tokens are refreshed this long before they expire, so no request starts with a token about to expire
+TOKEN_REFRESH_MARGIN = timedelta(seconds=int(os.getenv('GOOGLE_TOKEN_REFRESH_MARGIN', 300)))
 
 
 # Add user info
@@ -20,6 +32,7 @@ def add_basicinfo(user_id, spreadsheet_id, sheet_name):
     try:
         spreadsheet = UserGoogleSheetsCredentials(user_id=user_id,spreadsheet_id=spreadsheet_id,sheet_name=sheet_name)
         add_to_session_and_close(session,spreadsheet)
+        invalidate_sheets_client(user_id)
         logging.info(f'Spreadsheet info added by user:{user_id} : {spreadsheet_id}')
         return spreadsheet
     except Exception as e:
@@ -53,4 +66,308 @@ def get_google_auth_url():
     )
     return auth_url
 
-print(get_google_auth_url())
\ No newline at end of file
+print(get_google_auth_url())
+
+
+## SHEETS CLIENTS
+_sheets_service = None
+_sheets_service_lock = threading.Lock()
+
+# user_id -> SheetsClient
+_sheets_clients = {}
+_sheets_clients_lock = threading.Lock()
+
+# user_id -> (access token, refresh token, expiry) refreshed since the last write-back
+_refreshed_tokens = {}
+_refreshed_tokens_lock = threading.Lock()
+
+
+def get_sheets_service():
+    """
+    Returns the Sheets API service, built once from the discovery document bundled with googleapiclient.
+
+    The service holds no credentials: requests are executed with the caller's authorized
+    http, so one service is shared by every user and thread.
+    """
+    global _sheets_service
+    with _sheets_service_lock:
+        if _sheets_service is None:
+            document = discovery_cache.get_static_doc('sheets', 'v4')
+            _sheets_service = build_from_document(document, http=google_http())
+            logging.info('Sheets service built from the bundled discovery document.')
+        return _sheets_service
+
+
+class SheetsClient:
+    """
+    A user's Google credentials and sheet, ready to execute Sheets API requests.
+
+    Tokens are refreshed proactively, TOKEN_REFRESH_MARGIN before they expire, and only once
+    for all the requests running at that moment. Refreshed tokens are queued for a batched
+    write-back, see flush_refreshed_tokens.
+    """
+
+    def __init__(self, user_id, credentials, spreadsheet_id, sheet_name):
+        self.user_id = user_id
+        self.credentials = credentials
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self._lock = threading.Lock()
+
+    @property
+    def values(self):
+        return get_sheets_service().spreadsheets().values()
+
+    def _ensure_fresh_token(self):
+        with self._lock:
+            expiry = self.credentials.expiry
+            if self.credentials.token and expiry is not None and expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN:
+                return
+            self.credentials.refresh(google_auth_request())
+            logging.info(f'Google token of user {self.user_id} refreshed, valid until {self.credentials.expiry}.')
+            self._queue_write_back()
+
+    def _queue_write_back(self):
+        with _refreshed_tokens_lock:
+            _refreshed_tokens[self.user_id] = (self.credentials.token, self.credentials.refresh_token,
+                                               self.credentials.expiry)
+
+    def execute(self, request, num_retries=2):
+        """
+        Executes a Sheets API request with the user's credentials, on the shared connection pool.
+
+        Args:
+            request (googleapiclient.http.HttpRequest): The request, e.g. client.values.update(...).
+            num_retries (int): Retries on rate limits and server errors, with exponential backoff.
+
+        Returns:
+            dict: The API response.
+        """
+        self._ensure_fresh_token()
+        token = self.credentials.token
+        response = request.execute(http=google_authorized_http(self.credentials), num_retries=num_retries)
+        # A 401 makes AuthorizedHttp refresh on its own, that token must be stored as well
+        if self.credentials.token != token:
+            self._queue_write_back()
+        return response
+
+
+def get_sheets_client(user_id):
+    """
+    Returns the cached Sheets client of a user, loading the stored credentials on first use.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        SheetsClient: The user's client, or None if the user has no connected sheet or no refresh token.
+    """
+    with _sheets_clients_lock:
+        if user_id in _sheets_clients:
+            return _sheets_clients[user_id]
+
+    try:
+        with Session() as session:
+            stored = session.get(UserGoogleSheetsCredentials, user_id)
+            if stored is None or not stored.refresh_token or not stored.spreadsheet_id:
+                logging.info(f'User {user_id} has no connected Google sheet.')
+                return None
+            credentials = Credentials(token=stored.access_token, refresh_token=stored.refresh_token,
+                                      token_uri=TOKEN_URI, expiry=stored.token_expiry, scopes=SCOPES,
+                                      client_id=client_config['installed']['client_id'],
+                                      client_secret=client_config['installed']['client_secret'])
+            client = SheetsClient(user_id, credentials, stored.spreadsheet_id, stored.sheet_name)
+    except Exception as e:
+        logging.error(f'Error loading Google credentials of user {user_id}: {e}')
+        return None
+
+    with _sheets_clients_lock:
+        return _sheets_clients.setdefault(user_id, client)
+
+
+def invalidate_sheets_client(user_id):
+    """Drops the cached Sheets client of a user, e.g. after the sheet settings change."""
+    with _sheets_clients_lock:
+        _sheets_clients.pop(user_id, None)
+
+
+def flush_refreshed_tokens():
+    """
+    Writes the tokens refreshed since the last call back to the database, in one transaction.
+
+    Returns:
+        int: The number of users whose tokens were written.
+    """
+    with _refreshed_tokens_lock:
+        refreshed = dict(_refreshed_tokens)
+        _refreshed_tokens.clear()
+    if not refreshed:
+        return 0
+
+    table = UserGoogleSheetsCredentials.__table__
+    try:
+        with Session() as session:
+            session.connection().execute(
+                update(table)
+                .where(table.c.user_id == bindparam('gsheet_user_id'))
+                .values(access_token=bindparam('new_access_token'), refresh_token=bindparam('new_refresh_token'),
+                        token_expiry=bindparam('new_token_expiry'), updated_at=datetime.utcnow()),
+                [{'gsheet_user_id': user_id, 'new_access_token': token, 'new_refresh_token': refresh_token,
+                  'new_token_expiry': expiry}
+                 for user_id, (token, refresh_token, expiry) in refreshed.items()]
+            )
+            session.commit()
+        logging.info(f'Refreshed Google tokens of {len(refreshed)} users written back.')
+        return len(refreshed)
+
+    except Exception as e:
+        logging.error(f'Error writing back refreshed Google tokens, will retry: {e}')
+        # Tokens refreshed again in the meantime are newer than the ones we failed to store
+        with _refreshed_tokens_lock:
+            for user_id, tokens in refreshed.items():
+                _refreshed_tokens.setdefault(user_id, tokens)
+        return 0
+
+
+## BACKFILL
+# Rows written per values.update request
+BACKFILL_PAGE_SIZE = int(os.getenv('GSHEET_BACKFILL_PAGE_SIZE', 2000))
+SHEET_HEADER = ['ID', 'Date', 'Amount', 'Currency', 'Category', 'Description']
+
+
+def sheet_range(sheet_name, cell):
+    """A1 notation for a cell of a sheet, quoting the sheet name."""
+    sheet_name = (sheet_name or 'Sheet1').replace("'", "''")
+    return f"'{sheet_name}'!{cell}"
+
+
+def expense_sheet_row(expense):
+    """The sheet row of an expense, in SHEET_HEADER order."""
+    date = expense.date or expense.created_at
+    return [expense.id, f'{date:%Y-%m-%d}', expense.amount_cents / 100, expense.currency,
+            expense.name or '', expense.description or '']
+
+
+def expense_value_ranges(sheet_name, first_row, expenses):
+    """
+    The value ranges writing expenses to consecutive rows, from `first_row` on.
+
+    ID, date and amount (A:C) are written USER_ENTERED so Sheets stores a real date and
+    number. Currency, category and description (D:F) are free text and written RAW: text
+    like '=...', '+39...' or '3/4' must never become a formula, number or date.
+
+    Returns:
+        dict: valueInputOption -> value range, for values.update or values.batchUpdate.
+    """
+    rows = [expense_sheet_row(expense) for expense in expenses]
+    last_row = first_row + len(rows) - 1
+    return {
+        'USER_ENTERED': {'range': sheet_range(sheet_name, f'A{first_row}:C{last_row}'),
+                         'values': [row[:3] for row in rows]},
+        'RAW': {'range': sheet_range(sheet_name, f'D{first_row}:F{last_row}'),
+                'values': [row[3:] for row in rows]},
+    }
+
+
+def expense_row_hash(date, amount_cents, currency, category_name, description):
+    """
+    Hashes the user-editable content of an expense row, the same way for database and sheet values.
+
+    Returns:
+        str: The hex SHA-1 of the normalized content.
+    """
+    content = '\x1f'.join([f'{date:%Y-%m-%d}' if date else '', str(amount_cents), (currency or '').upper(),
+                           normalize_category_name(category_name or ''), ' '.join((description or '').split())])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _save_backfill_checkpoint(user_id, last_expense_id, rows, exported):
+    # The exported rows are recorded with the checkpoint, so a page re-sent after a crash is recorded once
+    now = datetime.utcnow()
+    with Session() as session:
+        session.execute(
+            update(UserGoogleSheetsCredentials)
+            .where(UserGoogleSheetsCredentials.user_id == user_id)
+            .values(backfill_last_expense_id=last_expense_id, backfill_rows=rows)
+        )
+        session.execute(insert(GsheetRow).values([
+            {'user_id': user_id, 'expense_id': expense_id, 'row_number': row_number,
+             'content_hash': content_hash, 'synced_at': now}
+            for expense_id, row_number, content_hash in exported
+        ]))
+        session.commit()
+
+
+def backfill_expenses_to_sheet(user_id, progress=None, page_size=BACKFILL_PAGE_SIZE):
+    """
+    Exports a user's expenses to their Google sheet, resuming from the last checkpoint.
+
+    Expenses are streamed in ID order through a server-side cursor and written in pages of
+    `page_size` rows, one values.update request per page. After every page the last
+    exported ID and the number of rows written are stored, so an interrupted export
+    continues where it stopped and a later run only adds the newer expenses.
+
+    Args:
+        user_id (int): The ID of the user.
+        progress (callable, optional): Called as progress(exported, total) after every page.
+        page_size (int): The number of rows per request.
+
+    Returns:
+        int: The number of expenses exported, or None if the user has no connected sheet.
+
+    Raises:
+        googleapiclient.errors.HttpError: If a Sheets request fails after retries.
+        SQLAlchemyError: If there is a database related error.
+    """
+    client = get_sheets_client(user_id)
+    if client is None:
+        return None
+
+    with Session() as session:
+        last_id, rows_written = session.execute(
+            select(UserGoogleSheetsCredentials.backfill_last_expense_id, UserGoogleSheetsCredentials.backfill_rows)
+            .where(UserGoogleSheetsCredentials.user_id == user_id)
+        ).one()
+        total = session.scalar(
+            select(func.count(Expense.id)).where(Expense.user_id == user_id, Expense.id > (last_id or 0))
+        )
+
+    if last_id is None:
+        client.execute(client.values.update(spreadsheetId=client.spreadsheet_id,
+                                            range=sheet_range(client.sheet_name, 'A1'),
+                                            valueInputOption='RAW', body={'values': [SHEET_HEADER]}))
+        rows_written = 0
+
+    exported = 0
+    # The export is the heaviest read, it runs on a replica when there is one
+    with get_read_session(user_id) as session:
+        result = session.execute(
+            select(Expense.id, Expense.date, Expense.created_at, Expense.amount_cents, Expense.currency,
+                   Category.name, Expense.description)
+            .outerjoin(Category, Category.id == Expense.category_id)
+            .where(Expense.user_id == user_id, Expense.id > (last_id or 0))
+            .order_by(Expense.id)
+            .execution_options(stream_results=True, yield_per=page_size)
+        )
+        for page in result.partitions():
+            # Row 1 is the header
+            for value_input_option, value_range in expense_value_ranges(client.sheet_name, rows_written + 2, page).items():
+                client.execute(client.values.update(spreadsheetId=client.spreadsheet_id, range=value_range['range'],
+                                                    valueInputOption=value_input_option,
+                                                    body={'values': value_range['values']}))
+            exported_rows = [
+                (expense.id, rows_written + 2 + index,
+                 expense_row_hash(expense.date or expense.created_at, expense.amount_cents, expense.currency,
+                                  expense.name, expense.description))
+                for index, expense in enumerate(page)
+            ]
+            last_id = page[-1].id
+            rows_written += len(page)
+            exported += len(page)
+            _save_backfill_checkpoint(user_id, last_id, rows_written, exported_rows)
+            if progress is not None:
+                progress(exported, total)
+
+    logging.info(f'Backfill of user {user_id}: {exported} expenses exported, {rows_written} rows in the sheet.')
+    return exported
+
@@ -0,0 +1,316 @@
+# Standard library imports
+import os
+import math
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+# Third-party imports
+from sqlalchemy import select, update, delete, bindparam
+
+# Local application imports
+from .db_utils import Session, record_write
+from .models import UserGoogleSheetsCredentials, Expense, Category, GsheetRow, GsheetBlock
+from .categories import normalize_category_name
+from .expenses import parse_amount
+from .recent import invalidate_recent_expenses
+from .classifier import learn_expense, unlearn_expense
+from .gsheet import get_sheets_service, get_sheets_client, sheet_range, expense_value_ranges, expense_row_hash
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Sheet rows covered by one fingerprint
+SYNC_BLOCK_ROWS = int(os.getenv('GSHEET_SYNC_BLOCK_ROWS', 500))
+# Every this many passes all blocks are read, catching edits a fingerprint could miss
+FULL_SYNC_EVERY = int(os.getenv('GSHEET_FULL_SYNC_EVERY', 24))
+# Hidden sheet holding one fingerprint formula per block
+SYNC_SHEET = '_sync'
+
+# Sheets stores dates as days since this day
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+_passes = {}
+
+
+def block_fingerprint_formula(sheet_name, block):
+    """
+    Formula computing a fingerprint of one block of expense rows, evaluated by Google Sheets.
+
+    It combines numeric sums (dates and amounts, exact) with the length and some characters
+    of every cell, weighted by position, so reading one cell tells whether the block changed.
+    """
+    first = 2 + block * SYNC_BLOCK_ROWS
+    cells = sheet_range(sheet_name, f'A{first}:F{first + SYNC_BLOCK_ROWS - 1}')
+    weight = f'ROW({cells})*COLUMN({cells})'
+    parts = [
+        f'SUMPRODUCT(IFERROR({cells}*1,0)*{weight})',
+        f'SUMPRODUCT(LEN({cells})*{weight})',
+        f'SUMPRODUCT(UNICODE({cells}&" ")*{weight})',
+        f'SUMPRODUCT(UNICODE(MID({cells}&" ",INT(LEN({cells})/2)+1,1))*{weight})',
+        f'SUMPRODUCT(UNICODE(RIGHT({cells}&" ",1))*{weight})',
+    ]
+    return '=' + '&"/"&'.join(parts)
+
+
+def _ensure_sync_sheet(client):
+    sheets = client.execute(get_sheets_service().spreadsheets().get(spreadsheetId=client.spreadsheet_id,
+                                                         fields='sheets.properties.title'))
+    if any(sheet['properties']['title'] == SYNC_SHEET for sheet in sheets.get('sheets', [])):
+        return
+    client.execute(get_sheets_service().spreadsheets().batchUpdate(spreadsheetId=client.spreadsheet_id, body={
+        'requests': [{'addSheet': {'properties': {'title': SYNC_SHEET, 'hidden': True}}}]
+    }))
+
+
+def _parse_sheet_row(row, categories):
+    """Turns a sheet row back into expense values, or None if it cannot be applied."""
+    row = list(row) + [''] * (6 - len(row))
+    expense_id, date, amount, currency, category_name, description = row[:6]
+    try:
+        expense_id = int(expense_id)
+        if isinstance(date, (int, float)):
+            date = SHEETS_EPOCH + timedelta(days=date)
+        else:
+            date = datetime.strptime(str(date).strip(), '%Y-%m-%d')
+        amount_cents = parse_amount(amount)
+    except (ValueError, TypeError):
+        return None
+    category_id = categories.get(normalize_category_name(str(category_name)))
+    if category_id is None:
+        return None
+    return {
+        'expense_id': expense_id, 'date': date, 'amount_cents': amount_cents,
+        'currency': (str(currency).strip() or 'EUR').upper()[:3], 'category_id': category_id,
+        'category_name': category_name, 'description': str(description),
+    }
+
+
+def _read_fingerprints(client, blocks):
+    response = client.execute(client.values.get(spreadsheetId=client.spreadsheet_id,
+                                                range=sheet_range(SYNC_SHEET, f'A1:A{blocks}'),
+                                                valueRenderOption='UNFORMATTED_VALUE'))
+    values = response.get('values', [])
+    # The formula results can be long, only their digest is stored
+    return {block: hashlib.sha1(str(values[block][0] if block < len(values) and values[block] else '').encode()).hexdigest()
+            for block in range(blocks)}
+
+
+def _store_fingerprints(user_id, fingerprints):
+    with Session() as session:
+        for block, fingerprint in fingerprints.items():
+            session.merge(GsheetBlock(user_id=user_id, block=block, fingerprint=fingerprint))
+        session.commit()
+
+
+def _apply_pulled_rows(user_id, pulled, now):
+    # The sheet edits and their new row hashes are committed together
+    expenses = Expense.__table__
+    rows_table = GsheetRow.__table__
+    with Session() as session:
+        previous = {
+            row.id: row for row in session.execute(
+                select(Expense.id, Expense.description, Expense.category_id)
+                .where(Expense.user_id == user_id, Expense.id.in_([row['expense_id'] for row in pulled]))
+            ).all()
+        }
+        session.connection().execute(
+            update(expenses)
+            .where(expenses.c.id == bindparam('expense_id'), expenses.c.user_id == user_id)
+            .values(date=bindparam('date'), amount_cents=bindparam('amount_cents'), currency=bindparam('currency'),
+                    category_id=bindparam('category_id'), description=bindparam('description'), updated_at=now),
+            [{key: row[key] for key in ('expense_id', 'date', 'amount_cents', 'currency', 'category_id', 'description')}
+             for row in pulled]
+        )
+        session.connection().execute(
+            update(rows_table)
+            .where(rows_table.c.user_id == user_id, rows_table.c.expense_id == bindparam('row_expense_id'))
+            .values(content_hash=bindparam('new_hash'), synced_at=now),
+            [{'row_expense_id': row['expense_id'], 'new_hash': row['content_hash']} for row in pulled]
+        )
+        record_write(session, user_id)
+        session.commit()
+
+    invalidate_recent_expenses(user_id)
+    # A category or description edited in the sheet relabels the expense, as a bot edit would
+    for row in pulled:
+        old = previous.get(row['expense_id'])
+        if old is not None and (old.description, old.category_id) != (row['description'], row['category_id']):
+            unlearn_expense(user_id, old.description, old.category_id)
+            learn_expense(user_id, row['description'], row['category_id'])
+
+
+def _record_pushed_rows(user_id, bot_changed, deleted, now):
+    rows_table = GsheetRow.__table__
+    with Session() as session:
+        if bot_changed:
+            session.connection().execute(
+                update(rows_table)
+                .where(rows_table.c.user_id == user_id, rows_table.c.expense_id == bindparam('row_expense_id'))
+                .values(content_hash=bindparam('new_hash'), synced_at=now),
+                [{'row_expense_id': expense.id,
+                  'new_hash': expense_row_hash(expense.date or expense.created_at, expense.amount_cents,
+                                               expense.currency, expense.name, expense.description)}
+                 for expense in bot_changed]
+            )
+        if deleted:
+            session.execute(delete(GsheetRow).where(GsheetRow.user_id == user_id,
+                                                    GsheetRow.expense_id.in_([expense_id for expense_id, _ in deleted])))
+        session.commit()
+
+
+def reconcile_sheet(user_id):
+    """
+    Runs one two-way sync pass between a user's expenses and their Google sheet.
+
+    Only the rows exported by the backfill are reconciled. Each pass reads one fingerprint
+    cell per block of SYNC_BLOCK_ROWS rows and only reads the blocks whose fingerprint
+    changed. In those blocks, rows whose content hash differs from the one stored at the
+    last sync were edited in the sheet and are applied to the database in one batch.
+    Expenses updated in the bot since their last sync (updated_at > synced_at) are written
+    to their rows with one batchUpdate, deleted expenses have their rows cleared.
+
+    When a row changed on both sides the bot edit wins: its updated_at is newer than the
+    last sync, while sheet edits carry no timestamp.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        dict: Counts of 'blocks_read', 'pulled', 'pushed' and 'cleared' rows, or None if the
+              user has no connected sheet.
+
+    Raises:
+        googleapiclient.errors.HttpError: If a Sheets request fails after retries.
+        SQLAlchemyError: If there is a database related error.
+    """
+    client = get_sheets_client(user_id)
+    if client is None:
+        return None
+
+    with Session() as session:
+        rows = session.scalar(select(UserGoogleSheetsCredentials.backfill_rows)
+                              .where(UserGoogleSheetsCredentials.user_id == user_id)) or 0
+        stored_fingerprints = dict(session.execute(
+            select(GsheetBlock.block, GsheetBlock.fingerprint).where(GsheetBlock.user_id == user_id)
+        ).all())
+    summary = {'blocks_read': 0, 'pulled': 0, 'pushed': 0, 'cleared': 0}
+    if not rows:
+        return summary
+
+    # Fingerprint formulas for blocks created since the last pass
+    blocks = math.ceil(rows / SYNC_BLOCK_ROWS)
+    missing = [block for block in range(blocks) if block not in stored_fingerprints]
+    if missing:
+        if not stored_fingerprints:
+            _ensure_sync_sheet(client)
+        client.execute(client.values.update(
+            spreadsheetId=client.spreadsheet_id,
+            range=sheet_range(SYNC_SHEET, f'A{missing[0] + 1}:A{blocks}'),
+            valueInputOption='USER_ENTERED',
+            body={'values': [[block_fingerprint_formula(client.sheet_name, block)] for block in range(missing[0], blocks)]}
+        ))
+
+    fingerprints = _read_fingerprints(client, blocks)
+    _passes[user_id] = _passes.get(user_id, 0) + 1
+    if _passes[user_id] % FULL_SYNC_EVERY == 0:
+        changed_blocks = list(range(blocks))
+    else:
+        changed_blocks = [block for block in range(blocks) if fingerprints[block] != stored_fingerprints.get(block)]
+
+    now = datetime.utcnow()
+    with Session() as session:
+        synced = {
+            row.expense_id: row for row in session.execute(
+                select(GsheetRow.expense_id, GsheetRow.row_number, GsheetRow.content_hash, GsheetRow.synced_at)
+                .where(GsheetRow.user_id == user_id)
+            ).all()
+        }
+        categories = dict(session.execute(
+            select(Category.name_normalized, Category.id).where(Category.user_id == user_id)
+        ).all())
+        # Rows changed in the bot since their last sync, and rows whose expense was deleted
+        bot_changed = session.execute(
+            select(Expense.id, Expense.date, Expense.created_at, Expense.amount_cents, Expense.currency,
+                   Category.name, Expense.description, GsheetRow.row_number)
+            .join(GsheetRow, (GsheetRow.user_id == Expense.user_id) & (GsheetRow.expense_id == Expense.id))
+            .outerjoin(Category, Category.id == Expense.category_id)
+            .where(Expense.user_id == user_id, Expense.updated_at > GsheetRow.synced_at)
+        ).all()
+        deleted = session.execute(
+            select(GsheetRow.expense_id, GsheetRow.row_number)
+            .outerjoin(Expense, Expense.id == GsheetRow.expense_id)
+            .where(GsheetRow.user_id == user_id, Expense.id.is_(None))
+        ).all()
+    bot_changed_ids = {expense.id for expense in bot_changed} | {expense_id for expense_id, _ in deleted}
+
+    # Pull: rows of the changed blocks whose content differs from the last sync
+    pulled = []
+    if changed_blocks:
+        ranges = [sheet_range(client.sheet_name, f'A{2 + block * SYNC_BLOCK_ROWS}:F{1 + (block + 1) * SYNC_BLOCK_ROWS}')
+                  for block in changed_blocks]
+        response = client.execute(client.values.batchGet(spreadsheetId=client.spreadsheet_id, ranges=ranges,
+                                                         valueRenderOption='UNFORMATTED_VALUE',
+                                                         dateTimeRenderOption='SERIAL_NUMBER'))
+        summary['blocks_read'] = len(changed_blocks)
+        for block, value_range in zip(changed_blocks, response.get('valueRanges', [])):
+            for offset, row in enumerate(value_range.get('values', [])):
+                parsed = _parse_sheet_row(row, categories) if row else None
+                if parsed is None:
+                    continue
+                stored = synced.get(parsed['expense_id'])
+                # Only rows still in the position the bot wrote them to are trusted
+                if stored is None or stored.row_number != 2 + block * SYNC_BLOCK_ROWS + offset:
+                    continue
+                parsed['content_hash'] = expense_row_hash(parsed['date'], parsed['amount_cents'], parsed['currency'],
+                                                          parsed['category_name'], parsed['description'])
+                if parsed['content_hash'] != stored.content_hash and parsed['expense_id'] not in bot_changed_ids:
+                    pulled.append(parsed)
+
+    # Each transaction is short and none is open during a Sheets request, so the rows of
+    # the user's expenses are never locked across a Google round trip
+    if pulled:
+        _apply_pulled_rows(user_id, pulled, now)
+
+    # Push: the sheet is written before the sync state is recorded, a failure retries next pass
+    # One batchUpdate per valueInputOption, the free-text columns are written RAW
+    pushes = {}
+    for expense in bot_changed:
+        for value_input_option, value_range in expense_value_ranges(client.sheet_name, expense.row_number, [expense]).items():
+            pushes.setdefault(value_input_option, []).append(value_range)
+    for value_input_option, value_ranges in pushes.items():
+        client.execute(client.values.batchUpdate(spreadsheetId=client.spreadsheet_id, body={
+            'valueInputOption': value_input_option, 'data': value_ranges,
+        }))
+    if deleted:
+        client.execute(client.values.batchClear(spreadsheetId=client.spreadsheet_id, body={
+            'ranges': [sheet_range(client.sheet_name, f'A{row_number}:F{row_number}') for _, row_number in deleted],
+        }))
+    if bot_changed or deleted:
+        _record_pushed_rows(user_id, bot_changed, deleted, now)
+
+    summary.update(pulled=len(pulled), pushed=len(bot_changed), cleared=len(deleted))
+    # Our own writes changed some fingerprints, read them again so they do not count as sheet edits
+    if bot_changed or deleted:
+        fingerprints = _read_fingerprints(client, blocks)
+    _store_fingerprints(user_id, fingerprints)
+
+    logging.info(f'Sheet sync of user {user_id}: {summary}.')
+    return summary
+
+
+def get_synced_users():
+    """
+    Returns the users with exported rows to reconcile.
+
+    Returns:
+        list: The IDs of the users.
+    """
+    with Session() as session:
+        return session.scalars(
+            select(UserGoogleSheetsCredentials.user_id)
+            .where(UserGoogleSheetsCredentials.backfill_rows > 0,
+                   UserGoogleSheetsCredentials.refresh_token.is_not(None))
+        ).all()
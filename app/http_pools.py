@@ -0,0 +1,340 @@
+# Standard library imports
+import os
+import time
+import logging
+import threading
+from importlib import import_module
+from importlib.util import find_spec
+
+# Third-party imports
+import httpx
+import openai
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google_auth_httplib2 import AuthorizedHttp
+from telegram.request import HTTPXRequest
+
+# Local application imports
+from .metrics import metrics
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+
+def _setting(pool, name, default, cast=float):
+    """Reads <POOL>_HTTP_<NAME>, then HTTP_<NAME>, then falls back to the default."""
+    value = os.getenv(f'{pool.upper()}_HTTP_{name}', os.getenv(f'HTTP_{name}'))
+    return default if value is None else cast(value)
+
+
+def _http2_enabled(pool):
+    # HTTP/2 needs the h2 package, without it the pools stay on HTTP/1.1 keep-alive
+    return _setting(pool, 'HTTP2', 'true', str).lower() == 'true' and find_spec('h2') is not None
+
+
+def _limits(pool):
+    return httpx.Limits(max_connections=_setting(pool, 'MAX_CONNECTIONS', 32, int),
+                        max_keepalive_connections=_setting(pool, 'MAX_KEEPALIVE', 16, int),
+                        keepalive_expiry=_setting(pool, 'KEEPALIVE_EXPIRY', 120.0))
+
+
+def _timeout(pool, read_default):
+    return httpx.Timeout(_setting(pool, 'READ_TIMEOUT', read_default),
+                         connect=_setting(pool, 'CONNECT_TIMEOUT', 5.0),
+                         pool=_setting(pool, 'POOL_TIMEOUT', 5.0))
+
+
+def _trace_event(transport, event):
+    # A steady state pool reuses its connections: these counters should stop growing
+    if event == 'connection.connect_tcp.complete':
+        metrics.increment('http.connections_opened', pool=transport.pool)
+        transport.count('connections_opened')
+    elif event == 'connection.start_tls.complete':
+        metrics.increment('http.tls_handshakes', pool=transport.pool)
+        transport.count('tls_handshakes')
+
+
+def _count_response(transport, response):
+    transport.count('requests')
+    if response.extensions.get('http_version') == b'HTTP/2':
+        transport.count('http2_requests')
+
+
+def _new_counters():
+    return {'requests': 0, 'http2_requests': 0, 'connections_opened': 0, 'tls_handshakes': 0}
+
+
+# Pool name -> metered httpx transport, for pool_stats
+_transports = {}
+
+
+class MeteredTransport:
+    """
+    httpx transport with a configured connection pool that records request and connection metrics.
+
+    The underlying pool is created on first use and again after `close`, so a client can be
+    rebuilt on the same transport. `http_module` is the httpx flavour of the client using
+    the transport (the OpenAI SDK ships its own fork with the same API).
+    """
+
+    def __init__(self, pool, http_module=httpx):
+        self.pool = pool
+        self._http = http_module
+        self._transport = None
+        self._lock = threading.Lock()
+        # Kept here rather than read from the pool, whose internals change between httpx releases
+        self._counters = _new_counters()
+        _transports[pool] = self
+
+    def count(self, name):
+        # Requests come from several worker threads
+        with self._lock:
+            self._counters[name] += 1
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _inner(self):
+        with self._lock:
+            if self._transport is None:
+                limits = _limits(self.pool)
+                self._transport = self._http.HTTPTransport(
+                    http2=_http2_enabled(self.pool),
+                    limits=self._http.Limits(max_connections=limits.max_connections,
+                                             max_keepalive_connections=limits.max_keepalive_connections,
+                                             keepalive_expiry=limits.keepalive_expiry))
+            return self._transport
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def handle_request(self, request):
+        request.extensions['trace'] = lambda event, info: _trace_event(self, event)
+        started = time.monotonic()
+        response = self._inner().handle_request(request)
+        _count_response(self, response)
+        metrics.increment('http.requests', pool=self.pool)
+        metrics.observe('http.response_seconds', time.monotonic() - started, pool=self.pool)
+        return response
+
+    def close(self):
+        with self._lock:
+            transport, self._transport = self._transport, None
+        if transport is not None:
+            transport.close()
+
+
+class AsyncMeteredTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of MeteredTransport, used for the Telegram Bot API."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._transport = None
+        self._counters = _new_counters()
+        _transports[pool] = self
+
+    def count(self, name):
+        # Only used from the event loop
+        self._counters[name] += 1
+
+    def counters(self):
+        return dict(self._counters)
+
+    def _inner(self):
+        if self._transport is None:
+            self._transport = httpx.AsyncHTTPTransport(http2=_http2_enabled(self.pool), limits=_limits(self.pool))
+        return self._transport
+
+    async def handle_async_request(self, request):
+        async def trace(event, info):
+            _trace_event(self, event)
+
+        request.extensions['trace'] = trace
+        started = time.monotonic()
+        response = await self._inner().handle_async_request(request)
+        _count_response(self, response)
+        metrics.increment('http.requests', pool=self.pool)
+        metrics.observe('http.response_seconds', time.monotonic() - started, pool=self.pool)
+        return response
+
+    async def aclose(self):
+        transport, self._transport = self._transport, None
+        if transport is not None:
+            await transport.aclose()
+
+
+## TELEGRAM
+def telegram_request(pool='telegram', read_timeout=5.0):
+    """
+    Builds the request object of the Telegram bot, backed by a metered, configured pool.
+
+    Args:
+        pool (str): The pool name, also the prefix of its settings (e.g. TELEGRAM_HTTP_MAX_CONNECTIONS).
+        read_timeout (float): The default read timeout, in seconds.
+
+    Returns:
+        HTTPXRequest: The request object to pass to ApplicationBuilder.
+    """
+    timeout = _timeout(pool, read_timeout)
+    return HTTPXRequest(
+        connection_pool_size=_setting(pool, 'MAX_CONNECTIONS', 32, int),
+        read_timeout=timeout.read,
+        connect_timeout=timeout.connect,
+        pool_timeout=timeout.pool,
+        http_version='2' if _http2_enabled(pool) else '1.1',
+        httpx_kwargs={'transport': AsyncMeteredTransport(pool)},
+    )
+
+
+## OPENAI
+def openai_http_client(read_timeout=20.0):
+    """
+    Builds the HTTP client of the OpenAI SDK, backed by a metered, configured pool.
+
+    Args:
+        read_timeout (float): The default read timeout, in seconds.
+
+    Returns:
+        httpx.Client: The client to pass as `http_client` to openai.OpenAI.
+    """
+    http_module = import_module(openai.DefaultHttpxClient.__mro__[1].__module__.split('.')[0])
+    timeout = _timeout('openai', read_timeout)
+    return openai.DefaultHttpxClient(transport=MeteredTransport('openai', http_module),
+                                     timeout=http_module.Timeout(timeout.read, connect=timeout.connect,
+                                                                 pool=timeout.pool))
+
+
+## GOOGLE
+# httplib2 connections are not thread safe, so every worker thread keeps its own
+_google_local = threading.local()
+
+
+class MeteredHttp(httplib2.Http):
+    """httplib2 client that counts the connections it has to open."""
+
+    def request(self, *args, **kwargs):
+        connections = len(self.connections)
+        started = time.monotonic()
+        response = super().request(*args, **kwargs)
+        metrics.increment('http.requests', pool='google')
+        metrics.observe('http.response_seconds', time.monotonic() - started, pool='google')
+        if len(self.connections) > connections:
+            metrics.increment('http.connections_opened', pool='google')
+        return response
+
+
+def google_http():
+    """Returns the keep-alive httplib2 client of the current thread, shared by all users."""
+    http = getattr(_google_local, 'http', None)
+    if http is None:
+        http = MeteredHttp(timeout=_setting('google', 'READ_TIMEOUT', 20.0))
+        _google_local.http = http
+    return http
+
+
+def google_authorized_http(credentials):
+    """
+    Wraps the pooled Google client with a user's credentials, for googleapiclient requests.
+
+    Args:
+        credentials (google.oauth2.credentials.Credentials): The user's credentials.
+
+    Returns:
+        AuthorizedHttp: The client to pass as `http` to googleapiclient.
+    """
+    return AuthorizedHttp(credentials, http=google_http())
+
+
+class MeteredHTTPAdapter(HTTPAdapter):
+    """requests adapter that counts the requests it sends."""
+
+    def __init__(self, *args, **kwargs):
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        with self._requests_lock:
+            self.requests += 1
+        return super().send(request, *args, **kwargs)
+
+
+# OAuth token endpoints are called through requests, with one shared adapter
+google_auth_adapter = MeteredHTTPAdapter(pool_connections=4,
+                                         pool_maxsize=_setting('google', 'MAX_CONNECTIONS', 16, int))
+_google_auth_session = requests.Session()
+_google_auth_session.mount('https://', google_auth_adapter)
+
+
+def google_auth_request():
+    """Returns a google-auth transport on the shared pool, for token refreshes."""
+    return GoogleAuthRequest(session=_google_auth_session)
+
+
+## STATS
+def _open_connections(transport):
+    # Best effort: the pool's connection list is not public API, so when an httpx or
+    # httpcore upgrade moves it the stats only lose the open/idle counts
+    inner = transport._transport
+    if inner is None:
+        return []
+    try:
+        return list(inner._pool.connections)
+    except (AttributeError, TypeError):
+        return None
+
+
+def _idle_connections(connections):
+    try:
+        return sum(1 for connection in connections if connection.is_idle())
+    except AttributeError:
+        return None
+
+
+def _auth_connections_created():
+    # Same as above for urllib3: only the request counter is ours
+    try:
+        pools = google_auth_adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def pool_stats():
+    """
+    Returns the current state of every pool.
+
+    The request, HTTP/2 and connection counters are kept by the metered transports. The
+    number of open and idle connections is read from the pools when the installed httpx
+    exposes it, and is None otherwise.
+
+    Returns:
+        dict: Pool name -> dict with the counters of httpx pools, and the connections and
+              requests made by the Google auth pool.
+    """
+    stats = {}
+    for name, transport in list(_transports.items()):
+        connections = _open_connections(transport)
+        stats[name] = {
+            'open': None if connections is None else len(connections),
+            'idle': None if connections is None else _idle_connections(connections),
+            **transport.counters(),
+        }
+    stats['google_auth'] = {
+        'created': _auth_connections_created(),
+        'requests': google_auth_adapter.requests,
+    }
+    return stats
+
+
+def log_pool_stats():
+    for name, stats in pool_stats().items():
+        logging.info(f'http pool {name}: ' + ', '.join(f'{key}={value}' for key, value in stats.items()))
@@ -0,0 +1,145 @@
+# Standard library imports
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+# Third-party imports
+from sqlalchemy import select, insert, delete
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+# Local application imports
+from .db_utils import Session
+from .models import ProcessedUpdate
+from .metrics import metrics
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Keys remembered in memory, the oldest are forgotten first
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 20000))
+# Presses of the same button on the same message within this many seconds are one press
+DEDUP_TAP_WINDOW = float(os.getenv('DEDUP_TAP_WINDOW', 2))
+# Telegram drops undelivered updates after a day, stored keys are not needed longer
+DEDUP_RETENTION = timedelta(hours=int(os.getenv('DEDUP_RETENTION_HOURS', 24)))
+
+
+def update_keys(update):
+    """
+    Returns the keys identifying an update: its update_id and, for button presses, the callback query id.
+
+    Returns:
+        list: The keys, empty for updates that are not Telegram updates (e.g. custom updates).
+    """
+    update_id = getattr(update, 'update_id', None)
+    if update_id is None:
+        return []
+    keys = [f'u{update_id}']
+    if update.callback_query is not None:
+        keys.append(f'q{update.callback_query.id}')
+    return keys
+
+
+def tap_key(update):
+    """The key of a button press, equal for repeated presses of the same button, or None."""
+    query = getattr(update, 'callback_query', None)
+    if query is None or query.message is None:
+        return None
+    return f't{query.message.chat.id}:{query.message.message_id}:{query.data}'
+
+
+class UpdateDeduplicator:
+    """
+    Drops updates that were already received, before any handler runs.
+
+    Update ids and callback query ids are remembered in a bounded in-memory LRU and in the
+    processed_updates table, so redeliveries are also dropped after a restart. Repeated
+    presses of one button within DEDUP_TAP_WINDOW seconds arrive as distinct updates and
+    are only remembered in memory.
+
+    An update is claimed before its handlers run, so it is processed at most once: an update
+    whose processing failed is not run again when Telegram resends it.
+    """
+
+    def __init__(self, cache_size=DEDUP_CACHE_SIZE, tap_window=DEDUP_TAP_WINDOW):
+        self.cache_size = cache_size
+        self.tap_window = tap_window
+        self._seen = OrderedDict()
+
+    def _remember(self, key, now):
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.cache_size:
+            self._seen.popitem(last=False)
+
+    def claim_in_memory(self, update):
+        """
+        Claims an update against the in-memory window, without I/O. Called from the event loop only.
+
+        Returns:
+            bool: True if the update is new, False if it is a duplicate.
+        """
+        now = time.monotonic()
+        keys = update_keys(update)
+        tap = tap_key(update)
+        if any(key in self._seen for key in keys):
+            metrics.increment('updates.duplicates', source='memory')
+            return False
+        if tap is not None and now - self._seen.get(tap, float('-inf')) < self.tap_window:
+            metrics.increment('updates.duplicates', source='double_tap')
+            return False
+        # Claimed before the database check, so a concurrent copy is dropped in memory
+        for key in keys + ([tap] if tap is not None else []):
+            self._remember(key, now)
+        return True
+
+    @staticmethod
+    def claim_in_database(update):
+        """
+        Records the update keys, one INSERT with the keys as primary key values.
+
+        Returns:
+            bool: True if the update is new, False if a previous run already processed it.
+        """
+        keys = update_keys(update)
+        if not keys:
+            return True
+        try:
+            with Session() as session:
+                session.execute(insert(ProcessedUpdate).values([{'update_key': key} for key in keys]))
+                session.commit()
+            return True
+        except IntegrityError:
+            metrics.increment('updates.duplicates', source='database')
+            return False
+        except SQLAlchemyError as e:
+            # Losing deduplication is better than losing the update
+            logging.error(f'Error recording update keys {keys}: {e}')
+            return True
+
+
+def prune_processed_updates(batch_size=5000):
+    """
+    Deletes the stored update keys older than DEDUP_RETENTION, in batches.
+
+    Returns:
+        int: The number of deleted keys.
+    """
+    cutoff = datetime.utcnow() - DEDUP_RETENTION
+    deleted = 0
+    while True:
+        with Session() as session:
+            keys = session.scalars(
+                select(ProcessedUpdate.update_key).where(ProcessedUpdate.created_at < cutoff).limit(batch_size)
+            ).all()
+            if not keys:
+                break
+            session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_key.in_(keys)))
+            session.commit()
+        deleted += len(keys)
+    if deleted:
+        logging.info(f'{deleted} processed update keys pruned.')
+    return deleted
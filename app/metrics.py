@@ -0,0 +1,87 @@
+# Standard library imports
+import logging
+import threading
+from collections import deque
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+
+class Summary:
+    """Count, total and recent samples of a measured value, for averages and percentiles."""
+
+    def __init__(self, samples=1000):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def percentile(self, fraction):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+        }
+
+
+class Metrics:
+    """
+    In-process counters and summaries.
+
+    Metrics are keyed by name plus optional labels, e.g. `metrics.observe('llm.prompt_tokens',
+    812, model='gpt-4o-mini')`. Recording is thread safe, since most measured calls run in
+    worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._summaries = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{label}={value}' for label, value in sorted(labels.items())) + '}'
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._summaries.setdefault(key, Summary()).observe(value)
+
+    def snapshot(self):
+        """Returns the current counters and summaries as plain dictionaries."""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'summaries': {key: summary.as_dict() for key, summary in self._summaries.items()},
+            }
+
+    def log_snapshot(self):
+        snapshot = self.snapshot()
+        for key, value in sorted(snapshot['counters'].items()):
+            logging.info(f'metric {key} = {value}')
+        for key, summary in sorted(snapshot['summaries'].items()):
+            logging.info(f"metric {key}: count={summary['count']} avg={summary['avg']:.4g} "
+                         f"p50={summary['p50']:.4g} p95={summary['p95']:.4g}")
+
+
+metrics = Metrics()
@@ -0,0 +1,223 @@
+# Standard library imports
+import logging
+
+# Third-party imports
+from sqlalchemy import inspect, text, select, update, func, bindparam
+
+# Local application imports
+from .db_utils import engine, Session
+from .models import (Base, Category, RecurringExpense, GsheetRow, GsheetBlock, ProcessedUpdate, BotUserData,
+                     BotConversation, EXPENSES_FTS_DDL)
+from .categories import normalize_category_name
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Online schema changes on MySQL: no table copy, reads and writes keep flowing
+ONLINE_DDL = ', ALGORITHM=INPLACE, LOCK=NONE'
+# InnoDB builds FULLTEXT indexes in place but cannot take writes meanwhile, reads keep flowing
+FULLTEXT_DDL = ', ALGORITHM=INPLACE, LOCK=SHARED'
+
+# Tables added after the first release, with no data to migrate
+NEW_TABLES = [RecurringExpense, GsheetRow, GsheetBlock, ProcessedUpdate, BotUserData, BotConversation]
+
+
+def _columns(table_name):
+    return {column['name'] for column in inspect(engine).get_columns(table_name)}
+
+
+def _indexes(table_name):
+    inspector = inspect(engine)
+    indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+    return indexes | {constraint['name'] for constraint in inspector.get_unique_constraints(table_name)}
+
+
+def migrate_category_normalized_names(batch_size=1000):
+    """
+    Adds and backfills categories.name_normalized, then enforces uniqueness per user.
+
+    The column is added as nullable, filled in short batches, and only made NOT NULL and
+    unique once every row has a value, so the table stays writable during the migration.
+
+    Args:
+        batch_size (int): The number of rows updated per transaction.
+
+    Raises:
+        RuntimeError: If existing categories collide once normalized; they must be renamed first.
+    """
+    if 'name_normalized' not in _columns('categories'):
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE categories ADD COLUMN name_normalized VARCHAR(100) NULL{ONLINE_DDL}'))
+        logging.info('Added categories.name_normalized.')
+
+    backfilled = 0
+    while True:
+        with Session() as session:
+            rows = session.execute(
+                select(Category.id, Category.name)
+                .where(Category.name_normalized.is_(None))
+                .order_by(Category.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            session.connection().execute(
+                update(Category.__table__)
+                .where(Category.__table__.c.id == bindparam('category_id'))
+                .values(name_normalized=bindparam('normalized')),
+                [{'category_id': row.id, 'normalized': normalize_category_name(row.name)} for row in rows]
+            )
+            session.commit()
+            backfilled += len(rows)
+    logging.info(f'Backfilled name_normalized for {backfilled} categories.')
+
+    if 'uq_categories_user_name' in _indexes('categories'):
+        return
+
+    with Session() as session:
+        duplicates = session.execute(
+            select(Category.user_id, Category.name_normalized, func.count(Category.id))
+            .group_by(Category.user_id, Category.name_normalized)
+            .having(func.count(Category.id) > 1)
+        ).all()
+    if duplicates:
+        for user_id, name, count in duplicates:
+            logging.error(f'User {user_id} has {count} categories named {name}.')
+        raise RuntimeError(f'{len(duplicates)} duplicated categories must be renamed before adding the unique constraint')
+
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE categories MODIFY name_normalized VARCHAR(100) NOT NULL{ONLINE_DDL}'))
+        connection.execute(text(f'ALTER TABLE categories ADD UNIQUE INDEX uq_categories_user_name (user_id, name_normalized){ONLINE_DDL}'))
+        if 'ix_categories_user_active' not in _indexes('categories'):
+            connection.execute(text(f'ALTER TABLE categories ADD INDEX ix_categories_user_active (user_id, active){ONLINE_DDL}'))
+    logging.info('Unique constraint on categories (user_id, name_normalized) created.')
+
+
+def migrate_expense_amounts_to_cents(batch_size=5000):
+    """
+    Moves expenses from the float `amount` column to integer `amount_cents` plus `currency`.
+
+    The new columns are added as nullable and backfilled by primary key ranges in short
+    transactions (rounding in SQL, so values never round-trip through Python floats).
+    Rows inserted by the previous release while the backfill runs are picked up by a final
+    pass. Once every row has cents the columns are made NOT NULL, the legacy column becomes
+    nullable so new inserts can omit it, and the covering index for totals is added.
+    The legacy `amount` column can be dropped once no older release is running.
+
+    Args:
+        batch_size (int): The number of primary keys covered per transaction.
+    """
+    columns = _columns('expenses')
+    with engine.begin() as connection:
+        if 'amount_cents' not in columns:
+            connection.execute(text(f'ALTER TABLE expenses ADD COLUMN amount_cents BIGINT NULL{ONLINE_DDL}'))
+        if 'currency' not in columns:
+            connection.execute(text(f"ALTER TABLE expenses ADD COLUMN currency VARCHAR(3) NULL DEFAULT 'EUR'{ONLINE_DDL}"))
+    if 'amount' not in columns:
+        return
+
+    def backfill():
+        with engine.connect() as connection:
+            max_id = connection.execute(text('SELECT MAX(id) FROM expenses')).scalar() or 0
+        updated = 0
+        for start in range(0, max_id + 1, batch_size):
+            with engine.begin() as connection:
+                result = connection.execute(
+                    text('UPDATE expenses SET amount_cents = ROUND(amount * 100), currency = COALESCE(currency, :currency) '
+                         'WHERE id >= :start AND id < :end AND amount_cents IS NULL'),
+                    {'start': start, 'end': start + batch_size, 'currency': 'EUR'}
+                )
+                updated += result.rowcount
+        return updated
+
+    updated = backfill()
+    # Catch rows written by the previous release during the first pass
+    updated += backfill()
+    logging.info(f'Backfilled amount_cents for {updated} expenses.')
+
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE expenses MODIFY amount DOUBLE NULL{ONLINE_DDL}'))
+        connection.execute(text(f"ALTER TABLE expenses MODIFY amount_cents BIGINT NOT NULL, "
+                                f"MODIFY currency VARCHAR(3) NOT NULL DEFAULT 'EUR'{ONLINE_DDL}"))
+        if 'ix_expenses_user_date_amount' not in _indexes('expenses'):
+            connection.execute(text('ALTER TABLE expenses ADD INDEX ix_expenses_user_date_amount '
+                                    f'(user_id, date, currency, amount_cents){ONLINE_DDL}'))
+    logging.info('Expense amounts migrated to integer cents.')
+
+
+def migrate_gsheet_backfill_checkpoint():
+    """
+    Adds the backfill checkpoint columns to the gsheet table.
+    """
+    columns = _columns('gsheet')
+    with engine.begin() as connection:
+        if 'backfill_last_expense_id' not in columns:
+            connection.execute(text(f'ALTER TABLE gsheet ADD COLUMN backfill_last_expense_id INT NULL{ONLINE_DDL}'))
+        if 'backfill_rows' not in columns:
+            connection.execute(text(f'ALTER TABLE gsheet ADD COLUMN backfill_rows INT NOT NULL DEFAULT 0{ONLINE_DDL}'))
+    logging.info('Backfill checkpoint columns added to gsheet.')
+
+
+def migrate_new_tables():
+    """
+    Creates the tables added after the first release, with their indexes.
+
+    They start empty, so creating them never blocks the existing tables. Tables that
+    already exist are left as they are.
+    """
+    existing = set(inspect(engine).get_table_names())
+    missing = [model.__table__ for model in NEW_TABLES if model.__tablename__ not in existing]
+    Base.metadata.create_all(engine, tables=missing)
+    logging.info(f'Created tables: {[table.name for table in missing]}.')
+
+
+def migrate_expense_indexes():
+    """
+    Adds the expenses indexes used by the history pages, the totals and the search.
+
+    The B-tree indexes are added online. On MySQL the FULLTEXT index on the descriptions
+    holds writes to expenses while it is built, so run it off-peak. On SQLite the search
+    uses the expenses_fts table instead, which is created and filled from the existing rows.
+    """
+    indexes = _indexes('expenses')
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as connection:
+            if 'ix_expenses_user_created_id' not in indexes:
+                connection.execute(text('CREATE INDEX ix_expenses_user_created_id ON expenses (user_id, created_at, id)'))
+            if 'ix_expenses_user_date_amount' not in indexes:
+                connection.execute(text('CREATE INDEX ix_expenses_user_date_amount '
+                                        'ON expenses (user_id, date, currency, amount_cents)'))
+            if 'expenses_fts' not in inspect(connection).get_table_names():
+                for statement in EXPENSES_FTS_DDL:
+                    connection.execute(text(statement))
+                connection.execute(text("INSERT INTO expenses_fts(expenses_fts) VALUES ('rebuild')"))
+        logging.info('Expense indexes added.')
+        return
+
+    with engine.begin() as connection:
+        if 'ix_expenses_user_created_id' not in indexes:
+            connection.execute(text('ALTER TABLE expenses ADD INDEX ix_expenses_user_created_id '
+                                    f'(user_id, created_at, id){ONLINE_DDL}'))
+        if 'ix_expenses_user_date_amount' not in indexes:
+            connection.execute(text('ALTER TABLE expenses ADD INDEX ix_expenses_user_date_amount '
+                                    f'(user_id, date, currency, amount_cents){ONLINE_DDL}'))
+        if 'ix_expenses_description_fulltext' not in indexes:
+            connection.execute(text('ALTER TABLE expenses ADD FULLTEXT INDEX ix_expenses_description_fulltext '
+                                    f'(description){FULLTEXT_DDL}'))
+    logging.info('Expense indexes added.')
+
+
+if __name__ == '__main__':
+    print("Migrating categories...")
+    migrate_category_normalized_names()
+    print("Migrating expense amounts...")
+    migrate_expense_amounts_to_cents()
+    print("Migrating Google Sheets settings...")
+    migrate_gsheet_backfill_checkpoint()
+    print("Creating new tables...")
+    migrate_new_tables()
+    print("Adding expense indexes...")
+    migrate_expense_indexes()
+    print("Migrations completed successfully.")
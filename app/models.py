@@ -3,7 +3,7 @@ from datetime import datetime
 import logging
 
 # Third-party imports
-from sqlalchemy import  Column, Integer, String, DateTime, Float, Boolean
+from sqlalchemy import  Column, Integer, BigInteger, String, Text, DateTime, Boolean, Index, UniqueConstraint, DDL, event
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -36,10 +36,16 @@ class User(Base):
 ## CATEGORIES
 class Category(Base):
     __tablename__ = 'categories'
+    __table_args__ = (
+        # A user cannot have two categories whose names only differ by case or spacing
+        UniqueConstraint('user_id', 'name_normalized', name='uq_categories_user_name'),
+        Index('ix_categories_user_active', 'user_id', 'active'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     name = Column(String(100), nullable=False)
+    name_normalized = Column(String(100), nullable=False)
     description = Column(String(300))
     active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -49,9 +55,19 @@ class Category(Base):
 ## EXPENSES
 class Expense(Base):
     __tablename__ = 'expenses'
+    __table_args__ = (
+        # Keyset pagination of a user's history: (user_id, created_at, id)
+        Index('ix_expenses_user_created_id', 'user_id', 'created_at', 'id'),
+        # Covers per-user totals over a date range without touching the table rows
+        Index('ix_expenses_user_date_amount', 'user_id', 'date', 'currency', 'amount_cents'),
+        # Word search over the descriptions, SQLite uses the expenses_fts table below instead
+        Index('ix_expenses_description_fulltext', 'description', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
     id = Column(Integer, primary_key=True)
-    amount = Column(Float, nullable=False)
+    # Amount in minor units (cents) of `currency`
+    amount_cents = Column(BigInteger, nullable=False)
+    currency = Column(String(3), nullable=False, default='EUR')
     user_id = Column(Integer, nullable=False)
     category_id = Column(Integer, nullable=False)
     description = Column(String(300))
@@ -59,6 +75,45 @@ class Expense(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+# SQLite has no FULLTEXT indexes: an FTS5 table indexes the descriptions, kept in step with triggers
+EXPENSES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(description, content='expenses', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN "
+    "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF description ON expenses BEGIN "
+    "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); "
+    "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END",
+]
+for statement in EXPENSES_FTS_DDL:
+    event.listen(Expense.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+## RECURRING EXPENSES
+class RecurringExpense(Base):
+    __tablename__ = 'recurring_expenses'
+    __table_args__ = (
+        # The scheduler selects every due rule with one range scan on this index
+        Index('ix_recurring_expenses_due', 'active', 'next_run'),
+        Index('ix_recurring_expenses_user', 'user_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    amount_cents = Column(BigInteger, nullable=False)
+    currency = Column(String(3), nullable=False, default='EUR')
+    category_id = Column(Integer, nullable=False)
+    description = Column(String(300))
+    frequency = Column(String(10), nullable=False)
+    # Occurrences are computed from the start date, so monthly rules do not drift after short months
+    start_date = Column(DateTime, nullable=False)
+    runs = Column(Integer, nullable=False, default=0)
+    next_run = Column(DateTime, nullable=False)
+    active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 ## GSHEET
 class UserGoogleSheetsCredentials(Base):
     __tablename__ = 'gsheet'
@@ -69,11 +124,62 @@ class UserGoogleSheetsCredentials(Base):
     token_expiry = Column(DateTime)
     spreadsheet_id = Column(String(255))
     sheet_name = Column(String(30))
+    # Backfill checkpoint: last expense exported and number of data rows written below the header
+    backfill_last_expense_id = Column(Integer)
+    backfill_rows = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class GsheetRow(Base):
+    __tablename__ = 'gsheet_rows'
+    __table_args__ = (
+        Index('ix_gsheet_rows_user_row', 'user_id', 'row_number'),
+    )
+
+    # One entry per expense exported to the user's sheet, with the content hash both sides agreed on
+    user_id = Column(Integer, primary_key=True)
+    expense_id = Column(Integer, primary_key=True)
+    row_number = Column(Integer, nullable=False)
+    content_hash = Column(String(40), nullable=False)
+    synced_at = Column(DateTime, nullable=False)
+
+
+class GsheetBlock(Base):
+    __tablename__ = 'gsheet_blocks'
+
+    # Last fingerprint read for each block of sheet rows, a block is only re-read when it changes
+    user_id = Column(Integer, primary_key=True)
+    block = Column(Integer, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+
+## UPDATE DEDUPLICATION
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+
+    # 'u<update_id>' or 'q<callback query id>', kept for a day so redeliveries after a restart are dropped
+    update_key = Column(String(40), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+## BOT PERSISTENCE
+class BotUserData(Base):
+    __tablename__ = 'bot_user_data'
+
+    telegram_user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class BotConversation(Base):
+    __tablename__ = 'bot_conversations'
+
+    name = Column(String(50), primary_key=True)
+    conversation_key = Column(String(100), primary_key=True)
+    state = Column(String(255), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 if __name__ == '__main__':
     print("Creating tables...")
     Base.metadata.create_all(engine)
     print("Tables created successfully.")
-    print("Execute: ALTER TABLE users AUTO_INCREMENT = 10000 on database console")
\ No newline at end of file
+    print("Execute: ALTER TABLE users AUTO_INCREMENT = 10000 on database console")
+    print("Existing databases are upgraded with: python -m app.migrations")
\ No newline at end of file
@@ -0,0 +1,206 @@
+# Standard library imports
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from collections import OrderedDict
+
+# Third-party imports
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from telegram.ext import BasePersistence, PersistenceInput
+
+# Local application imports
+from .db_utils import Session
+from .models import BotUserData, BotConversation
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Number of users remembered as loaded, the least recently seen are loaded again on their next update
+PERSISTENCE_LOADED_USERS = int(os.getenv('PERSISTENCE_LOADED_USERS', 10000))
+
+
+def _upsert(session, model, rows, columns):
+    # Both upserts are one statement, the syntax depends on the database
+    if session.get_bind().dialect.name == 'sqlite':
+        stmt = sqlite_insert(model).values(rows)
+        return stmt.on_conflict_do_update(index_elements=list(model.__table__.primary_key.columns),
+                                          set_={column: stmt.excluded[column] for column in columns})
+    stmt = mysql_insert(model).values(rows)
+    return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns})
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Stores `user_data` and the states of persistent ConversationHandlers in the database.
+
+    Writes are coalesced: the application hands over the entries that changed every
+    `update_interval` seconds, and each batch is written in a single transaction off the
+    event loop. `user_data` is loaded lazily, the first time an update for a user arrives.
+    Conversation states are small (only flows in progress are stored) and are loaded eagerly.
+    """
+
+    def __init__(self, update_interval=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval or float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', 0.3)),
+        )
+        self._dirty_user_data = {}
+        self._dirty_conversations = {}
+        # Telegram user ID -> None, least recently seen first
+        self._loaded_users = OrderedDict()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    ## WRITE BEHIND
+    def _schedule_flush(self):
+        # All the update_* calls of one persistence cycle run before this task, so one
+        # flush covers the whole cycle
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_dirty())
+
+    async def _flush_dirty(self):
+        async with self._flush_lock:
+            await asyncio.sleep(0)
+            # Entries marked dirty while a write is running are picked up by the next round
+            while self._dirty_user_data or self._dirty_conversations:
+                user_data, self._dirty_user_data = self._dirty_user_data, {}
+                conversations, self._dirty_conversations = self._dirty_conversations, {}
+                try:
+                    await asyncio.to_thread(self._write, user_data, conversations)
+                except SQLAlchemyError as e:
+                    logging.error(f'Error flushing bot persistence, will retry on next cycle: {e}')
+                    # Newer values written in the meantime win over the ones we failed to store
+                    self._dirty_user_data = {**user_data, **self._dirty_user_data}
+                    self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                    return
+
+    @staticmethod
+    def _write(user_data, conversations):
+        now = datetime.utcnow()
+        with Session() as session:
+            upserts = [
+                {'telegram_user_id': user_id, 'data': json.dumps(data, default=str), 'updated_at': now}
+                for user_id, data in user_data.items() if data is not None
+            ]
+            if upserts:
+                session.execute(_upsert(session, BotUserData, upserts, ['data', 'updated_at']))
+
+            drops = [user_id for user_id, data in user_data.items() if data is None]
+            if drops:
+                session.execute(delete(BotUserData).where(BotUserData.telegram_user_id.in_(drops)))
+
+            states = [
+                {'name': name, 'conversation_key': key, 'state': json.dumps(state), 'updated_at': now}
+                for (name, key), state in conversations.items() if state is not None
+            ]
+            if states:
+                session.execute(_upsert(session, BotConversation, states, ['state', 'updated_at']))
+
+            ended = [(name, key) for (name, key), state in conversations.items() if state is None]
+            if ended:
+                session.execute(delete(BotConversation).where(
+                    tuple_(BotConversation.name, BotConversation.conversation_key).in_(ended)))
+
+            session.commit()
+        logging.debug(f'Bot persistence flushed: {len(user_data)} users, {len(conversations)} conversations.')
+
+    ## USER DATA
+    async def get_user_data(self):
+        # Loaded lazily in refresh_user_data
+        return {}
+
+    def _mark_loaded(self, user_id):
+        self._loaded_users[user_id] = None
+        self._loaded_users.move_to_end(user_id)
+        while len(self._loaded_users) > PERSISTENCE_LOADED_USERS:
+            self._loaded_users.popitem(last=False)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            self._loaded_users.move_to_end(user_id)
+            return
+        self._mark_loaded(user_id)
+        # Loaded before and forgotten: the stored copy is older than unflushed changes in memory
+        if user_id in self._dirty_user_data:
+            return
+
+        def load():
+            with Session() as session:
+                return session.scalar(select(BotUserData.data).where(BotUserData.telegram_user_id == user_id))
+
+        try:
+            stored = await asyncio.to_thread(load)
+        except SQLAlchemyError as e:
+            self._loaded_users.pop(user_id, None)
+            logging.error(f'Error loading persisted user data of {user_id}: {e}')
+            return
+
+        if stored:
+            for key, value in json.loads(stored).items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        self._dirty_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_user_data[user_id] = None
+        self._loaded_users.pop(user_id, None)
+        self._schedule_flush()
+
+    ## CONVERSATIONS
+    async def get_conversations(self, name):
+        def load():
+            with Session() as session:
+                return session.execute(
+                    select(BotConversation.conversation_key, BotConversation.state)
+                    .where(BotConversation.name == name)
+                ).all()
+
+        rows = await asyncio.to_thread(load)
+        logging.info(f'Loaded {len(rows)} persisted {name} conversations.')
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+
+    ## NOT STORED
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,186 @@
+# Standard library imports
+import os
+import logging
+import itertools
+import threading
+from datetime import datetime
+from collections import OrderedDict, deque, namedtuple
+
+# Third-party imports
+from sqlalchemy import select
+
+# Local application imports
+from .db_utils import Session
+from .models import Expense, Category
+from .categories import get_category_version
+from .records import ExpenseRecord
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Most recent expenses kept per user, a bit more than a page so a few deletions do not force a reload
+RECENT_EXPENSES_SIZE = int(os.getenv('RECENT_EXPENSES_SIZE', 10))
+# Number of users whose recent expenses are kept in memory
+RECENT_CACHE_USERS = int(os.getenv('RECENT_CACHE_USERS', 1000))
+# Number of users whose last change is remembered, to tell loads that raced a change
+RECENT_GENERATION_USERS = int(os.getenv('RECENT_GENERATION_USERS', 10000))
+
+RecentExpense = namedtuple('RecentExpense', ['id', 'amount_cents', 'currency', 'category_id', 'description',
+                                             'date', 'created_at'])
+
+
+def as_datetime(value):
+    """Expense dates arrive as 'YYYY-MM-DD' strings from the bot flows, the database returns datetimes."""
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return value
+
+
+class RecentExpenses:
+    """
+    Ring buffer of a user's most recent expenses, newest first, with their category names.
+
+    `complete` tells that the buffer holds all the user's expenses, so reading fewer rows
+    than requested is an answer, not a reason to go back to the database.
+    """
+
+    def __init__(self, expenses, complete, category_names, category_version):
+        self.expenses = deque(expenses, maxlen=RECENT_EXPENSES_SIZE)
+        self.complete = complete
+        self.category_names = category_names
+        self.category_version = category_version
+
+    def covers(self, count):
+        return len(self.visible()) >= count or self.complete
+
+    def add(self, expense):
+        if any(known.id == expense.id for known in self.expenses):
+            return
+        if len(self.expenses) == self.expenses.maxlen:
+            # The oldest one is pushed out
+            self.complete = False
+        self.expenses.appendleft(expense)
+
+    def remove(self, expense_id):
+        for expense in self.expenses:
+            if expense.id == expense_id:
+                self.expenses.remove(expense)
+                return
+
+    def visible(self):
+        # Like the queries, which join on the category, expenses of deleted categories are left out
+        return [ExpenseRecord(expense.id, expense.amount_cents, expense.currency,
+                              self.category_names[expense.category_id], expense.description,
+                              expense.date, expense.created_at)
+                for expense in self.expenses if expense.category_id in self.category_names]
+
+
+_buffers = OrderedDict()
+_buffers_lock = threading.Lock()
+# User ID -> generation of the user's last change. A buffer loaded while the user's expenses
+# changed may have missed the change, so it is only cached if the generation did not move
+# meanwhile. Generations come from one increasing counter and the least recently changed
+# users are forgotten: a forgotten user reads as the last generation forgotten, which is
+# never lower than the one a running load saw, so a forgotten change still counts as a change
+_generations = OrderedDict()
+_generation_counter = itertools.count(1)
+_forgotten_generation = 0
+
+
+def _bump_generation(user_id):
+    # Called with _buffers_lock held
+    global _forgotten_generation
+    _generations[user_id] = next(_generation_counter)
+    _generations.move_to_end(user_id)
+    while len(_generations) > RECENT_GENERATION_USERS:
+        _, _forgotten_generation = _generations.popitem(last=False)
+
+
+def _generation(user_id):
+    # Called with _buffers_lock held
+    return _generations.get(user_id, _forgotten_generation)
+
+
+def _load_category_names(session, user_id):
+    return dict(session.execute(select(Category.id, Category.name).where(Category.user_id == user_id)).all())
+
+
+def _load(user_id):
+    # Own session on the primary: the buffer must hold committed rows only, the changes of a
+    # running unit of work are added when it commits, and a lagging replica could miss them
+    version = get_category_version(user_id)
+    with Session() as session:
+        rows = session.execute(
+            select(Expense.id, Expense.amount_cents, Expense.currency, Expense.category_id, Expense.description,
+                   Expense.date, Expense.created_at)
+            .join(Category, Expense.category_id == Category.id)
+            .where(Expense.user_id == user_id)
+            .order_by(Expense.created_at.desc(), Expense.id.desc())
+            .limit(RECENT_EXPENSES_SIZE)
+        ).all()
+        names = _load_category_names(session, user_id)
+    return RecentExpenses([RecentExpense._make(row) for row in rows], len(rows) < RECENT_EXPENSES_SIZE,
+                          names, version)
+
+
+def get_recent_expenses(user_id, count):
+    """
+    Returns a user's most recent expenses, loading them on first access.
+
+    Args:
+        user_id (int): The ID of the user.
+        count (int): The number of expenses wanted, at most RECENT_EXPENSES_SIZE.
+
+    Returns:
+        tuple: (expenses, has_more) where expenses is a list of up to `count` ExpenseRecord
+               tuples, newest first, and has_more tells whether the user has older expenses.
+    """
+    with _buffers_lock:
+        buffer = _buffers.get(user_id)
+        if buffer is not None:
+            _buffers.move_to_end(user_id)
+        generation = _generation(user_id)
+
+    # A category change can hide expenses, the buffer is then loaded again
+    if buffer is None or buffer.category_version != get_category_version(user_id) or not buffer.covers(count + 1):
+        buffer = _load(user_id)
+        with _buffers_lock:
+            if _generation(user_id) == generation:
+                _buffers[user_id] = buffer
+                while len(_buffers) > RECENT_CACHE_USERS:
+                    _buffers.popitem(last=False)
+
+    with _buffers_lock:
+        expenses = buffer.visible()
+    return expenses[:count], len(expenses) > count
+
+
+def remember_expenses(user_id, expenses):
+    """Adds new expenses (RecentExpense tuples, oldest first) to the user's buffer, if it is loaded."""
+    with _buffers_lock:
+        _bump_generation(user_id)
+        buffer = _buffers.get(user_id)
+        if buffer is not None:
+            for expense in expenses:
+                buffer.add(expense)
+
+
+def forget_expense(user_id, expense_id):
+    """Removes a deleted expense from the user's buffer, if it is loaded."""
+    with _buffers_lock:
+        _bump_generation(user_id)
+        buffer = _buffers.get(user_id)
+        if buffer is not None:
+            buffer.remove(expense_id)
+
+
+def invalidate_recent_expenses(user_id):
+    """Drops a user's buffer, e.g. after expenses were changed in bulk. It is reloaded on next access."""
+    with _buffers_lock:
+        _bump_generation(user_id)
+        _buffers.pop(user_id, None)
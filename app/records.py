@@ -0,0 +1,14 @@
+# Standard library imports
+from collections import namedtuple
+
+# Read models returned by the query helpers: plain immutable tuples holding only the
+# selected columns, with no session, identity map or change tracking behind them.
+
+# A category, as listed in keyboards and prompts
+CategoryRecord = namedtuple('CategoryRecord', ['name', 'id'])
+
+# An expense with its category name, as listed in the expense history
+ExpenseRecord = namedtuple('ExpenseRecord', ['id', 'amount_cents', 'currency', 'name', 'description', 'date', 'created_at'])
+
+# An expense in short lists
+ExpenseSummary = namedtuple('ExpenseSummary', ['id', 'amount_cents', 'currency', 'name'])
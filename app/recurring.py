@@ -0,0 +1,182 @@
+# Standard library imports
+import logging
+from datetime import datetime
+
+# Third-party imports
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, insert, update, case
+from sqlalchemy.exc import SQLAlchemyError
+
+# Local application imports
+from .db_utils import Session, get_session, savepoint, commit, record_write
+from .recent import invalidate_recent_expenses
+from .models import RecurringExpense, Expense, User
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+FREQUENCIES = {
+    'weekly': relativedelta(weeks=1),
+    'monthly': relativedelta(months=1),
+    'yearly': relativedelta(years=1),
+}
+# Occurrences materialized per rule and tick when the bot was down for a while
+MAX_CATCH_UP = 12
+
+
+def _occurrence(start_date, frequency, runs):
+    return start_date + FREQUENCIES[frequency] * runs
+
+
+def create_recurring_from_expense(user_id, expense_id, frequency='monthly'):
+    """
+    Turns an existing expense into a recurring rule, starting one period after it.
+
+    Args:
+        user_id (int): The ID of the user who owns the expense.
+        expense_id (int): The ID of the expense to repeat.
+        frequency (str): One of 'weekly', 'monthly' or 'yearly'.
+
+    Returns:
+        int: The ID of the new rule, or None if the expense was not found or an error occurred.
+    """
+    if frequency not in FREQUENCIES:
+        logging.error(f'Unknown frequency {frequency} for user {user_id}.')
+        return None
+
+    try:
+        with get_session() as session, savepoint(session):
+            expense = session.execute(
+                select(Expense.amount_cents, Expense.currency, Expense.category_id, Expense.description,
+                       Expense.date, Expense.created_at)
+                .where(Expense.user_id == user_id, Expense.id == expense_id)
+            ).first()
+            if expense is None:
+                logging.info(f'No expense found with ID {expense_id} for user {user_id}.')
+                return None
+
+            # The expense itself is occurrence 0
+            start_date = expense.date or expense.created_at
+            rule = RecurringExpense(user_id=user_id, amount_cents=expense.amount_cents, currency=expense.currency,
+                                    category_id=expense.category_id, description=expense.description,
+                                    frequency=frequency, start_date=start_date, runs=1,
+                                    next_run=_occurrence(start_date, frequency, 1))
+            session.add(rule)
+            commit(session)
+            logging.info(f'Expense {expense_id} of user {user_id} now repeats {frequency} (rule {rule.id}).')
+            return rule.id
+
+    except Exception as e:
+        logging.error(f'Error making expense {expense_id} recurring for user {user_id}: {e}')
+        return None
+
+
+def deactivate_recurring_expense(user_id, rule_id):
+    """
+    Stops a recurring expense rule.
+
+    Args:
+        user_id (int): The ID of the user who owns the rule.
+        rule_id (int): The ID of the rule.
+
+    Returns:
+        bool: True if the rule was stopped, False otherwise.
+    """
+    try:
+        with get_session() as session, savepoint(session):
+            result = session.execute(
+                update(RecurringExpense)
+                .where(RecurringExpense.user_id == user_id, RecurringExpense.id == rule_id)
+                .values(active=False)
+            )
+            commit(session)
+            return result.rowcount > 0
+
+    except Exception as e:
+        logging.error(f'Error stopping recurring expense {rule_id} for user {user_id}: {e}')
+        return False
+
+
+def materialize_due_expenses(now=None, limit=500):
+    """
+    Creates the expenses of every recurring rule that is due.
+
+    Due rules are selected with one query on the (active, next_run) index, so the cost of
+    a tick depends on the number of due rules, not on the number of users. All the
+    resulting expenses are inserted with one multi-row statement and the rules are
+    advanced with one UPDATE, in a single transaction. Rows locked by another process
+    running the same job are skipped.
+
+    Args:
+        now (datetime, optional): The reference time, defaults to the current UTC time.
+        limit (int): The maximum number of rules handled per call.
+
+    Returns:
+        list: One tuple (chat_id, rule_id, amount_cents, currency, description, occurrences)
+              per rule that produced expenses.
+
+    Raises:
+        SQLAlchemyError: If there is a database related error.
+    """
+    now = now or datetime.utcnow()
+
+    try:
+        with Session() as session:
+            due_rules = session.execute(
+                select(RecurringExpense.id, RecurringExpense.user_id, RecurringExpense.amount_cents,
+                       RecurringExpense.currency, RecurringExpense.category_id, RecurringExpense.description,
+                       RecurringExpense.frequency, RecurringExpense.start_date, RecurringExpense.runs,
+                       RecurringExpense.next_run, User.chat_id)
+                .join(User, User.id == RecurringExpense.user_id)
+                .where(RecurringExpense.active == True, RecurringExpense.next_run <= now)
+                .order_by(RecurringExpense.next_run)
+                .limit(limit)
+                # Only the rules are locked: the users rows stay free for the users' own writes
+                .with_for_update(skip_locked=True, of=RecurringExpense)
+            ).all()
+            if not due_rules:
+                return []
+
+            expense_rows = []
+            runs = {}
+            next_runs = {}
+            notifications = []
+            for rule in due_rules:
+                occurrences = 0
+                rule_runs, occurrence = rule.runs, rule.next_run
+                while occurrence <= now and occurrences < MAX_CATCH_UP:
+                    expense_rows.append({
+                        'amount_cents': rule.amount_cents, 'currency': rule.currency,
+                        'user_id': rule.user_id, 'category_id': rule.category_id,
+                        'description': rule.description, 'date': occurrence,
+                        'created_at': now, 'updated_at': now,
+                    })
+                    occurrences += 1
+                    rule_runs += 1
+                    occurrence = _occurrence(rule.start_date, rule.frequency, rule_runs)
+
+                runs[rule.id] = rule_runs
+                next_runs[rule.id] = occurrence
+                notifications.append((rule.chat_id, rule.id, rule.amount_cents, rule.currency,
+                                      rule.description, occurrences))
+
+            session.execute(insert(Expense).values(expense_rows))
+            session.execute(
+                update(RecurringExpense)
+                .where(RecurringExpense.id.in_(list(runs)))
+                .values(runs=case(runs, value=RecurringExpense.id),
+                        next_run=case(next_runs, value=RecurringExpense.id))
+            )
+            session.commit()
+            for user_id in {rule.user_id for rule in due_rules}:
+                record_write(session, user_id)
+                invalidate_recent_expenses(user_id)
+
+            logging.info(f'Materialized {len(expense_rows)} expenses from {len(due_rules)} recurring rules.')
+            return notifications
+
+    except SQLAlchemyError as e:
+        logging.error(f'Error materializing recurring expenses: {e}')
+        raise
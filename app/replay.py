@@ -0,0 +1,126 @@
+# Standard library imports
+import os
+import json
+import time
+import logging
+import argparse
+from collections import Counter
+
+# Local application imports
+from .whispergpt import (openai_transcribe, extract_expenses, validate_expense_output, parse_expense_json,
+                         get_category_prompt, LLM_FAST_MODEL, LLM_STRONG_MODEL)
+from .expenses import parse_amount
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+ROUTES = ('strong', 'fast', 'auto')
+
+
+def load_transcripts(audio_dir, transcripts_path, user_id):
+    """
+    Transcribes the sample voice messages, reusing the transcripts saved by previous runs.
+
+    Args:
+        audio_dir (str): The directory holding the .ogg samples.
+        transcripts_path (str): The JSON file mapping sample file names to transcripts.
+        user_id (int): The ID of the user for logging.
+
+    Returns:
+        dict: Sample file name -> transcript.
+    """
+    transcripts = {}
+    if os.path.exists(transcripts_path):
+        with open(transcripts_path) as transcripts_file:
+            transcripts = json.load(transcripts_file)
+
+    for name in sorted(os.listdir(audio_dir)):
+        if not name.endswith('.ogg') or name in transcripts:
+            continue
+        transcript = openai_transcribe(os.path.join(audio_dir, name), user_id)
+        if transcript is not None:
+            transcripts[name] = transcript.text
+
+    with open(transcripts_path, 'w') as transcripts_file:
+        json.dump(transcripts, transcripts_file, indent=1, ensure_ascii=False)
+    return transcripts
+
+
+def expense_key(output):
+    """Reduces an extraction to its (amount in cents, category ID) pairs, for comparisons."""
+    parsed = parse_expense_json(output) if output else None
+    if not parsed:
+        return None
+    try:
+        return sorted((parse_amount(amount), int(category_id)) for amount, category_id, _, _, _ in parsed)
+    except (ValueError, TypeError):
+        return None
+
+
+def replay(user_id, transcripts):
+    """
+    Runs every transcript through each route and compares the results with the strong model.
+
+    There are no hand-made labels for the samples, so the strong model output is the
+    reference: a route is accurate on a sample when it extracts the same amounts and categories.
+
+    Args:
+        user_id (int): The ID of the user whose categories are used.
+        transcripts (dict): Sample file name -> transcript.
+
+    Returns:
+        dict: Route -> list of per-sample results.
+    """
+    category_ids = {cat_id for _, cat_id in get_category_prompt(user_id)[0]}
+    results = {route: [] for route in ROUTES}
+
+    for name, transcript in sorted(transcripts.items()):
+        reference = None
+        for route in ROUTES:
+            started = time.monotonic()
+            output, served_by = extract_expenses(user_id, transcript, route=None if route == 'auto' else route)
+            latency = time.monotonic() - started
+
+            key = expense_key(output)
+            if route == 'strong':
+                reference = key
+            results[route].append({
+                'sample': name,
+                'served_by': served_by,
+                'latency': latency,
+                'valid': validate_expense_output(output, category_ids) is None,
+                'matches_reference': reference is not None and key == reference,
+            })
+    return results
+
+
+def format_report(results):
+    """Renders the per-route latency and accuracy table."""
+    lines = [f"Fast model: {LLM_FAST_MODEL}, strong model: {LLM_STRONG_MODEL}", "",
+             f"{'route':<8}{'samples':>8}{'valid':>8}{'match':>8}{'avg s':>8}{'p95 s':>8}  served by"]
+    for route, rows in results.items():
+        if not rows:
+            continue
+        latencies = sorted(row['latency'] for row in rows)
+        p95 = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
+        valid = sum(row['valid'] for row in rows) / len(rows)
+        matches = sum(row['matches_reference'] for row in rows) / len(rows)
+        served_by = ', '.join(f'{served}={count}' for served, count in Counter(row['served_by'] for row in rows).most_common())
+        lines.append(f"{route:<8}{len(rows):>8}{valid:>8.0%}{matches:>8.0%}"
+                     f"{sum(latencies) / len(latencies):>8.2f}{p95:>8.2f}  {served_by}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays the sample voice messages through each model route.')
+    parser.add_argument('--user-id', type=int, required=True, help='user whose categories are used')
+    parser.add_argument('--audio-dir', default='audio')
+    parser.add_argument('--transcripts', default='audio/transcripts.json')
+    args = parser.parse_args()
+
+    print("Transcribing samples...")
+    sample_transcripts = load_transcripts(args.audio_dir, args.transcripts, args.user_id)
+    print(f"Replaying {len(sample_transcripts)} samples...")
+    print(format_report(replay(args.user_id, sample_transcripts)))
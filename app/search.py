@@ -0,0 +1,138 @@
+# Standard library imports
+import re
+import logging
+
+# Third-party imports
+from sqlalchemy import select, and_, or_, func, text
+from sqlalchemy.dialects.mysql import match
+
+# Local application imports
+from .db_utils import get_read_session
+from .models import Expense, Category
+from .records import ExpenseRecord
+from .expenses import decode_expense_cursor
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+
+def parse_search_words(terms):
+    """
+    Splits search terms into words, dropping the punctuation the full-text syntaxes give a meaning to.
+
+    Args:
+        terms (str): The terms as typed by the user.
+
+    Returns:
+        list: The lowercase words.
+    """
+    return re.findall(r'\w+', terms.casefold())
+
+
+def _match_clause(session, words):
+    # Every word must match, as a prefix so "esse" finds "Esselunga"
+    if session.get_bind().dialect.name == 'sqlite':
+        fts_query = ' '.join(f'"{word}"*' for word in words)
+        return Expense.id.in_(text('SELECT rowid FROM expenses_fts WHERE expenses_fts MATCH :fts_query')
+                              .bindparams(fts_query=fts_query))
+    return match(Expense.description, against=' '.join(f'+{word}*' for word in words)).in_boolean_mode()
+
+
+def _filters(session, user_id, words, start_date, end_date, category_id):
+    filters = [Expense.user_id == user_id, _match_clause(session, words)]
+    if start_date is not None:
+        filters.append(Expense.date >= start_date)
+    if end_date is not None:
+        filters.append(Expense.date < end_date)
+    if category_id is not None:
+        filters.append(Expense.category_id == category_id)
+    return filters
+
+
+def search_expenses(user_id, terms, start_date=None, end_date=None, category_id=None, cursor=None, page_size=5):
+    """
+    Retrieves a page of a user's expenses whose description contains all the search words, newest first.
+
+    Matches come from the full-text index on the descriptions (FULLTEXT on MySQL, the
+    expenses_fts table on SQLite), never from a LIKE scan. Pages follow a (created_at, id)
+    cursor as in retrieve_expenses_page.
+
+    Args:
+        user_id (int): The ID of the user.
+        terms (str): The words to look for.
+        start_date (datetime, optional): Only expenses dated on or after this date.
+        end_date (datetime, optional): Only expenses dated before this date.
+        category_id (int, optional): Only expenses of this category.
+        cursor (str, optional): Encoded position of the last expense of the previous page. None for the first page.
+        page_size (int): The number of expenses per page.
+
+    Returns:
+        tuple: (expenses, has_more) where expenses is a list of ExpenseRecord tuples, or None if an error occurs.
+    """
+    words = parse_search_words(terms)
+    if not words:
+        return [], False
+
+    try:
+        with get_read_session(user_id) as session:
+            query = select(Expense.id, Expense.amount_cents, Expense.currency, Category.name, Expense.description,
+                           Expense.date, Expense.created_at)\
+                .join(Category, Expense.category_id == Category.id)\
+                .where(*_filters(session, user_id, words, start_date, end_date, category_id))
+
+            if cursor is not None:
+                created_at, expense_id = decode_expense_cursor(cursor)
+                query = query.where(or_(Expense.created_at < created_at,
+                                        and_(Expense.created_at == created_at, Expense.id < expense_id)))
+
+            # One extra row tells whether there is another page
+            rows = session.execute(query.order_by(Expense.created_at.desc(), Expense.id.desc())
+                                   .limit(page_size + 1)).all()
+            expenses = [ExpenseRecord._make(row) for row in rows]
+
+            logging.info(f"Expense search page retrieved for user {user_id}.")
+            return expenses[:page_size], len(expenses) > page_size
+
+    except Exception as e:
+        logging.error(f"Error searching expenses for user {user_id}: {e}")
+        return None
+
+
+def search_totals(user_id, terms, start_date=None, end_date=None, category_id=None):
+    """
+    Counts and sums, per currency, a user's expenses matching the search words.
+
+    Takes the same filters as search_expenses, so the totals describe exactly the listed expenses.
+
+    Args:
+        user_id (int): The ID of the user.
+        terms (str): The words to look for.
+        start_date (datetime, optional): Only expenses dated on or after this date.
+        end_date (datetime, optional): Only expenses dated before this date.
+        category_id (int, optional): Only expenses of this category.
+
+    Returns:
+        tuple: (count, totals) where totals maps currency code -> total amount in cents,
+               or None if an error occurs.
+    """
+    words = parse_search_words(terms)
+    if not words:
+        return 0, {}
+
+    try:
+        with get_read_session(user_id) as session:
+            rows = session.execute(
+                select(Expense.currency, func.count(Expense.id), func.sum(Expense.amount_cents))
+                .join(Category, Expense.category_id == Category.id)
+                .where(*_filters(session, user_id, words, start_date, end_date, category_id))
+                .group_by(Expense.currency)
+            ).all()
+
+            logging.info(f"Expense search totals computed for user {user_id}.")
+            return sum(count for _, count, _ in rows), {currency: int(total) for currency, _, total in rows}
+
+    except Exception as e:
+        logging.error(f"Error computing expense search totals for user {user_id}: {e}")
+        return None
@@ -0,0 +1,133 @@
+# Standard library imports
+import asyncio
+import logging
+
+# Third-party imports
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+# Local application imports
+from .db_utils import (begin_unit_of_work, end_unit_of_work, commit_unit_of_work, rollback_unit_of_work,
+                       unit_of_work_failed)
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently while keeping each user's updates in order.
+
+    Every user has a FIFO lock, so a user's updates run one at a time in the order they were
+    received, which is what the ConversationHandler flows expect. At most `max_workers`
+    updates run at the same time across all users. Updates waiting for their user's turn do
+    not hold a worker slot, so one busy user cannot starve the others.
+
+    Each update is a unit of work: the app helpers it calls share one database session and
+    the update's changes are committed once, after its handlers. Handlers that confirm a
+    change to the user commit it first, with app.db_utils.save_unit_of_work. An update whose
+    handler failed is rolled back instead (see app.db_utils.fail_unit_of_work).
+
+    With a `deduplicator` (see app.idempotency), resent updates and repeated button presses
+    are dropped here, before they wait for their turn or reach any handler.
+    """
+
+    def __init__(self, max_workers, max_pending=1024, deduplicator=None):
+        # The base semaphore only bounds the number of pending tasks, workers are limited below
+        super().__init__(max_concurrent_updates=max_pending)
+        self.max_workers = max_workers
+        self.deduplicator = deduplicator
+        self._workers = asyncio.Semaphore(max_workers)
+        self._user_locks = {}
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def _is_duplicate_in_memory(self, update):
+        if self.deduplicator is None or not isinstance(update, Update):
+            return False
+        return not self.deduplicator.claim_in_memory(update)
+
+    async def _is_duplicate_in_database(self, update):
+        if self.deduplicator is None or not isinstance(update, Update):
+            return False
+        return not await asyncio.to_thread(self.deduplicator.claim_in_database, update)
+
+    @staticmethod
+    async def _drop_duplicate(update, coroutine):
+        coroutine.close()
+        logging.info(f'Duplicate update {update.update_id} dropped.')
+        if update.callback_query is not None:
+            # Stops the loading indicator of the repeated press
+            try:
+                await update.callback_query.answer()
+            except TelegramError:
+                pass
+
+    @staticmethod
+    async def _run_unit_of_work(coroutine):
+        session, token = begin_unit_of_work()
+        try:
+            await coroutine
+        except Exception:
+            # The handlers' errors are caught by the Application and reach the error
+            # handler instead, which marks the unit of work with fail_unit_of_work
+            session.info['failed'] = True
+            raise
+        finally:
+            end_unit_of_work(token)
+            end = rollback_unit_of_work if unit_of_work_failed(session) else commit_unit_of_work
+            if session.in_transaction():
+                await asyncio.to_thread(end, session)
+            else:
+                end(session)
+
+    async def _process_unique(self, update, coroutine):
+        # The database claim waits in a worker thread, so it runs in the user's turn: awaited
+        # before the lock, threads finishing in any order would reorder the user's updates
+        if await self._is_duplicate_in_database(update):
+            await self._drop_duplicate(update, coroutine)
+            return
+        async with self._workers:
+            await self._run_unit_of_work(coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        if self._is_duplicate_in_memory(update):
+            await self._drop_duplicate(update, coroutine)
+            return
+
+        key = self._ordering_key(update)
+
+        if key is None:
+            await self._process_unique(update, coroutine)
+            return
+
+        # Lock entries are reference counted and dropped once nobody holds or waits for them.
+        # The entry is taken before the first await, in the order the updates arrived
+        lock, users = self._user_locks.get(key, (asyncio.Lock(), 0))
+        self._user_locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                await self._process_unique(update, coroutine)
+        finally:
+            lock, users = self._user_locks[key]
+            if users == 1:
+                del self._user_locks[key]
+            else:
+                self._user_locks[key] = (lock, users - 1)
+
+    async def initialize(self):
+        logging.info(f'Update processor started with {self.max_workers} workers.')
+
+    async def shutdown(self):
+        if self._user_locks:
+            logging.warning(f'Update processor shut down with {len(self._user_locks)} users still queued.')
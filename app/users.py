@@ -2,10 +2,11 @@
 import logging
 
 # Third-party imports
+from sqlalchemy import select, exists, delete
 from sqlalchemy.exc import SQLAlchemyError
 
 # Local application imports
-from .db_utils import Session, add_to_session_and_close
+from .db_utils import get_session, commit
 from .models import User
 
 # Configure logging
@@ -13,6 +14,10 @@ logging.basicConfig(filename='./logs/mylogs.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
+# Telegram ID -> internal user ID of registered users. The mapping never changes while
+# the user exists, so it is only dropped when the user is deleted.
+_user_id_cache = {}
+
 
 def get_user_id(telegram_id):
     """
@@ -24,11 +29,15 @@ def get_user_id(telegram_id):
     Returns:
         int: The internal user ID if the user is found, None otherwise.
     """
+    if telegram_id in _user_id_cache:
+        return _user_id_cache[telegram_id]
+
     try:
-        with Session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            if user:
-                return user.id
+        with get_session() as session:
+            user_id = session.scalar(select(User.id).where(User.telegram_id == telegram_id))
+            if user_id is not None:
+                _user_id_cache[telegram_id] = user_id
+                return user_id
             else:
                 logging.info(f'User with Telegram ID {telegram_id} not found.')
                 return None
@@ -37,6 +46,16 @@ def get_user_id(telegram_id):
         raise
 
 
+def preload_user_ids(user_ids):
+    """
+    Fills the Telegram ID cache from users loaded in bulk, e.g. at startup.
+
+    Args:
+        user_ids (dict): Telegram ID -> internal user ID.
+    """
+    _user_id_cache.update(user_ids)
+
+
 def is_user_registered(telegram_id):
     """
     Checks whether a user is registered based on the given Telegram ID.
@@ -51,11 +70,14 @@ def is_user_registered(telegram_id):
         SQLAlchemyError: If there is a database related error.
         Exception: For any other unexpected errors.
     """
+    if telegram_id in _user_id_cache:
+        return True
+
     try:
-        with Session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        with get_session() as session:
+            registered = session.scalar(select(exists().where(User.telegram_id == telegram_id)))
 
-            if user:
+            if registered:
                 logging.info(f'The User with telegram id: {telegram_id} is already registered.')
                 return True
             else:
@@ -93,11 +115,11 @@ def create_user(email, telegram_id, chat_id=None, first_name=None, last_name=Non
             logging.info("User already registered")
             raise
         else:
-            with Session() as session:
+            with get_session() as session:
                 new_user = User(telegram_id=telegram_id, chat_id=chat_id, email=email, 
                                 first_name=first_name, last_name=last_name)
                 session.add(new_user)
-                session.commit()
+                commit(session)
                 return new_user
 
     except SQLAlchemyError as e:
@@ -108,10 +130,17 @@ def create_user(email, telegram_id, chat_id=None, first_name=None, last_name=Non
         raise
 
 
+def forget_user_id(telegram_id):
+    """Drops a Telegram ID from the cache, once its user is deleted."""
+    _user_id_cache.pop(telegram_id, None)
+
+
 def delete_user(user_id):
     """
     Deletes a user based on the provided Telegram ID.
 
+    Only the users row is removed, app.accounts.delete_account removes an account with its data.
+
     Args:
         user_id (int): The ID of the user to be deleted.
 
@@ -123,12 +152,13 @@ def delete_user(user_id):
         Exception: For any other unexpected errors.
     """
     try:
-        with Session() as session:
-            user = session.query(User).filter(User.id == user_id).first()
+        with get_session() as session:
+            telegram_id = session.scalar(select(User.telegram_id).where(User.id == user_id))
 
-            if user:
-                session.delete(user)
-                session.commit()
+            if telegram_id is not None:
+                _user_id_cache.pop(telegram_id, None)
+                session.execute(delete(User).where(User.id == user_id))
+                commit(session)
                 logging.info(f'User with ID {user_id} deleted successfully.')
                 return True
             else:
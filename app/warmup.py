@@ -0,0 +1,104 @@
+# Standard library imports
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+
+# Third-party imports
+from sqlalchemy import select, text
+
+# Local application imports
+from .db_utils import Session, engine, replica_engines
+from .models import User, Category, Expense
+from .records import CategoryRecord
+from .users import preload_user_ids
+from .categories import get_category_version
+from .whispergpt import preload_category_prompts, warm_up_client
+
+# Configure logging
+logging.basicConfig(filename='./logs/mylogs.log',
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+# Users with an expense in the last WARMUP_ACTIVE_DAYS days are preloaded, up to WARMUP_MAX_USERS
+WARMUP_ACTIVE_DAYS = int(os.getenv('WARMUP_ACTIVE_DAYS', 7))
+WARMUP_MAX_USERS = int(os.getenv('WARMUP_MAX_USERS', 5000))
+
+
+def warm_up_pool(db_engine, connections):
+    """
+    Opens up to `connections` database connections, so the first updates find them ready in the pool.
+
+    Returns:
+        int: The number of connections opened.
+    """
+    # Connections beyond the pool size would be closed again on release
+    connections = min(connections, db_engine.pool.size()) if hasattr(db_engine.pool, 'size') else 1
+    opened = []
+    try:
+        for _ in range(connections):
+            connection = db_engine.connect()
+            opened.append(connection)
+            connection.execute(text('SELECT 1'))
+    finally:
+        for connection in opened:
+            connection.close()
+    return len(opened)
+
+
+def preload_active_users(days=WARMUP_ACTIVE_DAYS, max_users=WARMUP_MAX_USERS):
+    """
+    Loads the identity and active categories of recently active users, with one query each.
+
+    Returns:
+        int: The number of users preloaded.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    with Session() as session:
+        # A derived table, MySQL does not allow LIMIT in an IN subquery
+        recent = select(Expense.user_id).where(Expense.created_at >= cutoff).distinct().limit(max_users).subquery()
+        users = session.execute(select(User.telegram_id, User.id).join(recent, recent.c.user_id == User.id)).all()
+        user_ids = [user_id for _, user_id in users]
+        versions = {user_id: get_category_version(user_id) for user_id in user_ids}
+        categories = session.execute(
+            select(Category.user_id, Category.name, Category.id)
+            .where(Category.user_id.in_(user_ids), Category.active == True)
+        ).all() if user_ids else []
+
+    categories_by_user = {user_id: [] for user_id in user_ids}
+    for user_id, name, category_id in categories:
+        categories_by_user[user_id].append(CategoryRecord(name, category_id))
+
+    preload_user_ids(dict(users))
+    preload_category_prompts(categories_by_user, versions)
+    return len(users)
+
+
+def warm_up(connections):
+    """
+    Warms the caches, the database pools and the OpenAI connection before updates are accepted.
+
+    Every step is independent: a failing one is logged and the others still run.
+
+    Args:
+        connections (int): The number of database connections to open per engine.
+
+    Returns:
+        dict: Step name -> result, or None for the steps that failed.
+    """
+    steps = {
+        'db_connections': lambda: warm_up_pool(engine, connections),
+        'replica_connections': lambda: sum(warm_up_pool(replica, connections) for replica in replica_engines),
+        'users': preload_active_users,
+        'openai': warm_up_client,
+    }
+    results = {}
+    for name, step in steps.items():
+        started = time.monotonic()
+        try:
+            results[name] = step()
+            logging.info(f'Warm-up {name}: {results[name]} in {time.monotonic() - started:.2f}s.')
+        except Exception as e:
+            results[name] = None
+            logging.error(f'Warm-up {name} failed: {e}')
+    return results
@@ -1,7 +1,12 @@
 import os
+import re
 import json
+import time
 import logging
+import threading
 from datetime import datetime
+from collections import OrderedDict
+from decimal import Decimal
 import openai
 from openai import OpenAIError
 
@@ -14,12 +19,55 @@ logging.basicConfig(filename='./logs/mylogs.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=os.getenv('OPENAI_KEY'))
+from .http_pools import openai_http_client
+
+# Initialize OpenAI client. The timeout is kept short so that a degraded API surfaces as
+# a failure quickly instead of holding the voice path for the default ten minutes.
+# Connections come from a shared keep-alive pool, see app/http_pools.py.
+client = openai.OpenAI(api_key=os.getenv('OPENAI_KEY'),
+                       timeout=float(os.getenv('OPENAI_TIMEOUT', 20)),
+                       max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 1)),
+                       http_client=openai_http_client(read_timeout=float(os.getenv('OPENAI_TIMEOUT', 20))))
 
 # Import local modules
-from .categories import get_categories_and_id
-from .expenses import add_expense
+from .categories import get_categories_and_id, get_category_version, has_uncommitted_category_changes
+from .metrics import metrics
+from .expenses import parse_amount
+from .classifier import get_classifier, tokenize
+
+# Local category classifier: above this probability the category is taken without asking GPT,
+# and GPT is only shown the top categories covering CLASSIFIER_TOP_K_COVERAGE of the probability
+CLASSIFIER_SKIP_CONFIDENCE = float(os.getenv('CLASSIFIER_SKIP_CONFIDENCE', 0.9))
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv('CLASSIFIER_MIN_EXAMPLES', 5))
+CLASSIFIER_TOP_K = int(os.getenv('CLASSIFIER_TOP_K', 3))
+CLASSIFIER_TOP_K_COVERAGE = float(os.getenv('CLASSIFIER_TOP_K_COVERAGE', 0.95))
+
+# Static instructions, identical for every user and call, so they form a cacheable prompt prefix.
+# Everything that varies (date, categories, transcript) comes after them.
+EXPENSE_SYSTEM_PROMPT = (
+    "You extract expenses from a user's message for a budget app. Reply with JSON only: "
+    '{"expenses":[{"amount":decimal,"category_id":int,"description":string,"date":"YYYY-MM-DD","error":string|null}]}, '
+    "one entry per expense mentioned. category_id must be one of the listed ids. "
+    "description is a few words. date defaults to today. "
+    "If unsure about a field, set it to null and explain in error, with suggestions, in the user's language."
+)
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv('LLM_MAX_OUTPUT_TOKENS', 400))
+
+# Model routing: simple transcripts go to the fast model, which escalates to the strong one
+# when its output does not validate
+LLM_FAST_MODEL = os.getenv('LLM_FAST_MODEL', 'gpt-4o-mini')
+LLM_STRONG_MODEL = os.getenv('LLM_STRONG_MODEL', 'gpt-4-1106-preview')
+LLM_ROUTE_MAX_WORDS = int(os.getenv('LLM_ROUTE_MAX_WORDS', 12))
+LLM_ROUTE_MAX_AMOUNTS = int(os.getenv('LLM_ROUTE_MAX_AMOUNTS', 1))
+
+# user_id -> (category version, active CategoryRecord tuples, rendered category list), least
+# recently used first
+_category_prompts = OrderedDict()
+_category_prompts_lock = threading.Lock()
+CATEGORY_PROMPT_CACHE_USERS = int(os.getenv('CATEGORY_PROMPT_CACHE_USERS', 10000))
+
+AMOUNT_PATTERN = re.compile(r'\d+(?:[.,]\d+)*')
+CURRENCY_WORDS = {'euro', 'euros', 'eur', 'dollar', 'dollars', 'usd', 'pound', 'pounds', 'gbp'}
 
 
 def openai_transcribe(path, user_id):
@@ -53,82 +101,381 @@ def openai_transcribe(path, user_id):
         return None
 
 
-def get_expensedata(user_id, textstring):
+def render_categories(user_categories):
+    """Encodes categories compactly for the prompt, one 'id=name' per line."""
+    return "\n".join(f"{cat_id}={name}" for name, cat_id in user_categories)
+
+
+def _cache_category_prompt(user_id, entry):
+    with _category_prompts_lock:
+        _category_prompts[user_id] = entry
+        _category_prompts.move_to_end(user_id)
+        while len(_category_prompts) > CATEGORY_PROMPT_CACHE_USERS:
+            _category_prompts.popitem(last=False)
+
+
+def get_category_prompt(user_id):
     """
-    Retrieves expense data from a given text string using GPT-4.
+    Returns a user's active categories and their prompt encoding.
+
+    Both are cached per user and only rebuilt when the user's category version changes.
 
     Args:
-        user_id (int): The ID of the user for logging.
-        textstring (str): The text string to be analyzed by the model.
+        user_id (int): The ID of the user.
 
     Returns:
-        str: The JSON-formatted output from GPT-4 or an error message.
+        tuple: The CategoryRecord (name, id) tuples of the active categories and their rendered list.
     """
-    today = datetime.utcnow().strftime("%Y-%m-%d")
+    version = get_category_version(user_id)
+    with _category_prompts_lock:
+        cached = _category_prompts.get(user_id)
+        if cached is not None and cached[0] == version:
+            _category_prompts.move_to_end(user_id)
+            return cached[1], cached[2]
+
     user_categories = get_categories_and_id(user_id, type=1)
+    rendered = render_categories(user_categories)
+    if not has_uncommitted_category_changes(user_id):
+        _cache_category_prompt(user_id, (version, user_categories, rendered))
+    return user_categories, rendered
+
+
+def preload_category_prompts(categories_by_user, versions):
+    """
+    Fills the category prompt cache from categories loaded in bulk, e.g. at startup.
+
+    Args:
+        categories_by_user (dict): User ID -> list of the user's active CategoryRecord tuples.
+        versions (dict): User ID -> category version read before the categories were loaded,
+                         so a change made during the load is not cached under its new version.
+    """
+    for user_id, user_categories in categories_by_user.items():
+        _cache_category_prompt(user_id, (versions[user_id], user_categories, render_categories(user_categories)))
+
+
+def warm_up_client():
+    """Opens the pooled connection to the OpenAI API with a free metadata request."""
+    client.models.retrieve(LLM_FAST_MODEL)
+
+
+def prepare_expense_context(user_id):
+    """
+    Loads a user's categories, their prompt encoding and classifier ahead of get_expensedata.
+
+    Meant to run while the voice message is still downloading or being transcribed.
+    Errors are only logged, get_expensedata loads whatever is missing again.
+    """
+    try:
+        get_category_prompt(user_id)
+        get_classifier(user_id)
+    except Exception as e:
+        logging.error(f"Error preparing the expense context of user {user_id}: {e}")
+
+
+def build_expense_messages(textstring, today, rendered_categories):
+    """Builds the chat messages of an extraction: static prefix first, then the variable parts."""
+    return [
+        {"role": "system", "content": EXPENSE_SYSTEM_PROMPT},
+        {"role": "system", "content": f"Today: {today}\nCategories (id=name):\n{rendered_categories}"},
+        {"role": "user", "content": textstring},
+    ]
+
+
+def record_usage(user_id, model, usage, started, first_token_at):
+    """Records token usage and latency of a chat completion as metrics."""
+    if first_token_at is not None:
+        metrics.observe('llm.ttft_seconds', first_token_at - started, model=model)
+    metrics.observe('llm.latency_seconds', time.monotonic() - started, model=model)
+    if usage is None:
+        return
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+    metrics.observe('llm.prompt_tokens', usage.prompt_tokens, model=model)
+    metrics.observe('llm.completion_tokens', usage.completion_tokens, model=model)
+    metrics.increment('llm.tokens', usage.total_tokens, model=model)
+    metrics.increment('llm.cached_prompt_tokens', cached_tokens, model=model)
+    logging.info(f"API call for user {user_id} used {usage.prompt_tokens} prompt ({cached_tokens} cached) "
+                 f"and {usage.completion_tokens} completion tokens.")
+
+
+def rank_user_categories(user_id, textstring, user_categories):
+    """
+    Ranks the given categories for a text with the user's local classifier.
+
+    Args:
+        user_id (int): The ID of the user.
+        textstring (str): The transcript to classify.
+        user_categories (list): CategoryRecord (name, id) tuples, as returned by get_categories_and_id.
+
+    Returns:
+        tuple: The user's classifier and the (category_id, probability) ranking, which is
+               empty when the text cannot be classified.
+    """
+    try:
+        classifier = get_classifier(user_id)
+        return classifier, classifier.rank(textstring, [cat_id for _, cat_id in user_categories])
+    except Exception as e:
+        logging.error(f"Local classifier error for user {user_id}: {e}")
+        return None, []
+
+
+def suggest_category(user_id, textstring, min_probability=0.5):
+    """
+    Suggests the most likely active category for a text, for pre-selection in the manual flow.
+
+    Returns:
+        int: The category ID, or None when no category is likely enough.
+    """
+    try:
+        _, ranking = rank_user_categories(user_id, textstring, get_category_prompt(user_id)[0])
+    except Exception as e:
+        logging.error(f"Error suggesting a category for user {user_id}: {e}")
+        return None
+    if ranking and ranking[0][1] >= min_probability:
+        return ranking[0][0]
+    return None
+
+
+def extract_expense_locally(classifier, ranking, textstring, today):
+    """
+    Extracts a single expense without GPT, when the transcript is unambiguous.
+
+    That is the case when the transcript contains exactly one amount, the classifier is
+    confident about the category and has enough examples of it, and every other word has
+    been seen in the user's past expenses (so dates like "yesterday" still go to GPT).
+
+    Returns:
+        str: The expense in the same JSON format as get_expensedata, or None.
+    """
+    if classifier is None or not ranking:
+        return None
+    category_id, probability = ranking[0]
+    if probability < CLASSIFIER_SKIP_CONFIDENCE or classifier.expense_counts[category_id] < CLASSIFIER_MIN_EXAMPLES:
+        return None
+
+    amounts = AMOUNT_PATTERN.findall(textstring)
+    if len(amounts) != 1:
+        return None
+    try:
+        parse_amount(amounts[0])
+    except ValueError:
+        return None
+
+    words = [word for word in tokenize(textstring) if word not in CURRENCY_WORDS]
+    if not words or not all(classifier.known(word) for word in words):
+        return None
+
+    description = " ".join(word for word in AMOUNT_PATTERN.sub(" ", textstring).split()
+                           if word.strip(".,;:-").casefold() not in CURRENCY_WORDS).strip(" .,;:-€$£")
+    return json.dumps({'expenses': [{'amount': amounts[0], 'category_id': category_id, 'description': description,
+                                     'date': today, 'error': None}]})
+
+
+def choose_route(textstring):
+    """
+    Picks the model route for a transcript.
+
+    Short transcripts with at most LLM_ROUTE_MAX_AMOUNTS amounts go to the fast model,
+    anything longer or mentioning more amounts goes to the strong model.
+
+    Returns:
+        str: 'fast' or 'strong'.
+    """
+    if (len(textstring.split()) <= LLM_ROUTE_MAX_WORDS
+            and len(AMOUNT_PATTERN.findall(textstring)) <= LLM_ROUTE_MAX_AMOUNTS):
+        return 'fast'
+    return 'strong'
+
+
+def validate_expense_output(output, category_ids):
+    """
+    Checks an extraction before it is accepted.
 
-    system_message = {
-        "role": "system",
-        "content": f"You are a budget assistant. Extract expense information from the user's input and respond with the details in JSON format.\
-        These are the user categories: {user_categories}\
-        Include 'amount':value of the expense (decimal),\
-            'category_id': category unique identifier (integer),\
-            'category_name': the category name (string),\
-            'description': brief description of the expense (string),\
-            'date': today is {today}, if not specified set today (YYYY-MM-DD format),\
-             and 'error': use this field whenever you are not certain about one of the responses above, insert suggestions for user. (string).\
-        If you are not certain about any of the fields use None and valorize the 'error' field. Give detailed suggestions based on user laguage."
-    }
-
-    user_message = {
-        "role": "user",
-        "content": textstring
-    }
-    
+    Args:
+        output (str): The JSON output of the model.
+        category_ids (list): The IDs of the user's active categories.
+
+    Returns:
+        str: The reason the output is rejected, or None if it is valid.
+    """
+    parsed = parse_expense_json(output) if output else None
+    if not parsed:
+        return 'unparsable output'
+    for exp_amount, exp_cat_id, _, exp_date, exp_error in parsed:
+        if exp_error:
+            return 'error set'
+        try:
+            parse_amount(exp_amount)
+        except (ValueError, TypeError):
+            return 'invalid amount'
+        try:
+            if int(exp_cat_id) not in category_ids:
+                return 'unknown category'
+        except (ValueError, TypeError):
+            return 'unknown category'
+        try:
+            datetime.strptime(str(exp_date), "%Y-%m-%d")
+        except ValueError:
+            return 'invalid date'
+    return None
+
+
+def complete_expense(user_id, model, messages):
+    """
+    Runs one extraction chat completion.
+
+    Args:
+        user_id (int): The ID of the user for logging.
+        model (str): The model to use.
+        messages (list): The chat messages, see build_expense_messages.
+
+    Returns:
+        str: The JSON-formatted output of the model, or None in case of an error.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-1106-preview",
-            messages=[system_message, user_message],
-            response_format={"type": "json_object"}  # Setting the response format to JSON
+        # Streamed so the time to the first token can be measured, usage comes with the last chunk
+        started = time.monotonic()
+        first_token_at = None
+        usage = None
+        chunks = []
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"},  # Setting the response format to JSON
+            max_tokens=LLM_MAX_OUTPUT_TOKENS,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        
-        logging.info(f"User {user_id} expense info: {response.choices[0].message.content}")
-        logging.info(f"API call for user {user_id} cost {response.usage.total_tokens} tokens.")
-        
-        output = str(response.choices[0].message.content)
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                chunks.append(chunk.choices[0].delta.content)
+
+        output = "".join(chunks)
+        record_usage(user_id, model, usage, started, first_token_at)
+        logging.info(f"User {user_id} expense info ({model}): {output}")
         return output
-    
+
     except OpenAIError as oe:
+        metrics.increment('llm.errors', model=model)
         logging.error(f"OpenAI chat completion error for user {user_id}: {oe}")
         return None
-    
+
     except Exception as e:
+        metrics.increment('llm.errors', model=model)
         logging.error(f"Unexpected error for user {user_id}: {e}")
         return None
-    
+
+
+def extract_expenses(user_id, textstring, route=None):
+    """
+    Extracts expense data from a transcript, returning which route produced it.
+
+    The user's local category classifier runs first: short transcripts it is confident about
+    are answered without a model, otherwise the model is only shown the most likely
+    categories when the classifier is sure enough that the right one is among them.
+    Simple transcripts go to the fast model and are escalated to the strong model when
+    its output does not validate.
+
+    Args:
+        user_id (int): The ID of the user.
+        textstring (str): The transcript to be analyzed.
+        route (str, optional): Forces 'fast' or 'strong' (without escalation), used by the replay report.
+
+    Returns:
+        tuple: The JSON-formatted output (None in case of an error) and the route that
+               produced it: 'local', 'fast', 'strong' or 'escalated'.
+    """
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    user_categories, rendered_categories = get_category_prompt(user_id)
+
+    if route is None:
+        classifier, ranking = rank_user_categories(user_id, textstring, user_categories)
+        local_output = extract_expense_locally(classifier, ranking, textstring, today)
+        if local_output is not None:
+            metrics.increment('llm.route', route='local')
+            logging.info(f"User {user_id} expense info (local classifier): {local_output}")
+            return local_output, 'local'
+
+        top = ranking[:CLASSIFIER_TOP_K]
+        if top and sum(probability for _, probability in top) >= CLASSIFIER_TOP_K_COVERAGE:
+            candidates = {cat_id for cat_id, _ in top}
+            rendered_categories = render_categories([[name, cat_id] for name, cat_id in user_categories
+                                                     if cat_id in candidates])
+            logging.info(f"User {user_id}: prompt narrowed to {len(candidates)} candidate categories.")
+
+    messages = build_expense_messages(textstring, today, rendered_categories)
+    chosen = route or choose_route(textstring)
+    metrics.increment('llm.route', route=chosen)
+
+    if chosen == 'strong':
+        return complete_expense(user_id, LLM_STRONG_MODEL, messages), 'strong'
+
+    output = complete_expense(user_id, LLM_FAST_MODEL, messages)
+    if route is not None:
+        return output, 'fast'
+
+    rejection = validate_expense_output(output, {cat_id for _, cat_id in user_categories})
+    if rejection is None:
+        return output, 'fast'
+
+    # The strong model sees the full category list, the narrowed one may be why the fast one failed
+    metrics.increment('llm.escalations', reason=rejection)
+    logging.info(f"User {user_id}: escalating to {LLM_STRONG_MODEL} ({rejection}).")
+    messages = build_expense_messages(textstring, today, get_category_prompt(user_id)[1])
+    return complete_expense(user_id, LLM_STRONG_MODEL, messages), 'escalated'
+
+
+def get_expensedata(user_id, textstring):
+    """
+    Retrieves expense data from a given text string, see extract_expenses.
+
+    Args:
+        user_id (int): The ID of the user for logging.
+        textstring (str): The text string to be analyzed by the model.
+
+    Returns:
+        str: The JSON-formatted output or None in case of an error.
+    """
+    return extract_expenses(user_id, textstring)[0]
+
 
 def parse_expense_json(json_output):
     """
-    Parses a JSON string to extract expense details.
+    Parses a JSON string to extract the details of one or more expenses.
 
     Args:
-        json_output (str): JSON-formatted string containing expense details.
+        json_output (str): JSON-formatted string containing either a single expense object
+                           or an object with an 'expenses' list.
 
     Returns:
-        tuple: A tuple containing amount, category_id, description, date of the expense and error if present.
+        list: A list of tuples, one per expense, each containing amount, category_id, description,
+              date of the expense and error if present. None if the JSON cannot be parsed.
     """
     try:
-        expense_json = json.loads(json_output)
+        # Amounts stay exact decimals instead of becoming floats
+        expense_json = json.loads(json_output, parse_float=Decimal)
+        entries = expense_json.get('expenses', [expense_json])
+        parsed = []
+
+        for entry in entries:
+            # Extract details from JSON, an error on the envelope applies to every entry
+            exp_amount = entry.get('amount')
+            exp_cat_id = entry.get('category_id')
+            exp_description = entry.get('description')
+            exp_date = entry.get('date')
+            exp_error = entry.get('error') or expense_json.get('error')
 
-        # Extract details from JSON
-        exp_amount = expense_json.get('amount')
-        exp_cat_id = expense_json.get('category_id')
-        exp_description = expense_json.get('description')
-        exp_date = expense_json.get('date')
-        exp_error = expense_json.get('error')
+            parsed.append((exp_amount, exp_cat_id, exp_description, exp_date, exp_error))
 
-        return exp_amount, exp_cat_id, exp_description, exp_date, exp_error
+        if not parsed:
+            parsed.append((None, None, None, None, expense_json.get('error') or 'No expense found in the message.'))
+
+        return parsed
 
     except Exception as e:
         logging.error(f"Error parsing JSON {json_output} for expense data: {e}")
-        return None
\ No newline at end of file
+        return None
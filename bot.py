@@ -1,18 +1,35 @@
 import logging
 import os
+import time
 import asyncio
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden
+from sqlalchemy.exc import SQLAlchemyError
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, ConversationHandler, MessageHandler, CommandHandler, filters, CallbackQueryHandler
 )
 # Import Functions
 from app.users import is_user_registered, create_user, get_user_id
-from app.categories import add_category, generate_categories_message, get_categories_and_id, change_category_status, get_category_name
-from app.gsheet import add_basicinfo, extract_spreadsheet_id, get_google_auth_url
-from app.expenses import add_expense, retrieve_last_expense_id, delete_expense
-from app.whispergpt import openai_transcribe, get_expensedata, parse_expense_json
+from app.categories import add_category, generate_categories_message, get_categories_and_id, change_category_status, get_category_name, get_category_version, has_uncommitted_category_changes, normalize_category_name
+from app.gsheet import add_basicinfo, extract_spreadsheet_id, get_google_auth_url, flush_refreshed_tokens, backfill_expenses_to_sheet
+from app.expenses import add_expense, add_expenses, delete_expense, retrieve_expenses_page, retrieve_last5_expenses, retrieve_last_expense_id, encode_expense_cursor, parse_amount, format_amount, sum_expenses
+from app.whispergpt import openai_transcribe, get_expensedata, parse_expense_json, suggest_category, prepare_expense_context, get_category_prompt
+from app.admission import llm_admission
+from app.metrics import metrics
+from app.http_pools import telegram_request, log_pool_stats
+from app.gsheet_sync import reconcile_sheet, get_synced_users
+from app.recurring import create_recurring_from_expense, deactivate_recurring_expense, materialize_due_expenses
+from app.persistence import DatabasePersistence
+from app.update_processor import PerUserUpdateProcessor
+from app.idempotency import UpdateDeduplicator, prune_processed_updates
+from app.warmup import warm_up
+from app.db_utils import save_unit_of_work, outside_unit_of_work, fail_unit_of_work
+from app.accounts import delete_account
+from app.search import search_expenses, search_totals
 
 ## Setup logging
 logging.basicConfig(
@@ -32,13 +49,30 @@ API_KEY = os.getenv('API_KEY')
 from app.flask_app import app as flask_app
 from threading import Thread
 
+######################
+## UNIT OF WORK
+async def save_changes():
+    """Commits the update's changes before the user is told they are saved. Returns False if the commit failed."""
+    try:
+        await asyncio.to_thread(save_unit_of_work)
+        return True
+    except SQLAlchemyError:
+        return False
+
+
+async def rollback_failed_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Error handler: the changes of an update whose handler raised are rolled back, not committed."""
+    fail_unit_of_work()
+    logger.error(f"Error processing update {getattr(update, 'update_id', update)}", exc_info=context.error)
+
+
 ######################
 ## START
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_user_id = update.effective_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
-    if is_user_registered(tg_user_id):
+    if await asyncio.to_thread(is_user_registered, tg_user_id):
         logger.info(f"Registered user with id:{user_id} started the bot")
         # Display a welcome back message with inline buttons for registered users
         keyboard = [
@@ -72,65 +106,152 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ######################
 ## VOICE EXPENSE
+async def download_voice(bot, file_id, path):
+    voice_file = await bot.get_file(file_id)
+    await voice_file.download_to_drive(custom_path=path)
+
+
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_user_id = update.effective_user.id
-    user_id = get_user_id(tg_user_id)
 
-    if is_user_registered(tg_user_id):
+    # The download does not depend on the user, start it while the user is resolved
+    path = f"audio/{tg_user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}.ogg"
+    download = asyncio.create_task(download_voice(context.bot, update.message.voice.file_id, path))
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+
+    if user_id is not None:
+        # Answer straight away when the LLM path is saturated or failing
+        if not llm_admission.try_acquire():
+            download.cancel()
+            logger.warning(f"LLM path unavailable ({llm_admission.state}), offering manual flow to user {user_id}")
+            await offer_manual_expense(update, context, "⏳ Voice processing is busy right now.")
+            return
+
+        # Categories, prompt and classifier are loaded while the audio downloads and is transcribed
+        prefetch = asyncio.create_task(asyncio.to_thread(prepare_expense_context, user_id))
+
+        transcript_text = None
+        parsed = None
+        started = time.monotonic()
         try:
-            user_id = update.effective_user.id
-            path = f"audio/{user_id}_{datetime.now().strftime('%Y%m%d%H%M')}.ogg"
-            voice_message = update.message.voice
-            voice_file = await context.bot.get_file(voice_message.file_id)
-
-            # Correctly using the download method
-            await voice_file.download_to_drive(custom_path=path)
-
-            # Transcribe
-            testo = openai_transcribe(path, user_id).text
-            # Get infor from text
-            outputgpt = get_expensedata(user_id, testo)
-
-            exp_amount, exp_cat_id, exp_description, exp_date, exp_error = parse_expense_json(outputgpt)
-
-            if exp_error:
-                await update.message.reply_text(exp_error)
-
-            else:
-            # Add expense
-                add_expense(user_id=user_id, amount=exp_amount, category_id=exp_cat_id, date=exp_date, description=exp_description)
-                catname = get_category_name(user_id=user_id,category_id=exp_cat_id)
-                expense_id = retrieve_last_expense_id(user_id)
-
-                # Create an inline keyboard with a button to delete the expense
-                keyboard = [
-                    [InlineKeyboardButton("❌Delete Expense", callback_data=f'deleteexpense_{expense_id}')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            await download
+
+            # Transcribe, in a worker thread so other users' updates keep flowing
+            transcript = await asyncio.to_thread(openai_transcribe, path, user_id)
+            if transcript is not None:
+                transcript_text = transcript.text
+                await prefetch
+                # Get infor from text
+                outputgpt = await asyncio.to_thread(get_expensedata, user_id, transcript_text)
+                if outputgpt is not None:
+                    parsed = parse_expense_json(outputgpt)
+        except Exception as e:
+            logger.error(f"Error processing voice message of user {user_id}: {e}")
+        finally:
+            llm_admission.release(parsed is not None, time.monotonic() - started)
+            # The prefetch uses this update's database session, it must be done before anything else does
+            await asyncio.gather(prefetch, return_exceptions=True)
+
+        if parsed is None:
+            await offer_manual_expense(update, context, "There was an error processing your voice message.",
+                                       prefill={'description': transcript_text})
+            return
+
+        valid = [entry for entry in parsed if not entry[4] and entry[0] is not None and entry[1] is not None]
+        invalid = [entry for entry in parsed if entry not in valid]
+
+        if not valid:
+            exp_amount, exp_cat_id, exp_description, exp_date, exp_error = invalid[0]
+            await offer_manual_expense(update, context, exp_error or "I could not understand the expense.",
+                                       prefill={'amount': exp_amount, 'category_id': exp_cat_id,
+                                                'description': exp_description or transcript_text, 'date': exp_date})
+            return
 
-                await update.message.reply_text(f"Expense added! Here are the info:\n 💶Amount: {exp_amount}€\n 🗂Category: {catname}\n 📅Date: {exp_date}\n 📃Description: {exp_description}",reply_markup=reply_markup)
+        try:
+            # Add all the expenses at once
+            expense_ids = await asyncio.to_thread(add_expenses, user_id, [
+                {'amount': exp_amount, 'category_id': exp_cat_id, 'description': exp_description, 'date': exp_date}
+                for exp_amount, exp_cat_id, exp_description, exp_date, _ in valid
+            ])
+            if expense_ids is None or not await save_changes():
+                raise RuntimeError('bulk insert failed')
+
+            # Already loaded by the prefetch, the extracted categories are active ones
+            catnames = {str(cat_id): name for name, cat_id in (await asyncio.to_thread(get_category_prompt, user_id))[0]}
+
+            # One message for the whole batch, with a button to delete each expense
+            lines = []
+            keyboard = []
+            for number, (expense_id, (exp_amount, exp_cat_id, exp_description, exp_date, _)) in enumerate(zip(expense_ids, valid), start=1):
+                catname = catnames.get(str(exp_cat_id), "Category not found")
+                lines.append(f"{number}. 💶Amount: {format_amount(parse_amount(exp_amount))}\n 🗂Category: {catname}\n 📅Date: {exp_date}\n 📃Description: {exp_description}")
+                label = "❌Delete Expense" if len(valid) == 1 else f"❌Delete #{number} ({exp_description or catname})"[:60]
+                keyboard.append([InlineKeyboardButton(label, callback_data=f'deleteexpense_{expense_id}')])
+            if len(valid) == 1:
+                keyboard.append([InlineKeyboardButton("🔁 Repeat monthly", callback_data=f'makerecurring_{expense_ids[0]}')])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            header = "Expense added! Here are the info:" if len(valid) == 1 else f"{len(valid)} expenses added! Here are the info:"
+            await update.message.reply_text(f"{header}\n" + "\n".join(lines), reply_markup=reply_markup)
 
-            
         except Exception as e:
-            print(f"Error: {e}")
-            await update.message.reply_text("There was an error processing your voice message.")
+            logger.error(f"Error saving voice expenses of user {user_id}: {e}")
+            exp_amount, exp_cat_id, exp_description, exp_date, _ = valid[0]
+            await offer_manual_expense(update, context, "There was an error saving your expense.",
+                                       prefill={'amount': exp_amount, 'category_id': exp_cat_id,
+                                                'description': exp_description, 'date': exp_date})
+            return
+
+        if invalid:
+            exp_amount, exp_cat_id, exp_description, exp_date, exp_error = invalid[0]
+            await offer_manual_expense(update, context, exp_error or "I could not understand one of the expenses.",
+                                       prefill={'amount': exp_amount, 'category_id': exp_cat_id,
+                                                'description': exp_description, 'date': exp_date})
     else:
         # Respond to unregistered users
+        download.cancel()
         await update.message.reply_text("Please register to use this feature.")
 
 
+async def offer_manual_expense(update: Update, context: ContextTypes.DEFAULT_TYPE, reason, prefill=None):
+    """Replies immediately offering the manual expense flow, prefilled with whatever was parsed."""
+    prefill = {key: value for key, value in (prefill or {}).items() if value}
+    # Pre-select the category the local classifier expects for what was said
+    if 'category_id' not in prefill and prefill.get('description'):
+        user_id = await asyncio.to_thread(get_user_id, update.effective_user.id)
+        category_id = await asyncio.to_thread(suggest_category, user_id, prefill['description'])
+        if category_id is not None:
+            prefill['category_id'] = category_id
+    context.user_data['expense_prefill'] = prefill
+
+    keyboard = [[InlineKeyboardButton("✍️ Add it manually", callback_data='add_expense_prefilled')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(f"{reason} You can add the expense manually instead:", reply_markup=reply_markup)
+
+
 async def handle_expense_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
     data = query.data
 
     if data.startswith('deleteexpense_'):
         expense_id = int(data.split('_')[1])
-        success = delete_expense(user_id, expense_id)
+        success = await asyncio.to_thread(delete_expense, user_id, expense_id) and await save_changes()
+
+        # A confirmation listing several expenses keeps its other delete buttons
+        other_buttons = [
+            row for row in query.message.reply_markup.inline_keyboard
+            if row[0].callback_data != data
+        ] if query.message.reply_markup else []
+        if success and other_buttons:
+            await query.edit_message_text(text=f"{query.message.text}\n\n🗑 One expense was deleted.",
+                                          reply_markup=InlineKeyboardMarkup(other_buttons))
+            return
+
         # Prepare response based on the operation success
         if success:
             response_message = "Expense deleted successfully. Add a new expense manually or send a voice message."
@@ -144,6 +265,47 @@ async def handle_expense_delete(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text(text="There was an error deleting your expense.")
 
 
+######################
+## CATEGORY KEYBOARDS
+# Category pickers by kind: callback prefix -> type of categories listed (1 active, 2 inactive)
+CATEGORY_KEYBOARD_KINDS = {'expensecat': 1, 'deactivate': 1, 'reactivate': 2}
+# Rendered pickers per (user, kind), tagged with the category version they were built from,
+# least recently used first. Built in worker threads, hence the lock
+_category_keyboards = OrderedDict()
+_category_keyboards_lock = threading.Lock()
+CATEGORY_KEYBOARD_CACHE_SIZE = int(os.getenv('CATEGORY_KEYBOARD_CACHE_SIZE', 10000))
+
+def get_category_keyboard(user_id, kind):
+    """Returns the category picker of the given kind, rebuilding it only when the categories changed."""
+    version = get_category_version(user_id)
+    with _category_keyboards_lock:
+        cached = _category_keyboards.get((user_id, kind))
+        if cached and cached[0] == version:
+            _category_keyboards.move_to_end((user_id, kind))
+            return cached[1]
+
+    # Fetch categories and their IDs
+    categories = get_categories_and_id(user_id, CATEGORY_KEYBOARD_KINDS[kind])
+
+    # Create inline keyboard buttons for each category
+    keyboard_buttons = [
+        [InlineKeyboardButton(category[0], callback_data=f"{kind}_{category[1]}")]
+        for category in categories
+    ]
+
+    # Add 'Cancel' button
+    keyboard_buttons.append([InlineKeyboardButton("⬅️ Cancel", callback_data='cancel')])
+
+    reply_markup = InlineKeyboardMarkup(keyboard_buttons)
+    if not has_uncommitted_category_changes(user_id):
+        with _category_keyboards_lock:
+            _category_keyboards[(user_id, kind)] = (version, reply_markup)
+            _category_keyboards.move_to_end((user_id, kind))
+            while len(_category_keyboards) > CATEGORY_KEYBOARD_CACHE_SIZE:
+                _category_keyboards.popitem(last=False)
+    return reply_markup
+
+
 ######################
 ## ADD EXPENSE
 EXPENSE_AMOUNT, EXPENSE_CATEGORY, EXPENSE_DESCRIPTION, EXPENSE_DATE = range(4)
@@ -151,20 +313,26 @@ EXPENSE_AMOUNT, EXPENSE_CATEGORY, EXPENSE_DESCRIPTION, EXPENSE_DATE = range(4)
 async def start_expensecreation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    # Only the manual fallback of a voice message carries prefilled values
+    if query.data != 'add_expense_prefilled':
+        context.user_data.pop('expense_prefill', None)
     return await ask_expenseamount(update, context)
 
 async def ask_expenseamount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()  # Acknowledge the callback query
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+    prefill = context.user_data.get('expense_prefill', {})
     
     logger.info(f"Received callback query for expense amount from user: {user_id}")
     keyboard = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
+    if prefill.get('amount'):
+        keyboard.insert(0, [InlineKeyboardButton(f"✅ Use {prefill['amount']}€", callback_data='prefill_amount')])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.reply_text(
-        'Please enter your expense amount: (for decimal use ".", comma separator will soon be implemented.)', 
+        'Please enter your expense amount:', 
         reply_markup=reply_markup
     )
     logger.info("Asking user for their expense amount")
@@ -172,28 +340,41 @@ async def ask_expenseamount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return EXPENSE_AMOUNT
 
 async def ask_expensecategory(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    
-    context.user_data['expense_amount'] = update.message.text
-    tg_user_id = update.message.from_user.id
-    user_id = get_user_id(tg_user_id)
-    
-    # Fetch categories and their IDs
-    categories = get_categories_and_id(user_id, 1)
+    prefill = context.user_data.get('expense_prefill', {})
 
-    # Create inline keyboard buttons for each category
-    keyboard_buttons = [
-        [InlineKeyboardButton(category[0], callback_data=f"expensecat_{category[1]}")]
-        for category in categories
-    ]
-
-    # Add 'Cancel' button
-    keyboard_buttons.append([InlineKeyboardButton("⬅️ Cancel", callback_data='cancel')])
+    if update.callback_query:
+        # The user accepted the prefilled amount
+        await update.callback_query.answer()
+        context.user_data['expense_amount'] = prefill.get('amount')
+        message = update.callback_query.message
+    else:
+        try:
+            parse_amount(update.message.text)
+        except ValueError:
+            await update.message.reply_text("That doesn't look like an amount, please try again (e.g. 12.50 or 12,50):")
+            return EXPENSE_AMOUNT
+        context.user_data['expense_amount'] = update.message.text
+        message = update.message
 
-    # Create InlineKeyboardMarkup
-    reply_markup = InlineKeyboardMarkup(keyboard_buttons)
+    tg_user_id = update.effective_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+    
+    # Cached category picker, rebuilt only when the categories change
+    reply_markup = await asyncio.to_thread(get_category_keyboard, user_id, 'expensecat')
+
+    # Move the prefilled category first
+    if prefill.get('category_id'):
+        preselected = f"expensecat_{prefill['category_id']}"
+        keyboard_buttons = [list(row) for row in reply_markup.inline_keyboard]
+        for index, row in enumerate(keyboard_buttons):
+            if row[0].callback_data == preselected:
+                keyboard_buttons.pop(index)
+                keyboard_buttons.insert(0, [InlineKeyboardButton(f"⭐ {row[0].text}", callback_data=preselected)])
+                break
+        reply_markup = InlineKeyboardMarkup(keyboard_buttons)
 
     # Send the message with inline keyboard
-    await update.message.reply_text(
+    await message.reply_text(
         "Select the category of the expense:",
         reply_markup=reply_markup
     )
@@ -206,13 +387,16 @@ async def ask_expensedescription(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()    
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+    prefill = context.user_data.get('expense_prefill', {})
 
     category_id = query.data.split('_')[1]
     context.user_data['expense_category_id'] = category_id
 
     logger.info(f"Received callback query for expense amount from user: {user_id}")
     keyboard = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
+    if prefill.get('description'):
+        keyboard.insert(0, [InlineKeyboardButton(f"✅ Use \"{prefill['description'][:40]}\"", callback_data='prefill_description')])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.reply_text(
@@ -225,8 +409,16 @@ async def ask_expensedescription(update: Update, context: ContextTypes.DEFAULT_T
 
 
 async def ask_expensedate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    
-    context.user_data['expense_desription'] = update.message.text
+    prefill = context.user_data.get('expense_prefill', {})
+
+    if update.callback_query:
+        # The user accepted the prefilled description
+        await update.callback_query.answer()
+        context.user_data['expense_description'] = prefill.get('description')
+        message = update.callback_query.message
+    else:
+        context.user_data['expense_description'] = update.message.text
+        message = update.message
 
     # Define date options
     dates = [
@@ -234,6 +426,8 @@ async def ask_expensedate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ("🗓 Yesterday", (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")),
         ("🗓 Day Before Yesterday", (datetime.now() - timedelta(days=2)).strftime("%Y-%m-%d"))
     ]
+    if prefill.get('date') and prefill['date'] not in [date_str for _, date_str in dates]:
+        dates.insert(0, (f"⭐ {prefill['date']}", prefill['date']))
 
     # Create keyboard buttons for each date option
     keyboard_buttons = [
@@ -248,19 +442,11 @@ async def ask_expensedate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard_buttons)
 
      # Send the message with inline keyboard
-    await update.message.reply_text(
+    await message.reply_text(
         "Select the date:",
         reply_markup=reply_markup
     )
 
-    # # Send the message with inline keyboard
-    # await query.message.reply_text(
-    #     "Select the date:",
-    #     reply_markup=reply_markup
-    # )
-
-    # print(query.data)
-
     return EXPENSE_DATE
 
 
@@ -274,7 +460,7 @@ async def complete_expensecreation(update: Update, context: ContextTypes.DEFAULT
     context.user_data['expense_date'] = exp_date
 
     tg_user_id = update.effective_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     print(user_id)
     expense_amount = context.user_data.get('expense_amount')
     print(expense_amount)
@@ -287,26 +473,113 @@ async def complete_expensecreation(update: Update, context: ContextTypes.DEFAULT
 
     # Validate the data and add the expense (validation and error handling not shown here)
     try:
-        add_expense(user_id=user_id, amount=expense_amount, date=expense_date, category_id=expense_category_id, description=expense_description)
-        expense_id = retrieve_last_expense_id(user_id)
+        expense_id = await asyncio.to_thread(add_expense, user_id=user_id, amount=expense_amount, date=expense_date, category_id=expense_category_id, description=expense_description)
+        if expense_id is None or not await save_changes():
+            raise RuntimeError('insert failed')
         keyboard = [
-                [InlineKeyboardButton("❌Delete Expense", callback_data=f'deleteexpense_{expense_id}')]
+                [InlineKeyboardButton("❌Delete Expense", callback_data=f'deleteexpense_{expense_id}')],
+                [InlineKeyboardButton("🔁 Repeat monthly", callback_data=f'makerecurring_{expense_id}')]
             ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         # Confirmation message to the user
-        catname = get_category_name(user_id=user_id,category_id=expense_category_id)
+        catname = await asyncio.to_thread(get_category_name, user_id=user_id, category_id=expense_category_id)
 
-        await query.message.reply_text(f"Expense added! Here are the info:\n 💶Amount: {expense_amount}€\n 🗂Category: {catname}\n 📅Date: {expense_date}\n 📃Description: {expense_description}",reply_markup=reply_markup)
+        await query.message.reply_text(f"Expense added! Here are the info:\n 💶Amount: {format_amount(parse_amount(expense_amount))}\n 🗂Category: {catname}\n 📅Date: {expense_date}\n 📃Description: {expense_description}",reply_markup=reply_markup)
         
 
     except:
         await query.message.reply_text("There was an error adding your expense.")
 
+    context.user_data.pop('expense_prefill', None)
     return ConversationHandler.END
 
 
 
+######################
+## RECURRING EXPENSES
+# Notifications sent per second by the scheduler, below Telegram's broadcast limit
+RECURRING_NOTIFICATIONS_PER_SECOND = float(os.getenv('RECURRING_NOTIFICATIONS_PER_SECOND', 20))
+
+async def handle_make_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    user_id = await asyncio.to_thread(get_user_id, query.from_user.id)
+    expense_id = int(query.data.split('_')[1])
+    rule_id = await asyncio.to_thread(create_recurring_from_expense, user_id, expense_id, frequency='monthly')
+
+    if rule_id is None or not await save_changes():
+        await query.message.reply_text("There was an error making this expense recurring.")
+        return
+
+    # The expense can still be deleted, it just cannot be repeated twice
+    other_buttons = [
+        row for row in query.message.reply_markup.inline_keyboard
+        if row[0].callback_data != query.data
+    ] if query.message.reply_markup else []
+    other_buttons.append([InlineKeyboardButton("⏹ Stop repeating", callback_data=f'stoprecurring_{rule_id}')])
+    await query.edit_message_text(text=f"{query.message.text}\n\n🔁 This expense will be added again every month.",
+                                  reply_markup=InlineKeyboardMarkup(other_buttons))
+
+
+async def handle_stop_recurring(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    user_id = await asyncio.to_thread(get_user_id, query.from_user.id)
+    rule_id = int(query.data.split('_')[1])
+
+    if await asyncio.to_thread(deactivate_recurring_expense, user_id, rule_id) and await save_changes():
+        await query.edit_message_text(text=f"{query.message.text}\n\n⏹ This expense will not be repeated anymore.")
+    else:
+        await query.message.reply_text("There was an error stopping this recurring expense.")
+
+
+async def send_rate_limited(bot, messages, per_second=RECURRING_NOTIFICATIONS_PER_SECOND):
+    """Sends (chat_id, text, reply_markup) messages spaced out to stay within Telegram's limits."""
+    interval = 1 / per_second
+    for chat_id, text, reply_markup in messages:
+        for attempt in range(2):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+                break
+            except RetryAfter as e:
+                # Flood control: wait as long as Telegram asks, then try once more
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"Rate limited while notifying chat {chat_id}, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+            except Forbidden:
+                logger.info(f"Chat {chat_id} blocked the bot, skipping notification")
+                break
+            except Exception as e:
+                logger.error(f"Error notifying chat {chat_id}: {e}")
+                break
+        await asyncio.sleep(interval)
+
+
+async def materialize_recurring_expenses(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback: adds the due recurring expenses and tells their owners."""
+    try:
+        due = await asyncio.to_thread(materialize_due_expenses)
+    except Exception as e:
+        logger.error(f"Error materializing recurring expenses: {e}")
+        return
+
+    messages = []
+    for chat_id, rule_id, amount_cents, currency, description, occurrences in due:
+        if chat_id is None:
+            continue
+        times = "" if occurrences == 1 else f" ({occurrences} times, catching up)"
+        text = f"🔁 Recurring expense added{times}:\n 💶Amount: {format_amount(amount_cents, currency)}\n 📃Description: {description}"
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Stop repeating", callback_data=f'stoprecurring_{rule_id}')]])
+        messages.append((chat_id, text, reply_markup))
+
+    # Sending runs in its own task so a large batch does not delay the next tick
+    if messages:
+        context.application.create_task(outside_unit_of_work(send_rate_limited(context.bot, messages)))
+
+
 ######################
 ## SETTINGS
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -316,9 +589,10 @@ async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🗂️ Manage Categories", callback_data='manage_categories')], #List categories, Add category, Deactivate category, Reactivate category
         [InlineKeyboardButton("❌ Delete an Expense", callback_data='delete_expense')], # Delete an expense by id
-        [InlineKeyboardButton("🔗 GSheet Settings", callback_data='connect_gsheet')], #Link GSheet, Change Gsheet, Push all past data to Gsheet
+        [InlineKeyboardButton("🔗 GSheet Settings", callback_data='connect_gsheet')], #Link GSheet, Change Gsheet
+        [InlineKeyboardButton("⬆️ Push all past data to GSheet", callback_data='gsheet_backfill')],
         [InlineKeyboardButton("📥 Export CSV", callback_data='export_csv')], #Send csv to chat
-        [InlineKeyboardButton("👤 User Settings", callback_data='export_csv')], # Modify email, Delete account
+        [InlineKeyboardButton("👤 User Settings", callback_data='account_settings')], # Modify email, Delete account
         [InlineKeyboardButton("⬅️ Go Back", callback_data='go_backhome')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -329,6 +603,332 @@ async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+######################
+## ACCOUNT
+# Seconds between two edits of the deletion progress message
+ACCOUNT_DELETE_PROGRESS_INTERVAL = 3
+_deletions_running = set()
+
+async def show_account_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    keyboard = [
+        [InlineKeyboardButton("🗑️ Delete my account", callback_data='delete_account')],
+        [InlineKeyboardButton("⬅️ Go Back", callback_data='go_backhome')]
+    ]
+    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def ask_account_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    keyboard = [
+        [InlineKeyboardButton("🗑️ Yes, delete everything", callback_data='delete_account_confirm')],
+        [InlineKeyboardButton("⬅️ Go Back", callback_data='go_backhome')]
+    ]
+    await query.edit_message_text(
+        text="This deletes your account with all your expenses, categories and recurring expenses. "
+             "Your Google Sheet itself is kept. This cannot be undone.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def start_account_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    tg_user_id = query.from_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+
+    if user_id is None:
+        await query.edit_message_text("There is no account to delete.")
+        return
+    if user_id in _deletions_running:
+        await query.message.reply_text("Your account is already being deleted.")
+        return
+
+    await query.edit_message_text("🗑️ Deleting your account...")
+    _deletions_running.add(user_id)
+    # Runs in the background, a heavy account takes many batches
+    context.application.create_task(outside_unit_of_work(run_account_deletion(context.application, user_id, tg_user_id, query.message)))
+
+
+async def run_account_deletion(application, user_id, tg_user_id, message):
+    loop = asyncio.get_running_loop()
+    edits = []
+    last_edit = 0
+
+    def progress(table, deleted):
+        # Called from the worker thread after every batch
+        nonlocal last_edit
+        if time.monotonic() - last_edit < ACCOUNT_DELETE_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        edits.append(asyncio.run_coroutine_threadsafe(
+            message.edit_text(f"🗑️ Deleting your account... {deleted} {table.replace('_', ' ')} removed"), loop))
+
+    try:
+        deleted = await asyncio.to_thread(delete_account, user_id, progress)
+        application.drop_user_data(tg_user_id)
+        if deleted is None:
+            text = "There is no account to delete."
+        else:
+            text = f"✅ Your account was deleted, with {deleted['expenses']} expenses. Send /start to register again."
+    except Exception as e:
+        logger.error(f"Account deletion of user {user_id} stopped: {e}")
+        text = "⚠️ The deletion stopped. Delete your account again to finish it."
+    finally:
+        _deletions_running.discard(user_id)
+
+    # The final message must not be overwritten by a late progress edit
+    await asyncio.gather(*(asyncio.wrap_future(edit) for edit in edits), return_exceptions=True)
+    await message.edit_text(text)
+
+
+######################
+## EXPENSE HISTORY
+EXPENSE_PAGE_SIZE = 5
+
+async def show_expense_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    tg_user_id = query.from_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+
+    # 'delete_expense' opens the newest page, 'expensepage_<direction>_<cursor>' moves from a cursor
+    if query.data.startswith('expensepage_'):
+        _, direction, cursor = query.data.split('_', 2)
+    else:
+        direction, cursor = 'older', None
+
+    page = await asyncio.to_thread(retrieve_expenses_page, user_id, cursor=cursor, direction=direction, page_size=EXPENSE_PAGE_SIZE)
+    if page is None:
+        await query.edit_message_text(text="There was an error retrieving your expenses.")
+        return
+    expenses, has_newer, has_older = page
+
+    keyboard = [
+        [InlineKeyboardButton(f"❌ {format_amount(expense.amount_cents, expense.currency)} · {expense.name} · {(expense.date or expense.created_at):%d/%m}", callback_data=f'deleteexpense_{expense.id}')]
+        for expense in expenses
+    ]
+
+    navigation = []
+    if expenses and has_newer:
+        first = expenses[0]
+        navigation.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"expensepage_newer_{encode_expense_cursor(first.created_at, first.id)}"))
+    if expenses and has_older:
+        last = expenses[-1]
+        navigation.append(InlineKeyboardButton("Older ➡️", callback_data=f"expensepage_older_{encode_expense_cursor(last.created_at, last.id)}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("⬅️ Go Back", callback_data='user_settings')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if expenses:
+        text = "Your expenses, newest first. Tap one to delete it:\n\n" + "\n".join(
+            f"📅 {(expense.date or expense.created_at):%Y-%m-%d} · 💶 {format_amount(expense.amount_cents, expense.currency)} · 🗂 {expense.name} · 📃 {expense.description or '-'}"
+            for expense in expenses
+        )
+    else:
+        text = "No expenses found."
+
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+######################
+## LAST EXPENSES
+async def show_last_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = await asyncio.to_thread(get_user_id, update.effective_user.id)
+    if user_id is None:
+        await update.message.reply_text("Register first with /start.")
+        return
+
+    expenses = await asyncio.to_thread(retrieve_last5_expenses, user_id)
+    if expenses is None:
+        await update.message.reply_text("There was an error retrieving your expenses.")
+        return
+    if not expenses:
+        await update.message.reply_text("You have no expenses yet.")
+        return
+
+    keyboard = [
+        [InlineKeyboardButton(f"❌ {format_amount(expense.amount_cents, expense.currency)} · {expense.name}", callback_data=f'deleteexpense_{expense.id}')]
+        for expense in expenses
+    ]
+    await update.message.reply_text("Your last expenses, newest first. Tap one to delete it:",
+                                    reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def undo_last_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = await asyncio.to_thread(get_user_id, update.effective_user.id)
+    if user_id is None:
+        await update.message.reply_text("Register first with /start.")
+        return
+
+    expense_id = await asyncio.to_thread(retrieve_last_expense_id, user_id)
+    if expense_id is None:
+        await update.message.reply_text("There is no expense to undo.")
+    elif await asyncio.to_thread(delete_expense, user_id, expense_id) and await save_changes():
+        await update.message.reply_text("↩️ Your last expense was deleted.")
+    else:
+        await update.message.reply_text("There was an error deleting your last expense.")
+
+
+######################
+## SEARCH
+SEARCH_PAGE_SIZE = 5
+SEARCH_USAGE = ("Usage: /search <words> [from:YYYY-MM-DD] [to:YYYY-MM-DD] [year:YYYY] [cat:<category>]\n"
+                "e.g. /search esselunga year:2026")
+
+def parse_search_args(args, user_id):
+    """Splits the /search arguments into words and filters. Raises ValueError on a bad filter."""
+    words, search = [], {'start': None, 'end': None, 'category_id': None, 'category': None}
+    for arg in args:
+        key, _, value = arg.partition(':')
+        key = key.lower()
+        if not value or key not in ('from', 'to', 'year', 'cat'):
+            words.append(arg)
+        elif key == 'from':
+            search['start'] = datetime.strptime(value, '%Y-%m-%d').date().isoformat()
+        elif key == 'to':
+            # Inclusive for the user, the queries take an exclusive end
+            search['end'] = (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).date().isoformat()
+        elif key == 'year':
+            year = datetime.strptime(value, '%Y').year
+            search['start'], search['end'] = f"{year}-01-01", f"{year + 1}-01-01"
+        else:
+            # Spaces in category names are typed as underscores
+            wanted = normalize_category_name(value.replace('_', ' '))
+            category = next((category for category in get_categories_and_id(user_id)
+                             if normalize_category_name(category.name) == wanted), None)
+            if category is None:
+                raise ValueError(f"Unknown category: {value}")
+            search['category_id'], search['category'] = category.id, category.name
+    search['terms'] = ' '.join(words)
+    return search
+
+
+def search_filters(search):
+    return {
+        'start_date': datetime.fromisoformat(search['start']) if search['start'] else None,
+        'end_date': datetime.fromisoformat(search['end']) if search['end'] else None,
+        'category_id': search['category_id'],
+    }
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_user_id = update.effective_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+    if user_id is None:
+        await update.message.reply_text("Register first with /start.")
+        return
+
+    try:
+        search = await asyncio.to_thread(parse_search_args, context.args, user_id)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{SEARCH_USAGE}")
+        return
+    if not search['terms'].strip():
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+
+    result = await asyncio.to_thread(search_totals, user_id, search['terms'], **search_filters(search))
+    if result is None:
+        await update.message.reply_text("There was an error searching your expenses.")
+        return
+    count, totals = result
+
+    filters_text = ''.join([
+        f" from {search['start']}" if search['start'] else '',
+        f" before {search['end']}" if search['end'] else '',
+        f" in {search['category']}" if search['category'] else '',
+    ])
+    total_text = ' + '.join(format_amount(total, currency) for currency, total in totals.items()) or format_amount(0)
+    search['summary'] = f"🔎 \"{search['terms']}\"{filters_text}: {count} expenses, {total_text}"
+    # Callback data is limited to 64 bytes, so the pages only carry a cursor and the search is kept here
+    context.user_data['search'] = search
+
+    text, reply_markup = await asyncio.to_thread(render_search_page, user_id, search, None)
+    await update.message.reply_text(text=text, reply_markup=reply_markup)
+
+
+async def show_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    tg_user_id = query.from_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+    search = context.user_data.get('search')
+    if search is None:
+        await query.edit_message_text(text="This search has expired, send /search again.")
+        return
+
+    # 'searchpage_first' goes back to the first page, 'searchpage_<cursor>' moves on from a cursor
+    cursor = query.data.split('_', 1)[1]
+    text, reply_markup = await asyncio.to_thread(render_search_page, user_id, search, None if cursor == 'first' else cursor)
+    await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+def render_search_page(user_id, search, cursor):
+    page = search_expenses(user_id, search['terms'], cursor=cursor, page_size=SEARCH_PAGE_SIZE,
+                           **search_filters(search))
+    if page is None:
+        return "There was an error searching your expenses.", None
+    expenses, has_more = page
+
+    navigation = []
+    if cursor is not None:
+        navigation.append(InlineKeyboardButton("⏮ First", callback_data='searchpage_first'))
+    if expenses and has_more:
+        last = expenses[-1]
+        navigation.append(InlineKeyboardButton("Older ➡️", callback_data=f"searchpage_{encode_expense_cursor(last.created_at, last.id)}"))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+
+    lines = [
+        f"📅 {(expense.date or expense.created_at):%Y-%m-%d} · 💶 {format_amount(expense.amount_cents, expense.currency)} · 🗂 {expense.name} · 📃 {expense.description or '-'}"
+        for expense in expenses
+    ]
+    return "\n\n".join([search['summary'], "\n".join(lines) or "No expenses found."]), reply_markup
+
+
+######################
+## TOTALS
+TOTAL_USAGE = ("Usage: /total [from:YYYY-MM-DD] [to:YYYY-MM-DD] [year:YYYY] [cat:<category>]\n"
+               "e.g. /total year:2026 cat:groceries")
+
+async def total_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = await asyncio.to_thread(get_user_id, update.effective_user.id)
+    if user_id is None:
+        await update.message.reply_text("Register first with /start.")
+        return
+
+    # Same filters as /search, without words
+    try:
+        search = await asyncio.to_thread(parse_search_args, context.args, user_id)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{TOTAL_USAGE}")
+        return
+    if search['terms']:
+        await update.message.reply_text(TOTAL_USAGE)
+        return
+
+    totals = await asyncio.to_thread(sum_expenses, user_id, **search_filters(search))
+    if totals is None:
+        await update.message.reply_text("There was an error computing your total.")
+        return
+
+    filters_text = ''.join([
+        f" from {search['start']}" if search['start'] else '',
+        f" before {search['end']}" if search['end'] else '',
+        f" in {search['category']}" if search['category'] else '',
+    ])
+    total_text = ' + '.join(format_amount(total, currency) for currency, total in totals.items()) or format_amount(0)
+    await update.message.reply_text(f"💶 Total{filters_text}: {total_text}")
+
+
 ######################
 ## GO BACK HOME
 async def go_backhome(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -371,7 +971,7 @@ async def ask_categoryname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # Acknowledge the callback query
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     
     logger.info(f"Received callback query for category name from user: {user_id}")
     keyboard = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
@@ -395,12 +995,19 @@ async def complete_categorycreation(update: Update, context: ContextTypes.DEFAUL
     context.user_data['category_description'] = update.message.text
 
     tg_user_id = update.effective_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
     category_name = context.user_data.get('category_name')
     category_description = context.user_data.get('category_description')
 
-    add_category(user_id,category_name,category_description)
+    try:
+        await asyncio.to_thread(add_category, user_id, category_name, category_description)
+    except ValueError as e:
+        await update.message.reply_text(f'{e}. Go back to /start')
+        return ConversationHandler.END
+    if not await save_changes():
+        await update.message.reply_text('There was an error creating the category. Go back to /start')
+        return ConversationHandler.END
 
     await update.message.reply_text('Category created! Go back to /start')
 
@@ -414,22 +1021,10 @@ async def send_inactive_category_list(update: Update, context: ContextTypes.DEFA
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
-
-    # Fetch categories and their IDs
-    categories = get_categories_and_id(user_id, 1)  # 1 for active categories
-
-    # Create inline keyboard buttons for each category
-    keyboard_buttons = [
-        [InlineKeyboardButton(category[0], callback_data=f"deactivate_{category[1]}")]
-        for category in categories
-    ]
-
-    # Add 'Cancel' button
-    keyboard_buttons.append([InlineKeyboardButton("⬅️ Cancel", callback_data='cancel')])
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
-    # Create InlineKeyboardMarkup
-    reply_markup = InlineKeyboardMarkup(keyboard_buttons)
+    # Cached category picker, rebuilt only when the categories change
+    reply_markup = await asyncio.to_thread(get_category_keyboard, user_id, 'deactivate')
 
     # Send the message with inline keyboard
     await context.bot.send_message(
@@ -443,12 +1038,12 @@ async def handle_category_deactivation(update: Update, context: ContextTypes.DEF
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     data = query.data
 
     if data.startswith('deactivate_'):
         category_id = int(data.split('_')[1])
-        success = change_category_status(user_id, category_id, False)
+        success = await asyncio.to_thread(change_category_status, user_id, category_id, False) and await save_changes()
         # Prepare response based on the operation success
         if success:
             response_message = "Category deactivated successfully."
@@ -470,22 +1065,10 @@ async def send_active_category_list(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
-
-    # Fetch categories and their IDs
-    categories = get_categories_and_id(user_id, 2)  # 2 for inactive categories
-
-    # Create inline keyboard buttons for each category
-    keyboard_buttons = [
-        [InlineKeyboardButton(category[0], callback_data=f"reactivate_{category[1]}")]
-        for category in categories
-    ]
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
-    # Add 'Cancel' button
-    keyboard_buttons.append([InlineKeyboardButton("⬅️ Cancel", callback_data='cancel')])
-
-    # Create InlineKeyboardMarkup
-    reply_markup = InlineKeyboardMarkup(keyboard_buttons)
+    # Cached category picker, rebuilt only when the categories change
+    reply_markup = await asyncio.to_thread(get_category_keyboard, user_id, 'reactivate')
 
     # Send the message with inline keyboard
     await context.bot.send_message(
@@ -499,13 +1082,13 @@ async def handle_category_reactivation(update: Update, context: ContextTypes.DEF
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
     data = query.data
 
     if data.startswith('reactivate_'):
         category_id = int(data.split('_')[1])
-        success = change_category_status(user_id, category_id, True)
+        success = await asyncio.to_thread(change_category_status, user_id, category_id, True) and await save_changes()
         # Prepare response based on the operation success
         if success:
             response_message = "Category re-activated successfully."
@@ -527,9 +1110,9 @@ async def list_categories_handler(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
 
-    categories_message = generate_categories_message(user_id)
+    categories_message = await asyncio.to_thread(generate_categories_message, user_id)
 
     keyboard = [
         [InlineKeyboardButton("⬅️ Go Back", callback_data='go_backhome')]
@@ -556,7 +1139,7 @@ async def ask_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # Acknowledge the callback query
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     
     logger.info(f"Received callback query for first name from user: {user_id}")
     keyboard = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
@@ -598,7 +1181,10 @@ async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TY
     first_name = context.user_data.get('first_name')
     last_name = context.user_data.get('last_name')
 
-    create_user(email, tg_user_id, chat_id, first_name, last_name)
+    await asyncio.to_thread(create_user, email, tg_user_id, chat_id, first_name, last_name)
+    if not await save_changes():
+        await update.message.reply_text('There was an error completing your registration, try again with /start')
+        return ConversationHandler.END
     await update.message.reply_text('Registration complete, go back to the home /start')
     return ConversationHandler.END
 
@@ -627,7 +1213,7 @@ async def ask_spreadsheetid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # Acknowledge the callback query
 
     tg_user_id = query.from_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     
     logger.info(f"Received callback query for spreadsheet_id from user: {user_id}")
     keyboard = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
@@ -661,17 +1247,86 @@ async def complete_spreadsheetcreation(update: Update, context: ContextTypes.DEF
         return SHEET_NAME
     
     tg_user_id = update.effective_user.id
-    user_id = get_user_id(tg_user_id)
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
     spreadsheet_id = context.user_data.get('spreadsheet_id')
     sheet_name = context.user_data.get('sheet_name')
 
-    add_basicinfo(user_id,spreadsheet_id,sheet_name)
+    await asyncio.to_thread(add_basicinfo, user_id, spreadsheet_id, sheet_name)
     authurl = get_google_auth_url()
 
     await update.message.reply_text(f'Grant the bot access using this link {authurl}')
 
     return ConversationHandler.END
 
+######################
+## GSHEET BACKFILL
+# Seconds between two edits of the progress message
+BACKFILL_PROGRESS_INTERVAL = 3
+_backfills_running = set()
+
+async def start_gsheet_backfill(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    tg_user_id = query.from_user.id
+    user_id = await asyncio.to_thread(get_user_id, tg_user_id)
+
+    if user_id in _backfills_running:
+        await query.message.reply_text("The export to your Google Sheet is already running.")
+        return
+
+    message = await query.message.reply_text("⬆️ Exporting your expenses to Google Sheets...")
+    _backfills_running.add(user_id)
+    # Runs in the background, so the user's next updates are not queued behind the export
+    context.application.create_task(outside_unit_of_work(run_gsheet_backfill(user_id, message)))
+
+
+async def run_gsheet_backfill(user_id, message):
+    loop = asyncio.get_running_loop()
+    edits = []
+    last_edit = 0
+
+    def progress(exported, total):
+        # Called from the worker thread after every page
+        nonlocal last_edit
+        if time.monotonic() - last_edit < BACKFILL_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        edits.append(asyncio.run_coroutine_threadsafe(
+            message.edit_text(f"⬆️ Exporting your expenses to Google Sheets... {exported}/{total}"), loop))
+
+    try:
+        exported = await asyncio.to_thread(backfill_expenses_to_sheet, user_id, progress)
+        if exported is None:
+            text = "Connect your Google Sheet first from 🔗 GSheet Settings."
+        else:
+            text = f"✅ Export completed: {exported} expenses added to your Google Sheet."
+    except Exception as e:
+        logger.error(f"Google Sheets backfill of user {user_id} stopped: {e}")
+        text = "⚠️ The export stopped. Push again to resume from where it stopped."
+    finally:
+        _backfills_running.discard(user_id)
+
+    # The final message must not be overwritten by a late progress edit
+    await asyncio.gather(*(asyncio.wrap_future(edit) for edit in edits), return_exceptions=True)
+    await message.edit_text(text)
+
+async def reconcile_google_sheets(context: ContextTypes.DEFAULT_TYPE):
+    # Two-way sync of the exported rows, sheets with an export running are synced on the next pass
+    user_ids = await asyncio.to_thread(get_synced_users)
+    for user_id in user_ids:
+        if user_id in _backfills_running or user_id in _deletions_running:
+            continue
+        try:
+            await asyncio.to_thread(reconcile_sheet, user_id)
+        except Exception as e:
+            logger.error(f"Google Sheets sync of user {user_id} failed: {e}")
+
+######################
+## UPDATE DEDUPLICATION
+async def prune_update_keys(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(prune_processed_updates)
+
 ######################
 ## CANCEL
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -679,11 +1334,50 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Conversation cancelled. Type /start to begin again.')
     return ConversationHandler.END
 
+######################
+## METRICS
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE):
+    metrics.log_snapshot()
+    log_pool_stats()
+
+######################
+## GOOGLE TOKENS
+async def write_back_google_tokens(context: ContextTypes.DEFAULT_TYPE):
+    # Tokens refreshed during a sync burst are stored together
+    await asyncio.to_thread(flush_refreshed_tokens)
+
+######################
+## WARM-UP
+# Longest wait for the warm-up before updates are accepted anyway
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 20))
+
+async def warm_up_bot(application):
+    # Runs after the bot is initialized (its getMe opened the Telegram pool) and before polling starts
+    workers = application.update_processor.max_workers
+    try:
+        results = await asyncio.wait_for(asyncio.to_thread(warm_up, workers), timeout=WARMUP_TIMEOUT)
+        logger.info(f"Warm-up completed: {results}")
+    except asyncio.TimeoutError:
+        logger.warning(f"Warm-up still running after {WARMUP_TIMEOUT}s, accepting updates meanwhile")
+
 #####################
 ## BOT HANDLERS
 
 def run_bot():
-    application = ApplicationBuilder().token(API_KEY).build()
+    # Different users are served in parallel, each user's updates stay in order
+    # Resent updates and double-tapped buttons are dropped before reaching the handlers
+    update_processor = PerUserUpdateProcessor(max_workers=int(os.getenv('BOT_MAX_WORKERS', 8)),
+                                              deduplicator=UpdateDeduplicator())
+    # Keep-alive pools: one for bot API calls, one for the long polling getUpdates
+    application = ApplicationBuilder().token(API_KEY)\
+                                      .request(telegram_request())\
+                                      .get_updates_request(telegram_request('telegram_updates'))\
+                                      .persistence(DatabasePersistence())\
+                                      .concurrent_updates(update_processor)\
+                                      .post_init(warm_up_bot)\
+                                      .build()
+    # A failed update is rolled back, the Application hands the handlers' errors to this handler
+    application.add_error_handler(rollback_failed_update)
 
     ## COMMANDS
     #START
@@ -701,17 +1395,46 @@ def run_bot():
     expense_delete_handler = CallbackQueryHandler(handle_expense_delete, pattern='^deleteexpense_')
     application.add_handler(expense_delete_handler)
 
+    ## RECURRING EXPENSES
+    application.add_handler(CallbackQueryHandler(handle_make_recurring, pattern='^makerecurring_'))
+    application.add_handler(CallbackQueryHandler(handle_stop_recurring, pattern='^stoprecurring_'))
+    application.job_queue.run_repeating(materialize_recurring_expenses,
+                                        interval=int(os.getenv('RECURRING_INTERVAL', 300)), first=10,
+                                        name='recurring_expenses')
+
+    ## METRICS
+    application.job_queue.run_repeating(log_metrics,
+                                        interval=int(os.getenv('METRICS_LOG_INTERVAL', 600)),
+                                        name='log_metrics')
+
+    ## GOOGLE TOKENS
+    application.job_queue.run_repeating(write_back_google_tokens,
+                                        interval=int(os.getenv('GOOGLE_TOKEN_FLUSH_INTERVAL', 30)),
+                                        name='google_tokens')
+
+    ## GSHEET SYNC
+    application.job_queue.run_repeating(reconcile_google_sheets,
+                                        interval=int(os.getenv('GSHEET_SYNC_INTERVAL', 300)), first=60,
+                                        name='gsheet_sync')
+
+    ## UPDATE DEDUPLICATION
+    application.job_queue.run_repeating(prune_update_keys, interval=3600, first=300, name='prune_update_keys')
+
     ## ADD EXPENSE FLOW
     newexpense_conv_handler = ConversationHandler(
-    entry_points=[CallbackQueryHandler(start_expensecreation, pattern='^add_expense$')],
+    entry_points=[CallbackQueryHandler(start_expensecreation, pattern='^add_expense(_prefilled)?$')],
     states={
-        EXPENSE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_expensecategory)],
+        EXPENSE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_expensecategory),
+                         CallbackQueryHandler(ask_expensecategory, pattern='^prefill_amount$')],
         EXPENSE_CATEGORY: [CallbackQueryHandler(ask_expensedescription, pattern='^expensecat_')],
-        EXPENSE_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_expensedate)],
+        EXPENSE_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_expensedate),
+                              CallbackQueryHandler(ask_expensedate, pattern='^prefill_description$')],
         EXPENSE_DATE: [CallbackQueryHandler(complete_expensecreation, pattern='^date_')]
     },
     fallbacks=[CallbackQueryHandler(cancel_registration, pattern='^cancel$')],
-    per_message=False
+    per_message=False,
+    name='expense_creation',
+    persistent=True
     )
     application.add_handler(newexpense_conv_handler)
 
@@ -726,7 +1449,9 @@ def run_bot():
         CANCEL: [CallbackQueryHandler(cancel_registration, pattern='^cancel$')]
     },
     fallbacks=[CallbackQueryHandler(cancel_registration, pattern='^cancel$')],
-    per_message=False  # Changed to False
+    per_message=False,  # Changed to False
+    name='registration',
+    persistent=True
     )
     application.add_handler(registration_conv_handler)
 
@@ -734,6 +1459,10 @@ def run_bot():
     settings_handler = CallbackQueryHandler(show_settings, pattern='^user_settings$')
     application.add_handler(settings_handler)
 
+    ## EXPENSE HISTORY
+    expense_history_handler = CallbackQueryHandler(show_expense_page, pattern='^(delete_expense|expensepage_(newer|older)_.+)$')
+    application.add_handler(expense_history_handler)
+
     ## SPREADSHEET SETUP
     spreadsheet_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler( get_spreadsheet,pattern = '^connect_gsheet$')],
@@ -742,10 +1471,20 @@ def run_bot():
             SHEET_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, complete_spreadsheetcreation)]
         },
         fallbacks=[CallbackQueryHandler(cancel_registration, pattern='^cancel$')],
-        per_message=False
+        per_message=False,
+        name='spreadsheet_setup',
+        persistent=True
     )
     application.add_handler(spreadsheet_conv_handler)
 
+    ## GSHEET BACKFILL
+    application.add_handler(CallbackQueryHandler(start_gsheet_backfill, pattern='^gsheet_backfill$'))
+
+    ## ACCOUNT
+    application.add_handler(CallbackQueryHandler(show_account_settings, pattern='^account_settings$'))
+    application.add_handler(CallbackQueryHandler(ask_account_deletion, pattern='^delete_account$'))
+    application.add_handler(CallbackQueryHandler(start_account_deletion, pattern='^delete_account_confirm$'))
+
     ## CATEGORY SETTINGS
     cat_settings_handler = CallbackQueryHandler(show_cat_setting, pattern='^manage_categories$')
     application.add_handler(cat_settings_handler)
@@ -762,7 +1501,9 @@ def run_bot():
             CATEGORY_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, complete_categorycreation)]
         },
         fallbacks=[CallbackQueryHandler(cancel_registration, pattern='^cancel$')],
-        per_message=False
+        per_message=False,
+        name='category_creation',
+        persistent=True
     )
     application.add_handler(newcat_conversation_handler)
 
@@ -780,6 +1521,17 @@ def run_bot():
     category_reactivation_handler = CallbackQueryHandler(handle_category_reactivation, pattern='^reactivate_')
     application.add_handler(category_reactivation_handler)
 
+    ## TOTALS
+    application.add_handler(CommandHandler('total', total_command))
+
+    ## LAST EXPENSES
+    application.add_handler(CommandHandler('last', show_last_expenses))
+    application.add_handler(CommandHandler('undo', undo_last_expense))
+
+    ## SEARCH
+    application.add_handler(CommandHandler('search', search_command))
+    application.add_handler(CallbackQueryHandler(show_search_page, pattern='^searchpage_'))
+
     ## BACK HOME
     go_backhome_handler = CallbackQueryHandler(go_backhome, pattern='^go_backhome$')
     application.add_handler(go_backhome_handler)
@@ -0,0 +1,56 @@
+# Standard library imports
+import os
+import sys
+import json
+import tempfile
+
+# Third-party imports
+import pytest
+
+# The app modules configure themselves on import: they log to ./logs, read the database URI
+# from the environment and gsheet builds the Google auth URL from the OAuth client file. The
+# tests run them in a scratch directory against a SQLite file.
+_workdir = tempfile.mkdtemp(prefix='expensebot-tests-')
+os.makedirs(os.path.join(_workdir, 'logs'))
+with open(os.path.join(_workdir, 'client_secret_413293732491-pdfv31n1tct9o1kdeace1qv1v03r7rt9.apps.googleusercontent.com.json'), 'w') as f:
+    json.dump({'installed': {'client_id': 'test', 'client_secret': 'test',
+                             'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+                             'token_uri': 'https://oauth2.googleapis.com/token',
+                             'redirect_uris': ['http://localhost']}}, f)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(_workdir)
+os.environ['DATABASE_URI'] = f'sqlite:///{_workdir}/test.db'
+os.environ.pop('DATABASE_REPLICA_URIS', None)
+os.environ.setdefault('OPENAI_KEY', 'test')
+
+
+@pytest.fixture
+def db():
+    """Fresh tables for every test."""
+    from app import users, categories, classifier, recent, whispergpt
+    from app.db_utils import engine
+    from app.models import Base
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    # IDs start over with the tables, so do the in-memory caches keyed by them
+    users._user_id_cache.clear()
+    categories._category_versions.clear()
+    classifier._classifiers.clear()
+    recent._buffers.clear()
+    whispergpt._category_prompts.clear()
+    yield engine
+
+
+@pytest.fixture
+def user(db):
+    """A registered user with one category, as (user_id, category_id)."""
+    from app.db_utils import Session
+    from app.models import User, Category
+    with Session() as session:
+        user = User(telegram_id=1000, chat_id='1000', email='user@example.com')
+        session.add(user)
+        session.flush()
+        category = Category(user_id=user.id, name='Groceries', name_normalized='groceries')
+        session.add(category)
+        session.commit()
+        return user.id, category.id
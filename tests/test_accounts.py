@@ -0,0 +1,56 @@
+# Standard library imports
+from datetime import datetime
+
+# Third-party imports
+import pytest
+from sqlalchemy.exc import OperationalError
+
+# Local application imports
+from app import accounts
+from app.accounts import delete_account
+from app.db_utils import Session
+from app.models import User, Expense
+
+
+def add_expenses(user_id, category_id, count):
+    with Session() as session:
+        session.add_all([Expense(user_id=user_id, category_id=category_id, amount_cents=100, description='expense',
+                                 date=datetime(2026, 1, 1)) for _ in range(count)])
+        session.commit()
+
+
+def test_delete_account_removes_everything(user):
+    user_id, category_id = user
+    add_expenses(user_id, category_id, 5)
+
+    deleted = delete_account(user_id, batch_size=2)
+
+    assert (deleted['expenses'], deleted['categories'], deleted['users']) == (5, 1, 1)
+    assert delete_account(user_id) is None
+
+
+def test_deletion_failing_after_the_user_row_can_be_resumed(user, monkeypatch):
+    user_id, category_id = user
+    add_expenses(user_id, category_id, 3)
+    delete_in_batches = accounts._delete_in_batches
+    calls = []
+
+    def fail_in_the_last_sweep(*args):
+        calls.append(args[0])
+        if len(calls) > len(accounts.ACCOUNT_TABLES):
+            # An update that was already running wrote after the user row was deleted
+            add_expenses(user_id, category_id, 1)
+            raise OperationalError('DELETE', {}, Exception('lost connection'))
+        return delete_in_batches(*args)
+    monkeypatch.setattr(accounts, '_delete_in_batches', fail_in_the_last_sweep)
+
+    with pytest.raises(OperationalError):
+        delete_account(user_id)
+    monkeypatch.setattr(accounts, '_delete_in_batches', delete_in_batches)
+
+    deleted = delete_account(user_id)
+
+    assert deleted['expenses'] == 1
+    with Session() as session:
+        assert session.query(Expense).count() == 0
+        assert session.query(User).count() == 0
@@ -0,0 +1,46 @@
+# Standard library imports
+from decimal import Decimal
+
+# Third-party imports
+import pytest
+
+# Local application imports
+from app.expenses import parse_amount, format_amount
+
+
+@pytest.mark.parametrize('amount, cents', [
+    ('12', 1200),
+    ('12.5', 1250),
+    ('12,50', 1250),
+    ('0.05', 5),
+    ('1.000', 100000),
+    ('0.500', 50),
+    ('0,500', 50),
+    ('1,000,000', 100000000),
+    ('1.234,56', 123456),
+    ('1,234.56', 123456),
+    ('€ 7,99', 799),
+    (12.3, 1230),
+    (5, 500),
+    (Decimal('0.1'), 10),
+])
+def test_parse_amount(amount, cents):
+    assert parse_amount(amount) == cents
+
+
+@pytest.mark.parametrize('amount', ['', 'abc', '-5', '1.2.3,4', '1,23.45', '0.500.000', '0.123,45', None, True, -1, float('nan')])
+def test_parse_amount_rejects(amount):
+    with pytest.raises(ValueError):
+        parse_amount(amount)
+
+
+@pytest.mark.parametrize('cents, currency, text', [
+    (1250, 'EUR', '12.50€'),
+    (5, 'EUR', '0.05€'),
+    (0, 'EUR', '0.00€'),
+    (-150, 'EUR', '-1.50€'),
+    (-5, 'USD', '-0.05$'),
+    (123456, 'CHF', '1234.56 CHF'),
+])
+def test_format_amount(cents, currency, text):
+    assert format_amount(cents, currency) == text
@@ -0,0 +1,39 @@
+# Local application imports
+from app import whispergpt
+from app.categories import (add_category, change_category_status, get_category_version,
+                            has_uncommitted_category_changes)
+from app.db_utils import begin_unit_of_work, end_unit_of_work, commit_unit_of_work, rollback_unit_of_work
+
+
+def test_category_version_changes_on_commit(user):
+    user_id, category_id = user
+    version = get_category_version(user_id)
+
+    session, token = begin_unit_of_work()
+    try:
+        add_category(user_id, 'Travel')
+        assert get_category_version(user_id) == version
+        assert has_uncommitted_category_changes(user_id)
+        # Built from the uncommitted category, so not cached
+        assert [name for name, _ in whispergpt.get_category_prompt(user_id)[0]] == ['Groceries', 'Travel']
+        assert user_id not in whispergpt._category_prompts
+    finally:
+        end_unit_of_work(token)
+        commit_unit_of_work(session)
+
+    assert get_category_version(user_id) == version + 1
+    assert not has_uncommitted_category_changes(user_id)
+
+
+def test_rolled_back_category_change_keeps_the_version(user):
+    user_id, category_id = user
+    version = get_category_version(user_id)
+
+    session, token = begin_unit_of_work()
+    try:
+        change_category_status(user_id, category_id, False)
+    finally:
+        end_unit_of_work(token)
+        rollback_unit_of_work(session)
+
+    assert get_category_version(user_id) == version
@@ -0,0 +1,59 @@
+# Standard library imports
+from datetime import datetime
+
+# Third-party imports
+from sqlalchemy import event, insert
+
+# Local application imports
+from app.db_utils import Session, engine
+from app.expenses import add_expenses
+from app.models import Expense
+
+
+def test_add_expenses_returns_its_own_ids(user):
+    user_id, category_id = user
+    now = datetime.utcnow().replace(microsecond=0)
+
+    # Another writer, e.g. the recurring job, adds an expense of the same user in the same second,
+    # right after the batch is inserted
+    inserted = []
+
+    def concurrent_insert(connection, clauseelement, multiparams, params, execution_options, result):
+        if not inserted and getattr(clauseelement, 'is_insert', False) and getattr(clauseelement.table, 'name', None) == 'expenses':
+            inserted.append(True)
+            connection.execute(insert(Expense).values(
+                user_id=user_id, category_id=category_id, amount_cents=999, description='recurring',
+                date=now, created_at=now))
+    event.listen(engine, 'after_execute', concurrent_insert)
+
+    try:
+        ids = add_expenses(user_id, [
+            {'amount': '1.50', 'category_id': category_id, 'description': 'first', 'date': now},
+            {'amount': '2', 'category_id': category_id, 'description': 'second', 'date': now},
+        ])
+    finally:
+        event.remove(engine, 'after_execute', concurrent_insert)
+
+    assert inserted
+    with Session() as session:
+        assert [session.get(Expense, expense_id).description for expense_id in ids] == ['first', 'second']
+
+
+def test_add_expenses_uses_one_insert(user):
+    user_id, category_id = user
+    inserts = []
+
+    def count_inserts(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO expenses'):
+            inserts.append(statement)
+    event.listen(engine, 'before_cursor_execute', count_inserts)
+
+    try:
+        ids = add_expenses(user_id, [{'amount': str(index), 'category_id': category_id, 'description': f'expense {index}'}
+                                     for index in range(1, 4)])
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_inserts)
+
+    assert len(inserts) == 1
+    with Session() as session:
+        assert [session.get(Expense, expense_id).amount_cents for expense_id in ids] == [100, 200, 300]
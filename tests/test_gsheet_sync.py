@@ -0,0 +1,216 @@
+# Standard library imports
+import re
+from datetime import datetime
+
+# Third-party imports
+import pytest
+
+# Local application imports
+from app import gsheet, gsheet_sync
+from app.classifier import get_classifier
+from app.db_utils import Session, engine
+from app.models import Expense, UserGoogleSheetsCredentials
+
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+class FakeSheet:
+    """
+    In-memory spreadsheet behind a fake SheetsClient.
+
+    USER_ENTERED input is parsed like Sheets does: formulas are evaluated, dates and numbers
+    converted. RAW input is stored as is.
+    """
+
+    def __init__(self):
+        self.cells = {}  # (sheet, row, column index) -> value
+        self.connections_during_requests = []
+        self.spreadsheet_id = 'spreadsheet'
+        self.sheet_name = 'Sheet1'
+        self.values = self
+
+    @staticmethod
+    def _parse_range(a1):
+        sheet, cells = a1.rsplit('!', 1)
+        match = re.fullmatch(r'([A-Z])(\d+)(?::([A-Z])(\d+))?', cells)
+        first_column, first_row = ord(match.group(1)) - ord('A'), int(match.group(2))
+        last_column = ord(match.group(3) or match.group(1)) - ord('A')
+        last_row = int(match.group(4) or match.group(2))
+        return sheet.strip("'").replace("''", "'"), first_row, last_row, first_column, last_column
+
+    @staticmethod
+    def _user_entered(value):
+        if not isinstance(value, str):
+            return value
+        if value.startswith('='):
+            return f'evaluated {value}'
+        if re.fullmatch(r'\d{4}-\d\d-\d\d', value):
+            return (datetime.strptime(value, '%Y-%m-%d') - SHEETS_EPOCH).days
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    def _write(self, a1, values, value_input_option):
+        sheet, first_row, _, first_column, _ = self._parse_range(a1)
+        for row_offset, row in enumerate(values):
+            for column_offset, value in enumerate(row):
+                if value_input_option == 'USER_ENTERED':
+                    value = self._user_entered(value)
+                self.cells[(sheet, first_row + row_offset, first_column + column_offset)] = value
+
+    def _read(self, a1):
+        sheet, first_row, last_row, first_column, last_column = self._parse_range(a1)
+        if sheet == gsheet_sync.SYNC_SHEET:
+            # The fingerprint formulas: any change in a block changes its value
+            blocks = []
+            for block in range(first_row - 1, last_row):
+                first = 2 + block * gsheet_sync.SYNC_BLOCK_ROWS
+                cells = f"'{self.sheet_name}'!A{first}:F{first + gsheet_sync.SYNC_BLOCK_ROWS - 1}"
+                blocks.append([repr(self._read(cells))])
+            return blocks
+        return [[self.cells.get((sheet, row, column), '') for column in range(first_column, last_column + 1)]
+                for row in range(first_row, last_row + 1)]
+
+    def execute(self, request, num_retries=2):
+        # No database connection, and so no transaction, is held across a Sheets request
+        self.connections_during_requests.append(engine.pool.checkedout())
+        return request()
+
+    # values() API
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        return lambda: self._write(range, body['values'], valueInputOption)
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return lambda: {'values': self._read(range)}
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return lambda: {'valueRanges': [{'values': self._read(a1)} for a1 in ranges]}
+
+    def batchUpdate(self, spreadsheetId, body):
+        return lambda: [self._write(value_range['range'], value_range['values'], body['valueInputOption'])
+                        for value_range in body['data']]
+
+    def batchClear(self, spreadsheetId, body):
+        def clear():
+            for a1 in body['ranges']:
+                sheet, first_row, last_row, first_column, last_column = self._parse_range(a1)
+                for row in range(first_row, last_row + 1):
+                    for column in range(first_column, last_column + 1):
+                        self.cells.pop((sheet, row, column), None)
+        return clear
+
+    # spreadsheets() API, used to add the hidden sync sheet
+    def spreadsheets(self):
+        return self
+
+
+@pytest.fixture
+def sheet(user, monkeypatch):
+    user_id, _ = user
+    fake = FakeSheet()
+    with Session() as session:
+        session.add(UserGoogleSheetsCredentials(user_id=user_id, spreadsheet_id=fake.spreadsheet_id,
+                                                sheet_name=fake.sheet_name))
+        session.commit()
+    monkeypatch.setattr(gsheet, 'get_sheets_client', lambda user_id: fake)
+    monkeypatch.setattr(gsheet_sync, 'get_sheets_client', lambda user_id: fake)
+    monkeypatch.setattr(gsheet_sync, '_ensure_sync_sheet', lambda client: None)
+    return fake
+
+
+DESCRIPTIONS = ['=HYPERLINK("http://example.com")', '+39333', '1e5', '3/4', 'Esselunga']
+
+
+def add_expenses(user):
+    user_id, category_id = user
+    with Session() as session:
+        expenses = [Expense(user_id=user_id, category_id=category_id, amount_cents=150, currency='EUR',
+                            description=description, date=datetime(2026, 1, 1 + index))
+                    for index, description in enumerate(DESCRIPTIONS)]
+        session.add_all(expenses)
+        session.commit()
+        return [expense.id for expense in expenses]
+
+
+def stored_descriptions(ids):
+    with Session() as session:
+        return [session.get(Expense, expense_id).description for expense_id in ids]
+
+
+def test_descriptions_round_trip_as_text(user, sheet):
+    ids = add_expenses(user)
+
+    assert gsheet.backfill_expenses_to_sheet(user[0]) == len(ids)
+    # Written RAW: never parsed into formulas or numbers
+    assert [sheet.cells[('Sheet1', row, 5)] for row in range(2, 2 + len(ids))] == DESCRIPTIONS
+    # Date and amount are still real values
+    assert sheet.cells[('Sheet1', 2, 1)] == (datetime(2026, 1, 1) - SHEETS_EPOCH).days
+    assert sheet.cells[('Sheet1', 2, 2)] == 1.5
+
+    for _ in range(2):
+        summary = gsheet_sync.reconcile_sheet(user[0])
+        assert summary['pulled'] == 0
+    assert stored_descriptions(ids) == DESCRIPTIONS
+
+
+def test_bot_edits_are_pushed_raw(user, sheet):
+    ids = add_expenses(user)
+    gsheet.backfill_expenses_to_sheet(user[0])
+    gsheet_sync.reconcile_sheet(user[0])
+
+    with Session() as session:
+        expense = session.get(Expense, ids[-1])
+        expense.description = '=1+1'
+        expense.updated_at = datetime(2100, 1, 1)
+        session.commit()
+
+    assert gsheet_sync.reconcile_sheet(user[0])['pushed'] == 1
+    assert sheet.cells[('Sheet1', 1 + len(ids), 5)] == '=1+1'
+    assert gsheet_sync.reconcile_sheet(user[0])['pulled'] == 0
+    assert stored_descriptions(ids)[-1] == '=1+1'
+
+
+def test_sheet_edits_are_pulled(user, sheet):
+    ids = add_expenses(user)
+    gsheet.backfill_expenses_to_sheet(user[0])
+    gsheet_sync.reconcile_sheet(user[0])
+
+    sheet.cells[('Sheet1', 2 + len(ids) - 1, 5)] = 'Esselunga Milano'
+
+    assert gsheet_sync.reconcile_sheet(user[0])['pulled'] == 1
+    assert stored_descriptions(ids)[-1] == 'Esselunga Milano'
+
+
+def test_sync_holds_no_transaction_during_sheets_requests(user, sheet):
+    ids = add_expenses(user)
+    gsheet.backfill_expenses_to_sheet(user[0])
+    gsheet_sync.reconcile_sheet(user[0])
+    sheet.cells[('Sheet1', 2, 5)] = 'edited in the sheet'
+    with Session() as session:
+        session.get(Expense, ids[-1]).updated_at = datetime(2100, 1, 1)
+        session.commit()
+    sheet.connections_during_requests.clear()
+
+    summary = gsheet_sync.reconcile_sheet(user[0])
+
+    assert (summary['pulled'], summary['pushed']) == (1, 1)
+    assert set(sheet.connections_during_requests) == {0}
+
+
+def test_pulled_edits_relabel_the_classifier(user, sheet):
+    user_id, category_id = user
+    with Session() as session:
+        session.add(Expense(user_id=user_id, category_id=category_id, amount_cents=150, currency='EUR',
+                            description='pizza', date=datetime(2026, 1, 1)))
+        session.commit()
+    gsheet.backfill_expenses_to_sheet(user_id)
+    gsheet_sync.reconcile_sheet(user_id)
+    classifier = get_classifier(user_id)
+    assert classifier.known('pizza')
+
+    sheet.cells[('Sheet1', 2, 5)] = 'sushi'
+    gsheet_sync.reconcile_sheet(user_id)
+
+    assert not classifier.known('pizza')
+    assert classifier.known('sushi')
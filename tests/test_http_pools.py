@@ -0,0 +1,24 @@
+import httpx
+
+from app import http_pools
+from app.http_pools import MeteredTransport, pool_stats
+
+
+def test_pool_stats_counts_requests_without_pool_internals(monkeypatch):
+    transport = MeteredTransport('test')
+    # A mock transport has no connection pool: the stats fall back instead of failing
+    mock = httpx.MockTransport(lambda request: httpx.Response(200, extensions={'http_version': b'HTTP/2'}))
+    monkeypatch.setattr(transport, '_transport', mock)
+    monkeypatch.setattr(transport, '_inner', lambda: mock)
+    try:
+        with httpx.Client(transport=transport) as client:
+            client.get('https://example.com/')
+            client.get('https://example.com/')
+            stats = pool_stats()
+
+        assert stats['test']['requests'] == 2
+        assert stats['test']['http2_requests'] == 2
+        assert stats['test']['open'] is None and stats['test']['idle'] is None
+        assert stats['google_auth']['requests'] == 0
+    finally:
+        http_pools._transports.pop('test', None)
@@ -0,0 +1,36 @@
+# Third-party imports
+from sqlalchemy import inspect, text
+
+# Local application imports
+from app.db_utils import engine
+from app.migrations import NEW_TABLES, migrate_new_tables, migrate_expense_indexes
+from app.search import search_expenses
+
+
+def test_new_tables_and_expense_indexes_are_added(user):
+    user_id, category_id = user
+    # A database of the previous release: none of the new tables or indexes
+    with engine.begin() as connection:
+        for model in NEW_TABLES:
+            connection.execute(text(f'DROP TABLE {model.__tablename__}'))
+        connection.execute(text('DROP TABLE expenses_fts'))
+        for trigger in ('insert', 'delete', 'update'):
+            connection.execute(text(f'DROP TRIGGER expenses_fts_{trigger}'))
+        connection.execute(text('DROP INDEX ix_expenses_user_created_id'))
+        connection.execute(text('DROP INDEX ix_expenses_user_date_amount'))
+        connection.execute(text('INSERT INTO expenses (amount_cents, currency, user_id, category_id, description) '
+                                f"VALUES (150, 'EUR', {user_id}, {category_id}, 'Esselunga')"))
+
+    migrate_new_tables()
+    migrate_expense_indexes()
+    # Running them again changes nothing
+    migrate_new_tables()
+    migrate_expense_indexes()
+
+    inspector = inspect(engine)
+    assert {model.__tablename__ for model in NEW_TABLES} <= set(inspector.get_table_names())
+    assert {'ix_expenses_user_created_id', 'ix_expenses_user_date_amount'} <= \
+        {index['name'] for index in inspector.get_indexes('expenses')}
+    # The existing descriptions are searchable
+    expenses, _ = search_expenses(user_id, 'esse')
+    assert [expense.description for expense in expenses] == ['Esselunga']
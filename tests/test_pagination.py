@@ -0,0 +1,59 @@
+# Standard library imports
+from datetime import datetime, timedelta
+
+# Local application imports
+from app.db_utils import Session
+from app.expenses import encode_expense_cursor, decode_expense_cursor, retrieve_expenses_page
+from app.models import Expense
+
+
+def add_expenses(user_id, category_id, count):
+    # Pairs of expenses share their creation second, the id breaks the tie
+    start = datetime(2026, 1, 1)
+    with Session() as session:
+        expenses = [Expense(user_id=user_id, category_id=category_id, amount_cents=100, description=f'expense {index}',
+                            date=start, created_at=start + timedelta(seconds=index // 2))
+                    for index in range(count)]
+        session.add_all(expenses)
+        session.commit()
+        return [expense.id for expense in expenses]
+
+
+def cursor_of(expense):
+    return encode_expense_cursor(expense.created_at, expense.id)
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 3, 4, 5, 6, 7, 890)
+
+    assert decode_expense_cursor(encode_expense_cursor(created_at, 123)) == (created_at, 123)
+
+
+def test_pages_cover_every_expense_once(user):
+    user_id, category_id = user
+    ids = add_expenses(user_id, category_id, 7)
+
+    seen = []
+    cursor = None
+    while True:
+        expenses, has_newer, has_older = retrieve_expenses_page(user_id, cursor, page_size=2)
+        assert has_newer == (cursor is not None)
+        seen += [expense.id for expense in expenses]
+        if not has_older:
+            break
+        cursor = cursor_of(expenses[-1])
+
+    assert seen == list(reversed(ids))
+
+
+def test_newer_page_goes_back(user):
+    user_id, category_id = user
+    ids = list(reversed(add_expenses(user_id, category_id, 6)))
+    first, _, _ = retrieve_expenses_page(user_id, page_size=2)
+    second, _, _ = retrieve_expenses_page(user_id, cursor_of(first[-1]), page_size=2)
+    third, _, _ = retrieve_expenses_page(user_id, cursor_of(second[-1]), page_size=2)
+
+    expenses, has_newer, has_older = retrieve_expenses_page(user_id, cursor_of(third[0]), direction='newer', page_size=2)
+
+    assert [expense.id for expense in expenses] == ids[2:4]
+    assert has_newer and has_older
@@ -0,0 +1,40 @@
+# Standard library imports
+import json
+import asyncio
+
+# Local application imports
+from app import persistence
+from app.db_utils import Session
+from app.models import BotUserData, BotConversation
+from app.persistence import DatabasePersistence
+
+
+def test_write_upserts_and_deletes(db):
+    DatabasePersistence._write({1: {'step': 1}, 2: {'step': 1}}, {('expense_creation', '[1, 1]'): 2})
+    # A second flush updates the stored rows in place
+    DatabasePersistence._write({1: {'step': 2}, 2: None}, {('expense_creation', '[1, 1]'): 3})
+
+    with Session() as session:
+        assert {row.telegram_user_id: json.loads(row.data) for row in session.query(BotUserData)} == {1: {'step': 2}}
+        assert [(row.name, row.conversation_key, json.loads(row.state)) for row in session.query(BotConversation)] \
+            == [('expense_creation', '[1, 1]', 3)]
+
+    DatabasePersistence._write({}, {('expense_creation', '[1, 1]'): None})
+    with Session() as session:
+        assert session.query(BotConversation).count() == 0
+
+
+def test_forgotten_users_are_loaded_again(db, monkeypatch):
+    monkeypatch.setattr(persistence, 'PERSISTENCE_LOADED_USERS', 2)
+    DatabasePersistence._write({1: {'step': 1}}, {})
+    store = DatabasePersistence()
+
+    async def run():
+        for user_id in (1, 2, 3):
+            await store.refresh_user_data(user_id, {})
+        user_data = {}
+        await store.refresh_user_data(1, user_data)
+        return user_data
+
+    assert asyncio.run(run()) == {'step': 1}
+    assert list(store._loaded_users) == [3, 1]
@@ -0,0 +1,84 @@
+# Standard library imports
+from datetime import datetime, timedelta
+
+# Third-party imports
+from sqlalchemy import delete
+
+# Local application imports
+from app import recent
+from app.categories import bump_category_version
+from app.db_utils import Session
+from app.models import Category, Expense
+
+
+def add_expenses(user_id, category_id, count, start):
+    with Session() as session:
+        expenses = [Expense(user_id=user_id, category_id=category_id, amount_cents=100, description=f'expense {index}',
+                            date=start + timedelta(minutes=index), created_at=start + timedelta(minutes=index))
+                    for index in range(count)]
+        session.add_all(expenses)
+        session.commit()
+        return [expense.id for expense in expenses]
+
+
+def test_load_racing_an_invalidation_is_not_cached(user, monkeypatch):
+    user_id, category_id = user
+    add_expenses(user_id, category_id, 3, datetime(2026, 1, 1))
+    load = recent._load
+
+    def load_while_the_sheet_sync_changes_expenses(user_id):
+        buffer = load(user_id)
+        recent.invalidate_recent_expenses(user_id)
+        return buffer
+    monkeypatch.setattr(recent, '_load', load_while_the_sheet_sync_changes_expenses)
+
+    expenses, _ = recent.get_recent_expenses(user_id, 2)
+
+    assert len(expenses) == 2
+    assert user_id not in recent._buffers
+
+
+def test_pages_skip_expenses_of_deleted_categories(user):
+    user_id, category_id = user
+    with Session() as session:
+        other = Category(user_id=user_id, name='Travel', name_normalized='travel')
+        session.add(other)
+        session.commit()
+        other_id = other.id
+    kept = add_expenses(user_id, category_id, 3, datetime(2026, 1, 1))
+    add_expenses(user_id, other_id, 4, datetime(2026, 2, 1))
+    recent.get_recent_expenses(user_id, 5)
+
+    with Session() as session:
+        session.execute(delete(Category).where(Category.id == other_id))
+        session.commit()
+    bump_category_version(user_id)
+
+    expenses, has_more = recent.get_recent_expenses(user_id, 2)
+    assert [expense.id for expense in expenses] == kept[::-1][:2]
+    assert has_more
+    expenses, has_more = recent.get_recent_expenses(user_id, 3)
+    assert [expense.id for expense in expenses] == kept[::-1]
+    assert not has_more
+
+
+def test_forgotten_change_still_stops_a_racing_load_from_being_cached(user, monkeypatch):
+    user_id, category_id = user
+    add_expenses(user_id, category_id, 3, datetime(2026, 1, 1))
+    monkeypatch.setattr(recent, 'RECENT_GENERATION_USERS', 2)
+    load = recent._load
+
+    def load_while_other_users_change(user_id):
+        buffer = load(user_id)
+        # The user's change is forgotten before the load ends
+        recent.invalidate_recent_expenses(user_id)
+        recent.invalidate_recent_expenses(user_id + 1)
+        recent.invalidate_recent_expenses(user_id + 2)
+        return buffer
+    monkeypatch.setattr(recent, '_load', load_while_other_users_change)
+
+    recent.get_recent_expenses(user_id, 2)
+
+    assert user_id not in recent._generations
+    assert user_id not in recent._buffers
+    assert len(recent._generations) == 2
@@ -0,0 +1,93 @@
+# Standard library imports
+import asyncio
+from datetime import datetime
+
+# Third-party imports
+import pytest
+
+# Local application imports
+from app import db_utils
+from app.db_utils import (Session, begin_unit_of_work, end_unit_of_work, commit_unit_of_work, save_unit_of_work,
+                          outside_unit_of_work, get_session, on_commit)
+from app.categories import add_category
+from app.expenses import add_expense
+from app.models import Expense
+
+
+def committed_descriptions(user_id):
+    with Session() as session:
+        return [expense.description for expense in session.query(Expense).filter(Expense.user_id == user_id)]
+
+
+def test_failed_helper_keeps_the_earlier_changes_of_the_update(user):
+    user_id, category_id = user
+    ran = []
+
+    session, token = begin_unit_of_work()
+    try:
+        assert add_expense('3.50', category_id, user_id, 'bread', datetime(2026, 1, 1)) is not None
+        on_commit(session, lambda: ran.append('expense'))
+        # The duplicate category fails in its savepoint, not in the update's transaction
+        with pytest.raises(ValueError):
+            add_category(user_id, 'Groceries')
+    finally:
+        end_unit_of_work(token)
+        commit_unit_of_work(session)
+
+    assert committed_descriptions(user_id) == ['bread']
+    assert ran == ['expense']
+
+
+def test_save_unit_of_work_commits_before_the_update_ends(user):
+    user_id, category_id = user
+
+    session, token = begin_unit_of_work()
+    try:
+        add_expense('1', category_id, user_id, 'coffee', datetime(2026, 1, 1))
+        assert committed_descriptions(user_id) == []
+        save_unit_of_work()
+        assert committed_descriptions(user_id) == ['coffee']
+    finally:
+        end_unit_of_work(token)
+        commit_unit_of_work(session)
+
+
+def test_failing_callback_does_not_skip_the_others(db):
+    ran = []
+
+    def fail():
+        raise RuntimeError('stale cache')
+
+    session, token = begin_unit_of_work()
+    try:
+        on_commit(session, fail)
+        on_commit(session, lambda: ran.append('second'))
+    finally:
+        end_unit_of_work(token)
+        commit_unit_of_work(session)
+
+    assert ran == ['second']
+
+
+def test_spawned_tasks_do_not_share_the_update_session(db):
+    async def session_of_task():
+        await asyncio.sleep(0)
+        with get_session() as session:
+            return session
+
+    async def update():
+        session, token = begin_unit_of_work()
+        try:
+            detached = asyncio.create_task(outside_unit_of_work(session_of_task()))
+            # A task created without the wrapper copies the context, and outlives the update
+            copied = asyncio.create_task(session_of_task())
+            assert db_utils._unit_of_work_session() is session
+        finally:
+            end_unit_of_work(token)
+            commit_unit_of_work(session)
+        return session, await detached, await copied
+
+    session, detached_session, copied_session = asyncio.run(update())
+
+    assert detached_session is not session
+    assert copied_session is not session
@@ -0,0 +1,141 @@
+# Standard library imports
+import time
+import asyncio
+from datetime import datetime
+
+# Third-party imports
+from telegram import Update, Message, Chat, User, CallbackQuery
+from telegram.ext import Application, ApplicationBuilder, MessageHandler, filters
+
+# Local application imports
+from app.db_utils import Session, get_session, on_commit, fail_unit_of_work
+from app.expenses import add_expense
+from app.idempotency import UpdateDeduplicator
+from app.models import Expense
+from app.update_processor import PerUserUpdateProcessor
+
+USER = User(id=42, first_name='Test', is_bot=False)
+CHAT = Chat(id=42, type=Chat.PRIVATE)
+
+
+def message_update(update_id):
+    message = Message(message_id=update_id, date=datetime(2026, 1, 1), chat=CHAT, from_user=USER, text='hi')
+    return Update(update_id=update_id, message=message)
+
+
+def button_update(update_id, query_id, data='delete_1'):
+    message = Message(message_id=7, date=datetime(2026, 1, 1), chat=CHAT, from_user=USER, text='menu')
+    query = CallbackQuery(id=query_id, from_user=USER, chat_instance='chat', data=data, message=message)
+    return Update(update_id=update_id, callback_query=query)
+
+
+def process(processor, updates):
+    handled = []
+
+    async def handler(update):
+        handled.append(update.update_id)
+
+    async def run():
+        # Created in arrival order, as the Application does
+        tasks = [asyncio.create_task(processor.do_process_update(update, handler(update))) for update in updates]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    return handled
+
+
+class SlowFirstClaim:
+    """Deduplicator whose database claim of the first update is the slowest."""
+
+    @staticmethod
+    def claim_in_memory(update):
+        return True
+
+    @staticmethod
+    def claim_in_database(update):
+        time.sleep(0.2 if update.update_id == 1 else 0)
+        return True
+
+
+def test_updates_of_a_user_run_in_arrival_order(db):
+    processor = PerUserUpdateProcessor(max_workers=4, deduplicator=SlowFirstClaim())
+
+    assert process(processor, [message_update(1), message_update(2), message_update(3)]) == [1, 2, 3]
+    assert processor._user_locks == {}
+
+
+def test_redelivered_update_is_dropped(db):
+    processor = PerUserUpdateProcessor(max_workers=4, deduplicator=UpdateDeduplicator())
+
+    assert process(processor, [message_update(1), message_update(1), message_update(2)]) == [1, 2]
+
+
+def test_update_processed_before_a_restart_is_dropped(db):
+    process(PerUserUpdateProcessor(max_workers=4, deduplicator=UpdateDeduplicator()), [message_update(1)])
+
+    # A new deduplicator has an empty memory, the stored keys still match
+    restarted = PerUserUpdateProcessor(max_workers=4, deduplicator=UpdateDeduplicator())
+    assert process(restarted, [message_update(1), message_update(2)]) == [2]
+
+
+def test_repeated_button_press_is_dropped(db, monkeypatch):
+    async def answer(*args, **kwargs):
+        return True
+    monkeypatch.setattr(CallbackQuery, 'answer', answer)
+    processor = PerUserUpdateProcessor(max_workers=4, deduplicator=UpdateDeduplicator())
+
+    handled = process(processor, [button_update(1, 'a'), button_update(2, 'b'), button_update(3, 'c', data='other')])
+
+    assert handled == [1, 3]
+
+
+def test_failed_update_is_rolled_back(user):
+    user_id, category_id = user
+    ran = []
+
+    async def handler():
+        add_expense('1', category_id, user_id, 'partial', datetime(2026, 1, 1))
+        with get_session() as session:
+            on_commit(session, lambda: ran.append('callback'))
+        raise RuntimeError('handler failed')
+
+    async def run():
+        processor = PerUserUpdateProcessor(max_workers=1)
+        try:
+            await processor.do_process_update(message_update(1), handler())
+        except RuntimeError:
+            pass
+
+    asyncio.run(run())
+
+    with Session() as session:
+        assert session.query(Expense).count() == 0
+    assert ran == []
+
+
+def test_update_failing_in_a_handler_of_the_application_is_rolled_back(user, monkeypatch):
+    # Initializing the Application would call the Bot API
+    monkeypatch.setattr(Application, '_check_initialized', lambda self: None)
+    user_id, category_id = user
+
+    async def handler(update, context):
+        add_expense('1', category_id, user_id, 'partial', datetime(2026, 1, 1))
+        raise RuntimeError('handler failed')
+
+    async def error_handler(update, context):
+        fail_unit_of_work()
+
+    async def run():
+        application = ApplicationBuilder().token('123:test').updater(None).build()
+        application.add_handler(MessageHandler(filters.TEXT, handler))
+        application.add_error_handler(error_handler)
+        processor = PerUserUpdateProcessor(max_workers=1)
+        update = message_update(1)
+        update.set_bot(application.bot)
+        # The Application catches the handler's error, the processor only sees the error handler's mark
+        await processor.do_process_update(update, application.process_update(update))
+
+    asyncio.run(run())
+
+    with Session() as session:
+        assert session.query(Expense).count() == 0
@@ -0,0 +1,31 @@
+# Standard library imports
+from datetime import datetime
+
+# Third-party imports
+from sqlalchemy import event
+
+# Local application imports
+from app import whispergpt
+from app.categories import bump_category_version, get_category_version
+from app.db_utils import Session, engine
+from app.models import Expense
+from app.warmup import preload_active_users
+
+
+def test_category_change_during_warm_up_is_not_cached_as_current(user):
+    user_id, category_id = user
+    with Session() as session:
+        session.add(Expense(user_id=user_id, category_id=category_id, amount_cents=100, created_at=datetime.utcnow()))
+        session.commit()
+
+    # The user adds a category while the warm-up reads the categories
+    def change_categories(connection, clauseelement, multiparams, params, execution_options):
+        if 'categories' in str(clauseelement):
+            bump_category_version(user_id)
+    event.listen(engine, 'before_execute', change_categories)
+    try:
+        assert preload_active_users() == 1
+    finally:
+        event.remove(engine, 'before_execute', change_categories)
+
+    assert whispergpt._category_prompts[user_id][0] != get_category_version(user_id)